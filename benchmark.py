@@ -0,0 +1,487 @@
+#!/usr/bin/python
+"""
+OpenClass benchmarks.
+
+Usage: benchmark.py <test> [options]
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import random
+import socket
+import httplib
+import logging
+import resource
+import tempfile
+import shutil
+import traceback
+import threading
+import multiprocessing
+import collections
+
+from openclass import screen, protocol, fec, network, streamer
+
+def bench_encoding(frames=20):
+    """Measures projection frames per second for different worker counts"""
+    frames = int(frames)
+    capture = screen.SyntheticCapture("motion")
+    image = capture.grab(*capture.get_size())
+    rects = screen.split_rect((0, 0, image.get_width(), image.get_height()), 256, 192)
+    max_workers = multiprocessing.cpu_count()
+    workers = 1
+    while workers <= max_workers:
+        scr = screen.Screen(logging.getLogger("benchmark"), workers=workers, capture=capture)
+        tiler = screen.Tiler(max_size=1472 - protocol.CHUNK_HEADER_SIZE)
+        # warm up worker processes and the tiler cost map
+        tiler.tiles(image, rects, 75, encode=scr.encode)
+        start = time.time()
+        for i in range(frames):
+            tiles = tiler.tiles(image, rects, 75, encode=scr.encode)
+        elapsed = time.time() - start
+        scr.stop()
+        print "workers=%d: %.2f frames/s (%d tiles per frame)" % (workers, frames / elapsed, len(tiles))
+        workers *= 2
+
+def bench_projection(capture="synthetic", frames=50):
+    """Measures the capture-diff-encode pipeline on a headless capture backend.
+    With the synthetic backend, all its modes are measured."""
+    frames = int(frames)
+    if capture == "synthetic":
+        specs = ["synthetic:%s" % mode for mode in screen.SyntheticCapture.MODES]
+    else:
+        specs = [capture]
+    for spec in specs:
+        scr = screen.Screen(logging.getLogger("benchmark"), workers=multiprocessing.cpu_count(), capture=spec)
+        diff = screen.FrameDiff()
+        tiler = screen.Tiler(max_size=1472 - protocol.CHUNK_HEADER_SIZE)
+        tiles = 0
+        size = 0
+        start = time.time()
+        for i in range(frames):
+            chunks = scr.chunks(diff=diff, tiler=tiler)
+            tiles += len(chunks)
+            size += sum([len(chunk[4]) for chunk in chunks])
+        elapsed = time.time() - start
+        scr.stop()
+        print "%s: %.2f frames/s, %.1f tiles/frame, %d bytes/frame" % (spec,
+                frames / elapsed, tiles * 1.0 / frames, size / frames)
+
+def bench_capture(frames=50):
+    """Measures full screen captures per second of each X11 capture backend.
+    Run it inside Xvfb (xvfb-run) on headless machines."""
+    frames = int(frames)
+    for spec in ["gdk", "xshm"]:
+        capture = screen.get_capture(spec, logging.getLogger("benchmark"))
+        width, height = capture.get_size()
+        start = time.time()
+        for i in range(frames):
+            capture.grab(width, height)
+        elapsed = time.time() - start
+        capture.close()
+        print "%s (%s): %.2f captures/s" % (spec, capture.__class__.__name__, frames / elapsed)
+
+def bench_fec(frames=200, tiles=64):
+    """Measures the fraction of lost tiles rebuilt by forward error
+    correction, for different loss rates and parity group sizes"""
+    frames = int(frames)
+    tiles = int(tiles)
+    logger = logging.getLogger("benchmark")
+    proto = protocol.Protocol(logger)
+    r = random.Random(1)
+    payload = "".join([chr(r.randint(0, 255)) for i in range(1400)])
+    for loss in [0.01, 0.02, 0.05, 0.1, 0.2]:
+        for group_size in [4, 8, 16, fec.group_size_for_loss(loss)]:
+            encoder = fec.FecEncoder(logger)
+            decoder = fec.FecDecoder(logger)
+            lost = 0
+            delivered = 0
+            sent = 0
+            start = time.time()
+            for frame_id in range(1, frames + 1):
+                packets = [proto.pack_chunk(1024, 768, 0, (0, 0, 64, 64, payload[:r.randint(700, 1400)]),
+                    frame_id, seq, tiles) for seq in range(tiles)]
+                packets = encoder.encode(packets, frame_id, group_size)
+                sent += len(packets)
+                for packet in packets:
+                    dropped = r.random() < loss
+                    if not proto.is_parity(packet) and dropped:
+                        lost += 1
+                    if not dropped:
+                        for data in decoder.put(packet):
+                            delivered += 1
+            elapsed = time.time() - start
+            recovered = decoder.recovered
+            print "loss=%.2f group=%2d: %5.1f%% of lost tiles rebuilt, %5.1f%% of tiles delivered, %4.1f%% overhead, %.0f packets/s decoded" % (
+                    loss, group_size, 100.0 * recovered / max(lost, 1), 100.0 * delivered / (frames * tiles),
+                    100.0 * (sent - frames * tiles) / (frames * tiles), sent / elapsed)
+
+def get_allocated_memory():
+    """Returns the number of bytes allocated by the interpreter, or None
+    when it cannot tell"""
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return tracemalloc.get_traced_memory()[0]
+
+def stop_allocation_tracing():
+    """Stops tracing allocations, which slows everything down"""
+    try:
+        import tracemalloc
+    except ImportError:
+        return
+    tracemalloc.stop()
+
+def bench_receive(packets=100000, size=1400):
+    """Measures the datagram receive path of the multicast listener, up to
+    the decoded projection chunk: with a fresh string per datagram handed
+    off through a multiprocessing queue, and with a buffer ring handed off
+    through a deque and decoded from the buffer. Uses loopback unicast, so
+    it runs without a multicast route."""
+    packets = int(packets)
+    size = int(size)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(("127.0.0.1", 0))
+    addr = receiver.getsockname()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    proto = protocol.Protocol(logging.getLogger("benchmark"))
+    payload = proto.pack_chunk(1024, 768, 0, (0, 0, 64, 64, "x" * (size - protocol.CHUNK_HEADER_SIZE)), 1, 0, 1)
+    batch = 32
+
+    def recv_string(queue):
+        data, client_addr = receiver.recvfrom(network.DATAGRAM_SIZE + 1024)
+        queue.put((data, client_addr[0]))
+        data, source = queue.get()
+        return proto.unpack_chunk(data)
+
+    def recv_ring(queue, ring=network.ReceiveRing()):
+        data, client_addr = ring.recv(receiver)
+        queue.append((data, client_addr[0]))
+        data, source = queue.popleft()
+        chunk = proto.unpack_chunk(data)
+        return chunk[:-1] + (chunk[-1].tobytes(),)
+
+    for name, recv, queue in [("recvfrom+Queue", recv_string, multiprocessing.Queue()),
+            ("recv_into+deque", recv_ring, collections.deque(maxlen=network.RING_SIZE - 1))]:
+        received = 0
+        elapsed = 0.0
+        allocated = 0
+        while received < packets:
+            for i in range(batch):
+                sender.sendto(payload, addr)
+            before = get_allocated_memory()
+            start = time.time()
+            # kept until counted, so that freed memory does not hide them
+            messages = [recv(queue) for i in range(batch)]
+            elapsed += time.time() - start
+            if before is not None:
+                allocated += get_allocated_memory() - before
+            del messages
+            received += batch
+        if get_allocated_memory() is None:
+            allocations = "n/a"
+        else:
+            allocations = "%.0f" % (allocated * 1.0 / received)
+        print "%s: %.0f packets/s, %s bytes allocated per packet" % (name, received / elapsed, allocations)
+
+class BenchController:
+    """Answers control requests like a teacher with nothing to do"""
+    logger = logging.getLogger("benchmark")
+
+    def process_request(self, client, request, params):
+        return "noop", None
+
+def bench_http(students="50,100,200", duration=10, uploaders=0.1):
+    """Measures action request latency of the control server, with
+    students polling every second over keep-alive connections and a share
+    of them uploading a screenshot with each request"""
+    duration = float(duration)
+    uploaders = float(uploaders)
+    shot = "x" * 32768
+    for count in [int(x) for x in students.split(",")]:
+        listener = network.HTTPListener(BenchController(), port=0)
+        listener.setDaemon(True)
+        listener.start()
+        port = listener.socket.server_address[1]
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def student(upload):
+            connection = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+            next_poll = time.time() + random.random()
+            end = time.time() + duration
+            while next_poll < end:
+                time.sleep(max(0, next_poll - time.time()))
+                next_poll += 1
+                try:
+                    if upload:
+                        connection.request("POST", "/showscreen", "shot=%s" % shot,
+                                {"Content-Type": "application/x-www-form-urlencoded"})
+                        connection.getresponse().read()
+                    start = time.time()
+                    connection.request("GET", "/actions?name=student")
+                    connection.getresponse().read()
+                except:
+                    connection.close()
+                    with lock:
+                        errors.append(sys.exc_value)
+                    continue
+                with lock:
+                    latencies.append(time.time() - start)
+
+        threads = [threading.Thread(target=student, args=(i < count * uploaders,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        listener.actions.put(1)
+        latencies.sort()
+        if not latencies:
+            print "%d students: no request succeeded (%d errors)" % (count, len(errors))
+            continue
+        print "%d students: %d requests, p50 %.1f ms, p99 %.1f ms, max %.1f ms, %d errors" % (count,
+                len(latencies), 1000 * latencies[len(latencies) / 2],
+                1000 * latencies[len(latencies) * 99 / 100], 1000 * latencies[-1], len(errors))
+
+class FileController:
+    """Answers every request with a file"""
+    logger = logging.getLogger("benchmark")
+
+    def __init__(self, path):
+        self.path = path
+
+    def process_request(self, client, request, params):
+        return network.FileResponse(self.path), None
+
+def download_all(port, clients):
+    """Downloads a file from the control server with concurrent clients,
+    returns the number of bytes received by each of them"""
+    received = []
+    lock = threading.Lock()
+
+    def download():
+        connection = httplib.HTTPConnection("127.0.0.1", port, timeout=60)
+        total = 0
+        try:
+            connection.request("GET", "/getfile?file=bench")
+            response = connection.getresponse()
+            while True:
+                data = response.read(65536)
+                if not data:
+                    break
+                total += len(data)
+        except:
+            traceback.print_exc()
+        connection.close()
+        with lock:
+            received.append(total)
+
+    threads = [threading.Thread(target=download) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return received
+
+def bench_download(clients=40, size=64):
+    """Measures the throughput of concurrent file downloads from the control
+    server and its peak memory use. Size is in MB."""
+    clients = int(clients)
+    size = int(size) * 1024 * 1024
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as tmp:
+        block = os.urandom(1024 * 1024)
+        for i in range(size / len(block)):
+            tmp.write(block)
+    listener = network.HTTPListener(FileController(path), port=0)
+    listener.setDaemon(True)
+    listener.start()
+    port = listener.socket.server_address[1]
+    start = time.time()
+    received = download_all(port, clients)
+    elapsed = time.time() - start
+    listener.actions.put(1)
+    os.unlink(path)
+    complete = len([total for total in received if total == size])
+    print "%d downloads of %d MB: %.1f MB/s, %d complete, peak memory %d MB" % (clients,
+            size / (1024 * 1024), sum(received) / elapsed / (1024 * 1024), complete,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+def bench_files(receivers="10,40,100", size=2, loss=0.02, rate=20000000):
+    """Measures the teacher uplink used to share a file with a class, with
+    http downloads and with multicast and repairs. Multicast is simulated
+    over loopback unicast, each receiver losing chunks at random, so it
+    runs without a multicast route. Size is in MB."""
+    size = int(size) * 1024 * 1024
+    loss = float(loss)
+    rate = int(rate)
+    logger = logging.getLogger("benchmark")
+    proto = protocol.Protocol(logger)
+    r = random.Random(1)
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "shared")
+    with open(path, "wb") as fd:
+        fd.write(os.urandom(size))
+    for count in [int(x) for x in receivers.split(",")]:
+        listener = network.HTTPListener(FileController(path), port=0)
+        listener.setDaemon(True)
+        listener.start()
+        start = time.time()
+        http_sent = sum(download_all(listener.socket.server_address[1], count))
+        http_elapsed = time.time() - start
+        listener.actions.put(1)
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(0.1)
+        sender = network.McastFileSender(logger, rate=rate, addr="127.0.0.1", port=receiver.getsockname()[1])
+        sender.start()
+        decoders = [streamer.StreamerDecoder(os.path.join(tmpdir, "received%d" % i)) for i in range(count)]
+        encoder = streamer.StreamerEncoder(path)
+        encoder.prepare()
+        start = time.time()
+        last_chunk = start
+        next_nack = start
+        sender.add("shared", encoder)
+        complete = 0
+        while complete < count and time.time() - start < 300:
+            try:
+                data = receiver.recv(network.DATAGRAM_SIZE)
+                last_chunk = time.time()
+                for decoder in decoders:
+                    if r.random() >= loss:
+                        decoder.put_chunk(data)
+            except socket.timeout:
+                pass
+            now = time.time()
+            if now < next_nack:
+                continue
+            # reports as sent by students, a bit more often
+            next_nack = now + 0.2
+            complete = 0
+            for decoder in decoders:
+                if decoder.is_complete():
+                    complete += 1
+                    continue
+                end = decoder.highest
+                if now - last_chunk > 0.2:
+                    end = None
+                ranges = decoder.missing_ranges(end, limit=64)
+                if ranges:
+                    sender.nack("shared", proto.unpack_ranges(proto.pack_ranges(ranges)))
+        elapsed = time.time() - start
+        sender.quit()
+        receiver.close()
+        for decoder in decoders:
+            decoder.finish()
+            os.unlink(decoder.filename)
+        print "%d receivers: http %.1f MB in %.1f s, multicast %.1f MB (%d chunks repaired) in %.1f s, %d complete" % (
+                count, http_sent / 1048576.0, http_elapsed, sender.sent_bytes / 1048576.0,
+                sender.repaired_chunks, elapsed, complete)
+    shutil.rmtree(tmpdir)
+
+def bench_streamer(size=256, chunk_size=1024):
+    """Measures the chunks sent and decoded per second by the file streamer,
+    and the memory they use. Chunks of any size are sent to a loopback
+    socket, handing the mapped file to sendmsg(), and joined into datagrams
+    for sendto(). Size is in MB."""
+    size = int(size) * 1024 * 1024
+    chunk_size = int(chunk_size)
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as tmp:
+        block = os.urandom(1024 * 1024)
+        for i in range(size / len(block)):
+            tmp.write(block)
+    encoder = streamer.StreamerEncoder(path, chunk_size)
+    encoder.prepare()
+    num_chunks = encoder.get_num_chunks()
+    # never read, the kernel drops the datagrams which do not fit in its buffer
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    addr, port = receiver.getsockname()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for method in ["sendmsg", "sendto"]:
+        sender = network.ChunkSender(sock, addr, port, 0)
+        if method == "sendto":
+            sender.msg = None
+        elif sender.msg is None or encoder.address is None:
+            print "sending with sendmsg: not available"
+            continue
+        before = get_allocated_memory()
+        start = time.time()
+        total = 0
+        for pos in xrange(num_chunks):
+            header, offset, length = encoder.get_chunk_range(pos)
+            sender.send(encoder, header, offset, length)
+            total += len(header) + length
+        elapsed = time.time() - start
+        allocated = "n/a"
+        if before is not None:
+            allocated = "%d" % (get_allocated_memory() - before)
+        print "sending %d chunks of %d bytes with %s: %.0f chunks/s, %.1f MB/s, %s bytes kept allocated" % (
+                num_chunks, chunk_size, method, num_chunks / elapsed, total / elapsed / (1024 * 1024), allocated)
+    stop_allocation_tracing()
+    sock.close()
+    receiver.close()
+    # chunks arrive out of order, a tenth of them twice
+    r = random.Random(1)
+    order = range(num_chunks)
+    r.shuffle(order)
+    order.extend(order[::10])
+    for use_mmap in [False, True]:
+        decoder = streamer.StreamerDecoder(path + ".out", use_mmap)
+        scan = 0.0
+        elapsed = 0.0
+        for i, chunk in enumerate(order):
+            data = encoder.get_chunk(chunk)
+            start = time.time()
+            decoder.put_chunk(data)
+            elapsed += time.time() - start
+            if i % 10000 == 0:
+                start = time.time()
+                decoder.missing_ranges()
+                scan += time.time() - start
+        decoder.finish()
+        os.unlink(decoder.filename)
+        print "decoding with mmap=%s: %.0f chunks/s, complete=%s, %.2f ms per missing ranges scan" % (use_mmap,
+                len(order) / elapsed, decoder.is_complete(), 1000 * scan / (len(order) / 10000 + 1))
+    encoder.finish()
+    os.unlink(path)
+    print "peak memory %d MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+TESTS = {
+        "fec": bench_fec,
+        "http": bench_http,
+        "capture": bench_capture,
+        "encoding": bench_encoding,
+        "projection": bench_projection,
+        "receive": bench_receive,
+        "download": bench_download,
+        "files": bench_files,
+        "streamer": bench_streamer,
+        }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in TESTS:
+        print "Usage: %s <%s> [options]" % (sys.argv[0], "|".join(sorted(TESTS.keys())))
+        sys.exit(1)
+    TESTS[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+"""Background file download module
+
+Downloads files shared by the teacher in background threads, resuming
+interrupted transfers with http range requests and verifying the result
+against the sha-256 digest sent by the teacher.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import base64
+import hashlib
+import httplib
+import urlparse
+from threading import Thread
+from Queue import Queue
+
+# suffix of the files being downloaded
+PART_SUFFIX=".part"
+BLOCK_SIZE=65536
+# seconds between progress reports of a download
+PROGRESS_INTERVAL=0.5
+
+def file_digest(path):
+    """Returns the sha-256 digest of a file, encoded as in the http Digest
+    header"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fd:
+        while True:
+            data = fd.read(BLOCK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return base64.b64encode(digest.digest())
+
+def parse_digest(header):
+    """Returns the sha-256 value of a Digest header, or None"""
+    for item in (header or "").split(","):
+        algorithm, sep, value = item.strip().partition("=")
+        if algorithm.lower() == "sha-256" and value:
+            return value
+    return None
+
+def fetch_digest(url, timeout=30):
+    """Asks the server for the digest of a file with a HEAD request,
+    returns None when it is not known"""
+    url = urlparse.urlsplit(url)
+    path = url.path
+    if url.query:
+        path += "?" + url.query
+    connection = httplib.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    try:
+        connection.request("HEAD", path)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            return None
+        return parse_digest(response.getheader("Digest"))
+    finally:
+        connection.close()
+
+class DownloadError(Exception):
+    """Download failure which trying again would not solve"""
+    pass
+
+class Download:
+    """A file being downloaded"""
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.name = os.path.basename(path)
+        # total size, when known
+        self.size = None
+        self.received = 0
+        # ETag of the file the partial download was received from, without
+        # which it is not resumed
+        self.etag = None
+        # queued, running, done or failed
+        self.status = "queued"
+        self.error = None
+
+    def get_progress(self):
+        """Returns the fraction of the file received, or None"""
+        if not self.size:
+            return None
+        return self.received * 1.0 / self.size
+
+class Downloader:
+    """Downloads files in background threads, max_downloads at once.
+    Callback is called from the download threads with the Download whose
+    status or progress changed."""
+    def __init__(self, logger, callback, max_downloads=2, retries=5, timeout=30):
+        self.logger = logger
+        self.callback = callback
+        self.retries = retries
+        self.timeout = timeout
+        self.queue = Queue()
+        self.workers = []
+        for i in range(max(1, max_downloads)):
+            worker = Thread(target=self.run)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def add(self, url, path):
+        """Queues the download of url into path"""
+        download = Download(url, path)
+        self.callback(download)
+        self.queue.put(download)
+        return download
+
+    def quit(self):
+        """Stops the download threads once their current download ends"""
+        for worker in self.workers:
+            self.queue.put(None)
+
+    def run(self):
+        """Downloads queued files"""
+        while True:
+            download = self.queue.get()
+            if download is None:
+                return
+            self.fetch(download)
+
+    def fetch(self, download):
+        """Downloads a file, trying again after network failures"""
+        download.status = "running"
+        self.callback(download)
+        for attempt in range(self.retries):
+            try:
+                self.transfer(download)
+                download.error = None
+                download.status = "done"
+                self.callback(download)
+                return
+            except DownloadError:
+                download.error = sys.exc_value
+                break
+            except:
+                self.logger.exception("Downloading %s, attempt %d" % (download.url, attempt + 1))
+                download.error = sys.exc_value
+            if attempt < self.retries - 1:
+                time.sleep(min(2 ** attempt, 30))
+        self.logger.error("Unable to download %s: %s" % (download.url, download.error))
+        download.status = "failed"
+        self.callback(download)
+
+    def transfer(self, download):
+        """Downloads what is missing of a file, and verifies it"""
+        part = download.path + PART_SUFFIX
+        offset = 0
+        if download.etag and os.path.exists(part):
+            # only resumed from the same file, which the teacher checks
+            # against the ETag
+            offset = os.path.getsize(part)
+        url = urlparse.urlsplit(download.url)
+        path = url.path
+        if url.query:
+            path += "?" + url.query
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+            headers["If-Range"] = download.etag
+        connection = httplib.HTTPConnection(url.hostname, url.port or 80, timeout=self.timeout)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            if response.status == 416:
+                # nothing left to download, or the file changed
+                response.read()
+                size = response.getheader("Content-Range", "").rpartition("/")[2]
+                if size != str(offset) or response.getheader("ETag") != download.etag:
+                    os.unlink(part)
+                    raise IOError("Partial download of %s does not match the file" % download.name)
+                length = 0
+            elif response.status in (200, 206):
+                if response.status == 200:
+                    offset = 0
+                if response.getheader("Accept-Ranges") is None:
+                    # the teacher answered with an error message, followed
+                    # by its parameters
+                    message, sep, params = response.read().rpartition(" ")
+                    raise DownloadError(message or download.name)
+                length = int(response.getheader("Content-Length"))
+            else:
+                raise IOError("HTTP error %d" % response.status)
+            digest = parse_digest(response.getheader("Digest"))
+            download.etag = response.getheader("ETag")
+            download.size = offset + length
+            download.received = offset
+            last_report = time.time()
+            with open(part, "r+b" if offset else "wb") as fd:
+                fd.seek(offset)
+                fd.truncate()
+                while download.received < download.size:
+                    data = response.read(min(BLOCK_SIZE, download.size - download.received))
+                    if not data:
+                        raise IOError("Connection closed after %d bytes" % download.received)
+                    fd.write(data)
+                    download.received += len(data)
+                    now = time.time()
+                    if now - last_report > PROGRESS_INTERVAL:
+                        last_report = now
+                        self.callback(download)
+        finally:
+            connection.close()
+        if digest and file_digest(part) != digest:
+            os.unlink(part)
+            raise IOError("Digest mismatch for %s" % download.name)
+        if os.path.exists(download.path):
+            os.unlink(download.path)
+        os.rename(part, download.path)
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+"""Forward error correction module
+
+Protects the tiles of a projection frame with XOR parity packets: each
+group of tiles is followed by a parity packet, from which any single
+lost tile of the group can be rebuilt by the students.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+"""
+
+import binascii
+
+import protocol
+
+# largest group of tiles protected by a single parity packet
+MAX_GROUP_SIZE=16
+# extra bytes of a parity packet over the largest tile of its group
+PARITY_OVERHEAD=protocol.PARITY_HEADER_SIZE + 2 * MAX_GROUP_SIZE
+
+def xor(packets, size):
+    """XORs a list of strings, padded with zeroes to size"""
+    value = 0
+    for packet in packets:
+        if packet:
+            value ^= int(binascii.hexlify(packet.ljust(size, "\0")), 16)
+    return binascii.unhexlify("%0*x" % (size * 2, value))
+
+def group_size_for_loss(loss):
+    """Returns a parity group size suited for a loss rate, or 0 when
+    protection is not needed. Groups are sized so that two losses in the
+    same group, which cannot be repaired, remain unlikely."""
+    if loss < 0.005:
+        return 0
+    return max(2, min(MAX_GROUP_SIZE, int(1 / (4 * loss))))
+
+class FecEncoder:
+    """Adds parity packets to the packets of a frame"""
+    def __init__(self, logger):
+        self.protocol = protocol.Protocol(logger)
+
+    def encode(self, packets, frame_id, group_size):
+        """Returns the packets of a frame, in sequence order, with a parity
+        packet following each group of group_size packets"""
+        if not group_size:
+            return packets
+        res = []
+        for first in range(0, len(packets), group_size):
+            group = packets[first:first + group_size]
+            res.extend(group)
+            lengths = [len(packet) for packet in group]
+            payload = xor(group, max(lengths))
+            res.append(self.protocol.pack_parity(frame_id, first, lengths, payload))
+        return res
+
+class FecDecoder:
+    """Rebuilds lost packets from parity packets"""
+    # frames kept for repairing, counting from the newest one
+    WINDOW = 3
+
+    def __init__(self, logger):
+        self.protocol = protocol.Protocol(logger)
+        # frame id -> {sequence number: packet}
+        self.packets = {}
+        # frame id -> {first sequence number: (lengths, payload)}
+        self.parities = {}
+        self.newest = -1
+        # newest frame protected by parity packets
+        self.protected = -1
+        self.recovered = 0
+
+    def put(self, data):
+        """Accounts for a received packet, returns the list of data packets
+        it makes available: the packet itself first, if it is not a parity
+        packet, and a rebuilt packet when it allowed to repair one. The
+        packet may be a memoryview of a reused buffer: it is only copied when
+        kept, while the teacher sends parity packets."""
+        if self.protocol.is_parity(data):
+            parity = self.protocol.unpack_parity(data)
+            if not parity:
+                return []
+            frame_id, first, lengths, payload = parity
+            self.new_frame(frame_id)
+            self.protected = max(self.protected, frame_id)
+            if isinstance(payload, memoryview):
+                payload = payload.tobytes()
+            self.parities.setdefault(frame_id, {})[first] = (lengths, payload)
+            return self.repair(frame_id, first)
+        frame_id, seq = self.protocol.peek_chunk(data)
+        self.new_frame(frame_id)
+        if self.protected <= frame_id - self.WINDOW:
+            # no parity packets lately, nothing to repair with
+            return [data]
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.packets.setdefault(frame_id, {})[seq] = data
+        res = [data]
+        for first in self.parities.get(frame_id, {}).keys():
+            if first <= seq < first + len(self.parities[frame_id][first][0]):
+                res.extend(self.repair(frame_id, first))
+        return res
+
+    def new_frame(self, frame_id):
+        """Forgets frames out of the repair window"""
+        if frame_id + protocol.FRAME_RESTART < self.newest:
+            # teacher restarted
+            self.packets = {}
+            self.parities = {}
+            self.newest = frame_id
+            self.protected = -1
+        if frame_id <= self.newest:
+            return
+        self.newest = frame_id
+        for frames in (self.packets, self.parities):
+            for old in frames.keys():
+                if old <= frame_id - self.WINDOW:
+                    del frames[old]
+
+    def repair(self, frame_id, first):
+        """Attempts to rebuild the missing packet of a group"""
+        lengths, payload = self.parities[frame_id][first]
+        packets = self.packets.get(frame_id, {})
+        missing = [seq for seq in range(first, first + len(lengths)) if seq not in packets]
+        if len(missing) > 1:
+            # wait for more packets
+            return []
+        del self.parities[frame_id][first]
+        if not missing:
+            return []
+        seq = missing[0]
+        group = [packets.get(i) for i in range(first, first + len(lengths))]
+        data = xor(group + [payload], len(payload))[:lengths[seq - first]]
+        packets[seq] = data
+        self.recovered += 1
+        return [data]
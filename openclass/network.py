@@ -16,16 +16,23 @@ along with this program; if not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import errno
+import binascii
+import mimetypes
+import collections
 from multiprocessing import Queue
 import socket
 import traceback
 import struct
 import SocketServer
+import select
 import sys
 import time
 import thread
 import ssl
 from threading import Thread
+import threading
+from Queue import Queue as ThreadQueue
 
 import cgi
 
@@ -36,15 +43,58 @@ from SimpleHTTPServer import SimpleHTTPRequestHandler
 LISTENPORT = 40000
 MCASTPORT = 40001
 BCASTPORT = 40002
+CONTROLPORT = 40003
 
 MCASTADDR="224.51.105.104"
 BCASTADDR="255.255.255.255"
 
+# per-class multicast groups are picked in 239.255.0.0/16 (organization
+# local scope), on a port from MCASTPORT_BASE on
+MCASTPORT_BASE = 41000
+MCASTPORT_RANGE = 1000
+# files are sent to the group of the class, on its port plus this offset
+FILEPORT_OFFSET = MCASTPORT_RANGE
+
+# linux socket options missing from the socket module
+IP_MULTICAST_ALL = 49
+IP_ADD_SOURCE_MEMBERSHIP = 39
+IP_DROP_SOURCE_MEMBERSHIP = 40
+
 DATAGRAM_SIZE=65000
 
+# threads serving HTTP requests
+HTTP_WORKERS=16
+# seconds to wait for a request to be sent
+HTTP_TIMEOUT=10
+# seconds an idle keep-alive connection is kept open
+HTTP_IDLE_TIMEOUT=60
+
+# files sent at once, others wait for their turn
+MAX_TRANSFERS=64
+
+# returned by controllers, with a timeout, to answer a request later
+DEFER="defer"
+
+# length prefix of control channel frames
+FRAME_HEADER=struct.Struct("!I")
+MAX_FRAME_SIZE=16 * 1024 * 1024
+
+# receive buffers reused by multicast listeners
+RING_SIZE=64
+
 DEBUG=False
 
 import system
+import protocol
+import streamer
+
+def get_class_group(class_name, host):
+    """Derives the multicast group and port of a class from its name and
+    the teacher host, so classes of the same building do not share them"""
+    h = binascii.crc32("%s@%s" % (class_name, host)) & 0xffffffff
+    addr = "239.255.%d.%d" % ((h >> 8) & 0xff, max(1, h & 0xff))
+    port = MCASTPORT_BASE + (h >> 16) % MCASTPORT_RANGE
+    return addr, port
 
 # {{{ BcastSender
 class BcastSender(Thread):
@@ -83,13 +133,54 @@ class BcastSender(Thread):
 
 # {{{ HTTPListener
 class HTTPRequestHandler(SimpleHTTPRequestHandler):
-    """Handles HTTP requests"""
+    """Handles HTTP requests. Each call to handle() serves one request, and
+    keep-alive connections are then handed back to the server until their
+    next request arrives."""
     listener = None
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_TIMEOUT
+    # send headers and body together
+    wbufsize = -1
 
     def log_request(self, code='-', size='-'):
         """Log request"""
         pass
 
+    def setup(self):
+        """Configures the connection"""
+        SimpleHTTPRequestHandler.setup(self)
+        # small responses on a keep-alive connection must not wait for the
+        # acknowledgement of the previous ones
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        """Handles a single request"""
+        self.close_connection = 1
+        self.handle_one_request()
+
+    deferred = None
+    transferring = None
+
+    def finish(self):
+        """Closes the connection, or keeps it for the next request"""
+        if self.deferred:
+            # still waiting for the answer
+            return
+        if self.transferring:
+            self.server.transfer(self, self.transferring)
+            return
+        if self.close_connection or not hasattr(self.server, "park"):
+            SimpleHTTPRequestHandler.finish(self)
+            self.server.shutdown_request(self.request)
+        else:
+            self.wfile.flush()
+            self.server.park(self)
+
+    def close(self):
+        """Closes an idle connection"""
+        SimpleHTTPRequestHandler.finish(self)
+        self.server.shutdown_request(self.request)
+
     def do_POST(self):
         """POST requests"""
         client = self.client_address[0]
@@ -103,6 +194,17 @@ class HTTPRequestHandler(SimpleHTTPRequestHandler):
         else:
             params = {}
 
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith("application/x-www-form-urlencoded") and \
+                not content_type.startswith("multipart/form-data"):
+            # raw binary body
+            try:
+                params["data"] = [self.rfile.read(int(self.headers.get('Content-Length', 0)))]
+            except:
+                self.server.controller.logger.warning("Unable to read request body from %s, skipping" % client,
+                        exc_info=True)
+            return self.process(client, path, params)
+
         try:
             form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={'REQUEST_METHOD':'POST', 'CONTENT_TYPE':self.headers['Content-Type'], })
             for item in form:
@@ -130,6 +232,10 @@ class HTTPRequestHandler(SimpleHTTPRequestHandler):
             params = {}
         return self.process(client, path, params)
 
+    def do_HEAD(self):
+        """HEAD request, answered as GET without the body"""
+        return self.do_GET()
+
     def process(self, client, path, params):
         """Processes a request"""
         # Support additional client identifiers, like $DISPLAY for multi-seat
@@ -140,66 +246,283 @@ class HTTPRequestHandler(SimpleHTTPRequestHandler):
                 client = client_s
             except:
                 traceback.print_exc()
+        since = time.time()
+        results, params_ret = self.server.controller.process_request(client, path, params)
+        if isinstance(results, FileResponse):
+            if hasattr(self.server, "transfer"):
+                # sent by a transfer thread once the request is finished,
+                # not to hold a worker
+                self.transferring = results
+            else:
+                self.send_file(results)
+            return
+        if results == DEFER and hasattr(self.server, "defer"):
+            # answered when the server is woken up for this client, or on
+            # timeout, without holding a thread meanwhile
+            self.deferred = (client, path, params)
+            self.server.defer(self, client, params_ret, since)
+            return
+        self.respond(results, params_ret)
+
+    def resume(self):
+        """Answers a deferred request"""
+        client, path, params = self.deferred
+        self.deferred = None
+        params.pop("wait", None)
         results, params = self.server.controller.process_request(client, path, params)
+        self.respond(results, params)
 
+    def send_file(self, response):
+        """Sends a file, or the byte range of it asked by the client"""
+        try:
+            fd = open(response.path, "rb")
+        except:
+            self.send_error(404, "File not found")
+            return
+        try:
+            st = os.fstat(fd.fileno())
+            size = st.st_size
+            # validator of the file contents, so a download is only resumed
+            # if the file did not change
+            etag = '"%x-%x"' % (size, int(st.st_mtime * 1000000))
+            start = 0
+            end = size - 1
+            status = 200
+            byte_range = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if if_range and if_range != etag:
+                # changed since the part the client has, send it whole
+                byte_range = None
+            if byte_range and byte_range.startswith("bytes=") and "," not in byte_range:
+                first, last = byte_range[6:].split("-", 1)
+                try:
+                    if first:
+                        start = int(first)
+                        if last:
+                            end = min(int(last), size - 1)
+                    elif last:
+                        # suffix range: last bytes of the file
+                        start = max(0, size - int(last))
+                except ValueError:
+                    start = size
+                if start >= size or start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % size)
+                    self.send_header("ETag", etag)
+                    if response.digest:
+                        self.send_header("Digest", "SHA-256=%s" % response.digest)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status = 206
+            length = end - start + 1
+            self.send_response(status)
+            self.send_header("Content-Type", response.content_type)
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            if response.digest:
+                self.send_header("Digest", "SHA-256=%s" % response.digest)
+            if status == 206:
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            self.end_headers()
+            self.wfile.flush()
+            if self.command != "HEAD":
+                sendfile(self.connection, fd, start, length)
+        finally:
+            fd.close()
+
+    def respond(self, results, params):
+        """Sends the answer to a request"""
+        body = ""
+        if results:
+            body = "%s %s" % (results, params)
         self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
 
-        if results:
-            self.wfile.write("%s %s" % (results, params))
+class FileResponse:
+    """File sent as the answer to a request, streamed from disk"""
+    def __init__(self, path, content_type=None, digest=None):
+        self.path = path
+        # base64 sha-256 of the file, when known
+        self.digest = digest
+        if not content_type:
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.content_type = content_type
+
+def load_sendfile():
+    """Returns the sendfile() system call of the C library, if there is one"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = getattr(libc, "sendfile64", None) or libc.sendfile
+        func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+        func.restype = ctypes.c_ssize_t
+        return func
+    except:
+        traceback.print_exc()
+        return None
+
+libc_sendfile = None
+if not hasattr(os, "sendfile"):
+    libc_sendfile = load_sendfile()
+
+def sendfile(sock, fd, offset, count):
+    """Sends count bytes of a file from offset, without copying them
+    through user space where the system supports it"""
+    if hasattr(os, "sendfile") or libc_sendfile:
+        if libc_sendfile:
+            import ctypes
+            position = ctypes.c_longlong(offset)
+        timeout = sock.gettimeout()
+        end = offset + count
+        while offset < end:
+            try:
+                if libc_sendfile:
+                    sent = libc_sendfile(sock.fileno(), fd.fileno(), ctypes.byref(position), min(end - offset, 0x7ffff000))
+                    if sent < 0:
+                        error = ctypes.get_errno()
+                        raise OSError(error, os.strerror(error))
+                else:
+                    sent = os.sendfile(sock.fileno(), fd.fileno(), offset, end - offset)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                # sockets with a timeout are non-blocking
+                readable, writable, failed = select.select([], [sock], [], timeout)
+                if not writable:
+                    raise socket.timeout("Timed out sending file")
+                continue
+            if sent == 0:
+                raise socket.error("File truncated while sending")
+            offset += sent
+    else:
+        fd.seek(offset)
+        while count > 0:
+            data = fd.read(min(count, 65536))
+            if not data:
+                raise socket.error("File truncated while sending")
+            sock.sendall(data)
+            count -= len(data)
 
 class HTTPListener(Thread):
-    def __init__(self, controller):
+    def __init__(self, controller, port=LISTENPORT, workers=HTTP_WORKERS):
         Thread.__init__(self)
         self.actions = Queue()
         self.messages = []
         self.lock = thread.allocate_lock()
 
-        self.socket = ReusableTCPServer(("", LISTENPORT), HTTPRequestHandler)
+        self.socket = PooledTCPServer(("", port), HTTPRequestHandler, workers)
         self.socket.set_controller(controller)
 
     def run(self):
         while 1:
             if not self.actions.empty():
                 print "Finishing server listening"
+                self.socket.quit()
                 return
-            self.socket.handle_request()
+            self.socket.serve()
+
+    def wake(self, client=None):
+        """Answers the deferred requests of a client, or all of them"""
+        self.socket.wake(client)
 # }}}
 
 # {{{ McastListener
+class ReceiveRing:
+    """Ring of preallocated buffers for receiving datagrams without
+    allocating a string for each of them. A received datagram remains valid
+    until size more datagrams are received."""
+    def __init__(self, size=RING_SIZE, buffer_size=DATAGRAM_SIZE + 1024):
+        self.views = [memoryview(bytearray(buffer_size)) for i in range(size)]
+        self.index = 0
+
+    def recv(self, sock):
+        """Receives a datagram, returns a memoryview of it and the sender"""
+        view = self.views[self.index]
+        self.index = (self.index + 1) % len(self.views)
+        size, addr = sock.recvfrom_into(view)
+        return view[:size], addr
+
 class McastListener(Thread):
     """Multicast listening thread"""
-    def __init__(self, addr=MCASTADDR, port=MCASTPORT):
+    def __init__(self, addr=MCASTADDR, port=MCASTPORT, source=None, receiver=None):
+        """Listens on a multicast group. When the source address is given,
+        only its packets are received, using source-specific membership
+        where supported. When a receiver is given, it is called from this
+        thread with each message and its sender, instead of queueing them
+        into messages. Messages are memoryviews of reused buffers, which
+        must be copied to be kept."""
         Thread.__init__(self)
         self.actions = Queue()
-        self.messages = Queue()
+        # (message, sender) pairs, popped with popleft(); bounded so queued
+        # messages are never overwritten by the ring
+        self.messages = collections.deque(maxlen=RING_SIZE - 1)
+        # oldest messages dropped because nobody popped them in time
+        self.dropped = 0
+        self.ring = ReceiveRing()
         self.addr = addr
         self.port = port
+        self.source = source
+        self.receiver = receiver
 
     def stop(self):
         """Stops the execution"""
         self.actions.put(1)
 
+    def add_membership(self, s):
+        """Joins the multicast group, returns the option to leave it and
+        the membership request"""
+        if self.source and sys.platform.startswith("linux"):
+            # struct ip_mreq_source: group, interface, source
+            mreq = struct.pack("4s4s4s", socket.inet_aton(self.addr),
+                    socket.inet_aton("0.0.0.0"), socket.inet_aton(self.source))
+            try:
+                s.setsockopt(socket.IPPROTO_IP, IP_ADD_SOURCE_MEMBERSHIP, mreq)
+                return IP_DROP_SOURCE_MEMBERSHIP, mreq
+            except:
+                traceback.print_exc()
+        mreq = struct.pack("4sl", socket.inet_aton(self.addr), socket.INADDR_ANY)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        return socket.IP_DROP_MEMBERSHIP, mreq
+
     def run(self):
         """Keep listening for multicasting messages"""
         # Configura o socket
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(('', self.port))
+        if sys.platform.startswith("linux"):
+            # only receive the groups joined by this socket, and not the
+            # ones joined by other sockets bound to the same port
+            s.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+            s.bind((self.addr, self.port))
+        else:
+            s.bind(('', self.port))
         # configura para multicast
-        mreq = struct.pack("4sl", socket.inet_aton(self.addr), socket.INADDR_ANY)
-        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        drop, mreq = self.add_membership(s)
         # configura timeout para 1 segundo
         s.settimeout(1)
         while 1:
             if not self.actions.empty():
                 print "Finishing multicast capture"
-                s.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, mreq)
+                s.setsockopt(socket.IPPROTO_IP, drop, mreq)
                 s.close()
                 return
             try:
-                data, client_addr = s.recvfrom(DATAGRAM_SIZE + 1024)
-                self.messages.put((data, client_addr[0]))
+                data, client_addr = self.ring.recv(s)
+                if self.receiver:
+                    self.receiver(data, client_addr[0])
+                else:
+                    if len(self.messages) == self.messages.maxlen:
+                        self.dropped += 1
+                    self.messages.append((data, client_addr[0]))
             except socket.timeout:
                 #print "Timeout!"
                 pass
@@ -262,22 +585,35 @@ class BcastListener(Thread):
 # {{{ TcpClient
 class TcpClient:
     """TCP Client"""
-    def __init__(self, addr, port, use_ssl=False):
-        """Initializes a TCP connection"""
+    def __init__(self, addr, port, use_ssl=False, ca_certs=None):
+        """Initializes a TCP connection. With ca_certs, the server
+        certificate is verified against these authorities."""
         self.addr = addr
         self.port = port
         self.use_ssl = use_ssl
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if use_ssl:
-            self.sock = ssl.wrap_socket(self.sock)
+            if ca_certs:
+                self.sock = ssl.wrap_socket(self.sock, cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_certs)
+            else:
+                self.sock = ssl.wrap_socket(self.sock)
+        # serializes frames sent from different threads
+        self.lock = thread.allocate_lock()
+        # parts received of the frame header or data, and the size of the
+        # frame once its header is complete
+        self.pending = []
+        self.pending_size = 0
+        self.frame_size = None
 
     def connect(self, timeout=None, retries=1):
         """Attempts to connect"""
         while retries > 0:
+            retries -= 1
             try:
-                self.sock.connect((self.addr, self.port))
                 if timeout:
-                    s.settimeout(timeout)
+                    self.sock.settimeout(timeout)
+                self.sock.connect((self.addr, self.port))
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 return True
             except:
                 traceback.print_exc()
@@ -285,62 +621,171 @@ class TcpClient:
         # Unable to establish a connection
         return False
 
+    def settimeout(self, timeout):
+        """Sets the timeout of blocking operations"""
+        self.sock.settimeout(timeout)
+
     def close(self, msg=None):
         """Closes a connection"""
-        if msg:
-            self.sock.send(msg)
-        self.sock.close()
+        try:
+            if msg:
+                self.send(msg)
+        finally:
+            self.sock.close()
 
     def send(self, msg):
         """Sends a message"""
-        self.sock.write(msg)
+        with self.lock:
+            self.sock.sendall(msg)
 
     def recv(self, msg_size):
         """Receives a message"""
         try:
-            data = self.sock.read(msg_size)
+            data = self.sock.recv(msg_size)
             return data
         except:
             traceback.print_exc()
             return None
+
+    def send_frame(self, data):
+        """Sends a length-prefixed frame"""
+        self.send(FRAME_HEADER.pack(len(data)) + data)
+
+    def recv_frame(self):
+        """Receives a length-prefixed frame, returns None when the
+        connection was closed. Raises socket.timeout on timeout, keeping
+        what was received of the frame for the next call."""
+        while True:
+            if self.frame_size is None:
+                needed = FRAME_HEADER.size - self.pending_size
+            else:
+                needed = self.frame_size - self.pending_size
+            if needed == 0:
+                data = "".join(self.pending)
+                self.pending = []
+                self.pending_size = 0
+                if self.frame_size is None:
+                    self.frame_size, = FRAME_HEADER.unpack(data)
+                    if self.frame_size > MAX_FRAME_SIZE:
+                        raise ValueError("Frame too large: %d bytes" % self.frame_size)
+                    continue
+                self.frame_size = None
+                return data
+            data = self.sock.recv(min(needed, 65536))
+            if not data:
+                return None
+            self.pending.append(data)
+            self.pending_size += len(data)
+
+def recv_exactly(sock, size):
+    """Receives exactly size bytes, or None when the connection is closed"""
+    data = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        data.append(chunk)
+        size -= len(chunk)
+    return "".join(data)
+
+def recv_frame(sock):
+    """Receives a length-prefixed frame, or None when the connection is
+    closed"""
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if not header:
+        return None
+    size, = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError("Frame too large: %d bytes" % size)
+    return recv_exactly(sock, size)
 # }}}
 
 # {{{ McastSender
+class TokenBucket:
+    """Token bucket rate limiter, counting bytes"""
+    def __init__(self, rate, burst):
+        """Rate is in bytes per second, burst is the bucket size in bytes"""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = system.timefunc()
+
+    def delay(self, size):
+        """Takes size bytes from the bucket, returns how long to wait
+        before sending them"""
+        if not self.rate:
+            return 0
+        now = system.timefunc()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
 class McastSender(Thread):
     """Multicast socket for sending stuff"""
-    def __init__(self, logger, interval=0.05):
-        """Configures multicast sender. Interval is the minimum interval between packets"""
+    def __init__(self, logger, interval=0, rate=0, burst=DATAGRAM_SIZE, addr=MCASTADDR, port=MCASTPORT):
+        """Configures multicast sender. Interval is the minimum interval
+        between packets, rate the maximum sending rate in bytes per second
+        (0 for unlimited) and burst the number of bytes which can be sent
+        at once. Addr and port are the multicast group, which can be
+        changed before the thread starts."""
         Thread.__init__(self)
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_IP)
         s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.queue = Queue()
         self.socket = s
+        self.addr = addr
+        self.port = port
         self.interval = interval
+        # a packet bigger than the bucket would never be sent
+        self.bucket = TokenBucket(rate, max(burst, DATAGRAM_SIZE))
         self.logger = logger
+        # achieved sending rate, in bytes per second
+        self.sent_rate = 0.0
+        self.sent_bytes = 0
+        self.sent_since = system.timefunc()
 
-    def send(self, data, addr=MCASTADDR, port=MCASTPORT):
+    def send(self, data, addr=None, port=None):
         """Sends stuff via multicast"""
-        self.socket.sendto(bytes(data), (addr, port))
+        self.socket.sendto(bytes(data), (addr or self.addr, port or self.port))
+
+    def get_rate(self):
+        """Returns the achieved sending rate, in bytes per second"""
+        return self.sent_rate
+
+    def account(self, size):
+        """Updates the achieved sending rate"""
+        self.sent_bytes += size
+        now = system.timefunc()
+        elapsed = now - self.sent_since
+        if elapsed >= 1.0:
+            self.sent_rate = self.sent_bytes / elapsed
+            self.sent_bytes = 0
+            self.sent_since = now
 
     def run(self):
         """Runs the thread, waiting for instructions via queue interface"""
         lasttime = system.timefunc()
-        curtime = lasttime
         while 1:
             command, payload = self.queue.get()
             if command == "quit":
                 return
             elif command == "send":
-                curtime = system.timefunc()
-                curdelay = curtime - lasttime
+                delay = self.bucket.delay(len(payload))
+                curdelay = system.timefunc() - lasttime
                 if curdelay < self.interval:
-                    delay = self.interval - curdelay
-                    self.logger.debug("Sending too fast, sleeping for %f" % curdelay)
-                    time.sleep(curdelay)
+                    delay = max(delay, self.interval - curdelay)
+                if delay > 0:
+                    if DEBUG:
+                        self.logger.debug("Sending too fast, sleeping for %f" % delay)
+                    time.sleep(delay)
                 # do the sending
                 self.send(payload)
-                lasttime = curtime
+                lasttime = system.timefunc()
+                self.account(len(payload))
 
     def put(self, payload):
         """Queues a packet for multicast sending"""
@@ -351,6 +796,263 @@ class McastSender(Thread):
         self.queue.put(("quit", None))
 # }}}
 
+# {{{ McastFileSender
+def load_sendmsg():
+    """Returns the sendmsg() system call of the C library and the iovec and
+    msghdr structures it takes, if there is one"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        class iovec(ctypes.Structure):
+            # takes both strings and addresses
+            _fields_ = [("iov_base", ctypes.c_char_p), ("iov_len", ctypes.c_size_t)]
+        class msghdr(ctypes.Structure):
+            _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                    ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                    ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                    ("msg_flags", ctypes.c_int)]
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.sendmsg
+        func.argtypes = [ctypes.c_int, ctypes.POINTER(msghdr), ctypes.c_int]
+        func.restype = ctypes.c_ssize_t
+        return func, iovec, msghdr
+    except:
+        traceback.print_exc()
+        return None
+
+libc_sendmsg = load_sendmsg()
+# smallest chunk worth calling sendmsg() through ctypes for, smaller ones are
+# copied faster than the call is made
+SENDMSG_MIN_SIZE=32768
+
+class ChunkSender:
+    """Sends the chunks of memory mapped files to an address. Where the C
+    library allows it, the header and the mapped pages of large chunks are
+    handed to sendmsg() as they are, so their data is only copied by the
+    kernel. Other chunks are joined into a datagram first."""
+    def __init__(self, sock, addr, port, min_size=SENDMSG_MIN_SIZE):
+        self.sock = sock
+        self.addr = (addr, port)
+        self.min_size = min_size
+        self.msg = None
+        if not libc_sendmsg:
+            return
+        import ctypes
+        func, iovec, msghdr = libc_sendmsg
+        try:
+            # struct sockaddr_in
+            name = struct.pack("=H", socket.AF_INET) + struct.pack("!H", port) + socket.inet_aton(addr) + "\0" * 8
+        except socket.error:
+            # not a numeric address
+            return
+        self.name = ctypes.create_string_buffer(name, len(name))
+        self.iov = (iovec * 2)()
+        # kept, as making them again costs as much as copying small chunks
+        self.header_iov = self.iov[0]
+        self.data_iov = self.iov[1]
+        self.msg = msghdr()
+        self.msg.msg_name = ctypes.addressof(self.name)
+        self.msg.msg_namelen = len(name)
+        self.msg.msg_iov = self.iov
+        self.msg.msg_iovlen = 2
+        self.msg_ref = ctypes.byref(self.msg)
+        self.call = func
+
+    def send(self, encoder, header, start, length):
+        """Sends a chunk header followed by length bytes of a file from start"""
+        if self.msg is None or encoder.address is None or length < self.min_size:
+            return self.sock.sendto(header + encoder.map[start:start + length], self.addr)
+        self.header_iov.iov_base = header
+        self.header_iov.iov_len = len(header)
+        self.data_iov.iov_base = encoder.address + start
+        self.data_iov.iov_len = length
+        sent = self.call(self.sock.fileno(), self.msg_ref, 0)
+        if sent < 0:
+            import ctypes
+            error = ctypes.get_errno()
+            raise socket.error(error, os.strerror(error))
+        return sent
+
+class FileStream:
+    """A file being sent over multicast"""
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.num_chunks = encoder.get_num_chunks()
+        # next chunk of the first pass
+        self.position = 0
+        # chunks to send again, in the order they were asked
+        self.repairs = collections.deque()
+        self.pending = set()
+        # chunk id -> time it was last sent again
+        self.repaired = {}
+        self.last_active = system.timefunc()
+        # time of the last report of missing chunks
+        self.last_report = 0
+
+    def has_work(self):
+        """Checks if there are chunks waiting to be sent"""
+        return self.repairs or self.position < self.num_chunks
+
+class McastFileSender(Thread):
+    """Sends files to the class over multicast. Each file is sent once, then
+    the chunks reported missing by students are sent again, merging the
+    reports of different students, so the teacher uplink does not grow with
+    the size of the class."""
+    def __init__(self, logger, rate=0, burst=DATAGRAM_SIZE, addr=MCASTADDR, port=MCASTPORT + FILEPORT_OFFSET,
+            holdoff=1.0, expire=600, repair_timeout=5.0):
+        """Rate is the maximum sending rate in bytes per second, shared by
+        all files. Reports for a chunk sent again less than holdoff seconds
+        ago are ignored, chunks queued for repair are dropped when no report
+        came for repair_timeout seconds, and files are forgotten expire
+        seconds after their last report."""
+        Thread.__init__(self)
+        self.setDaemon(True)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_IP)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket = s
+        self.logger = logger
+        self.addr = addr
+        self.port = port
+        self.sender = ChunkSender(s, addr, port)
+        self.bucket = TokenBucket(rate, max(burst, DATAGRAM_SIZE))
+        self.holdoff = holdoff
+        self.expire = expire
+        self.repair_timeout = repair_timeout
+        self.lock = threading.Condition()
+        # key -> FileStream
+        self.streams = {}
+        # stream served first, rotated so that files are sent together
+        self.turn = 0
+        self.quitting = False
+        # bytes sent, for all files
+        self.sent_bytes = 0
+        self.repaired_chunks = 0
+
+    def add(self, key, encoder):
+        """Starts sending a file, prepared by a streamer encoder"""
+        with self.lock:
+            self.streams[key] = FileStream(encoder)
+            self.lock.notify()
+
+    def drop(self, stream):
+        """Stops sending a file"""
+        with self.lock:
+            for key, value in self.streams.items():
+                if value is stream:
+                    del self.streams[key]
+        stream.encoder.finish()
+
+    def has_stream(self, key):
+        """Checks if a file is being sent"""
+        with self.lock:
+            return key in self.streams
+
+    def nack(self, key, ranges, max_repairs=4096):
+        """Queues the chunks of a file reported missing, given as a list of
+        (first, last) ranges, with None as last up to the end of the file,
+        which is only honoured once the file was sent entirely. Returns the
+        number of chunks queued."""
+        now = system.timefunc()
+        queued = 0
+        with self.lock:
+            stream = self.streams.get(key)
+            if not stream:
+                return 0
+            stream.last_active = now
+            stream.last_report = now
+            for first, last in ranges:
+                if last is None:
+                    if stream.position < stream.num_chunks:
+                        # the rest is still coming, and the student will
+                        # report what it missed once it knows the file size
+                        continue
+                    last = stream.num_chunks - 1
+                for pos in xrange(max(0, first), min(last + 1, stream.num_chunks)):
+                    if queued >= max_repairs:
+                        break
+                    if pos >= stream.position or pos in stream.pending:
+                        # not sent yet, or already queued
+                        continue
+                    if now - stream.repaired.get(pos, 0) < self.holdoff:
+                        continue
+                    stream.repairs.append(pos)
+                    stream.pending.add(pos)
+                    queued += 1
+            if queued:
+                self.lock.notify()
+        return queued
+
+    def next_chunk(self):
+        """Waits for a chunk to send, returns its stream and id"""
+        with self.lock:
+            while not self.quitting:
+                now = system.timefunc()
+                for key, stream in self.streams.items():
+                    if not stream.has_work() and now - stream.last_active > self.expire:
+                        stream.encoder.finish()
+                        del self.streams[key]
+                streams = self.streams.values()
+                if streams:
+                    self.turn = (self.turn + 1) % len(streams)
+                    streams = streams[self.turn:] + streams[:self.turn]
+                # repairs first, as students are waiting for them
+                for stream in streams:
+                    if stream.repairs and now - stream.last_report > self.repair_timeout:
+                        # nobody is asking for them anymore
+                        stream.repairs.clear()
+                        stream.pending.clear()
+                    if stream.repairs:
+                        pos = stream.repairs.popleft()
+                        stream.pending.discard(pos)
+                        stream.repaired[pos] = now
+                        self.repaired_chunks += 1
+                        return stream, pos
+                for stream in streams:
+                    if stream.position < stream.num_chunks:
+                        stream.position += 1
+                        stream.last_active = now
+                        return stream, stream.position - 1
+                for stream in streams:
+                    for pos, when in stream.repaired.items():
+                        if now - when > self.holdoff:
+                            del stream.repaired[pos]
+                self.lock.wait(1)
+        return None, None
+
+    def run(self):
+        """Sends the chunks of the files"""
+        while True:
+            stream, pos = self.next_chunk()
+            if stream is None:
+                break
+            try:
+                header, start, length = stream.encoder.get_chunk_range(pos)
+                size = len(header) + length
+                delay = self.bucket.delay(size)
+                if delay > 0:
+                    time.sleep(delay)
+                self.sender.send(stream.encoder, header, start, length)
+                self.sent_bytes += size
+            except streamer.FileChanged:
+                self.logger.warning("Stopped sending a file: %s" % sys.exc_value)
+                self.drop(stream)
+            except:
+                self.logger.exception("Sending chunk %d of a file" % pos)
+        with self.lock:
+            for stream in self.streams.values():
+                stream.encoder.finish()
+            self.streams = {}
+
+    def quit(self):
+        """Tells thread to leave"""
+        with self.lock:
+            self.quitting = True
+            self.lock.notify()
+# }}}
+
 class ReusableForkingTCPServer(SocketServer.ForkingTCPServer):
     allow_reuse_address = True
 
@@ -365,6 +1067,337 @@ class ReusableTCPServer(SocketServer.TCPServer):
         """Sets a fallback countroller"""
         self.controller = controller
 
+class PooledTCPServer(ReusableTCPServer):
+    """Server handling requests on a bounded pool of threads. Idle
+    persistent connections do not hold a thread: they are watched for the
+    next request together with the listening socket."""
+    request_queue_size = 128
+
+    def __init__(self, addr, handler, workers=HTTP_WORKERS, idle_timeout=HTTP_IDLE_TIMEOUT):
+        ReusableTCPServer.__init__(self, addr, handler)
+        self.idle_timeout = idle_timeout
+        # (connection, client address, handler or None for new connections)
+        self.requests = ThreadQueue()
+        # idle connection -> (handler, time it became idle)
+        self.idle = {}
+        self.idle_lock = thread.allocate_lock()
+        # deferred request handler -> (client, deadline)
+        self.deferred = {}
+        # client -> time of last wake up, None for all clients
+        self.woken = {}
+        # files waiting to be sent, as (handler, response), and the threads
+        # sending them, up to MAX_TRANSFERS, started when none is idle
+        self.transfers = ThreadQueue()
+        self.senders = []
+        self.idle_senders = 0
+        self.senders_lock = thread.allocate_lock()
+        # datagram socket sending to itself, to interrupt select() when a
+        # connection becomes idle
+        self.wakeup = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.wakeup.bind(("127.0.0.1", 0))
+        self.workers = []
+        for i in range(workers):
+            worker = Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def serve(self):
+        """Waits up to one second for new connections or requests on idle
+        connections, and queues them for the workers"""
+        with self.idle_lock:
+            idle = self.idle.keys()
+            deadlines = [deadline for client, deadline in self.deferred.values()]
+        timeout = 1.0
+        if deadlines:
+            timeout = max(0, min(timeout, min(deadlines) - time.time()))
+        try:
+            readable, writable, failed = select.select([self.socket, self.wakeup] + idle, [], [], timeout)
+        except select.error:
+            # an idle connection was closed meanwhile
+            readable = []
+        for sock in readable:
+            if sock is self.socket:
+                try:
+                    request, client_address = self.get_request()
+                except socket.error:
+                    continue
+                self.requests.put((request, client_address, None))
+            elif sock is self.wakeup:
+                self.wakeup.recv(64)
+            else:
+                with self.idle_lock:
+                    handler, since = self.idle.pop(sock, (None, None))
+                if handler:
+                    self.requests.put((sock, handler.client_address, handler))
+        now = time.time()
+        with self.idle_lock:
+            expired = [sock for sock, (handler, since) in self.idle.items() if now - since > self.idle_timeout]
+            expired = [self.idle.pop(sock)[0] for sock in expired]
+            expired_deferred = [handler for handler, (client, deadline) in self.deferred.items() if deadline <= now]
+            for handler in expired_deferred:
+                del self.deferred[handler]
+        for handler in expired:
+            handler.close()
+        for handler in expired_deferred:
+            self.requests.put((handler.request, handler.client_address, handler))
+
+    def transfer(self, handler, response):
+        """Queues a file for the sender threads, as it may take long"""
+        with self.senders_lock:
+            if self.idle_senders:
+                self.idle_senders -= 1
+            elif len(self.senders) < MAX_TRANSFERS:
+                sender = Thread(target=self.send_files)
+                sender.setDaemon(True)
+                sender.start()
+                self.senders.append(sender)
+        self.transfers.put((handler, response))
+
+    def send_files(self):
+        """Sends queued files"""
+        while True:
+            handler, response = self.transfers.get()
+            if handler is None:
+                return
+            self.send_file(handler, response)
+            with self.senders_lock:
+                self.idle_senders += 1
+
+    def send_file(self, handler, response):
+        """Sends a file, then hands the connection back to the server"""
+        try:
+            handler.transferring = None
+            handler.send_file(response)
+            handler.finish()
+        except:
+            self.handle_error(handler.request, handler.client_address)
+            self.shutdown_request(handler.request)
+
+    def defer(self, handler, client, timeout, since):
+        """Keeps a request to be answered when woken up or on timeout.
+        Since is the time the request was processed, so a wake up happening
+        meanwhile is not missed."""
+        with self.idle_lock:
+            woken = max(self.woken.get(client, 0), self.woken.get(None, 0))
+            if woken < since:
+                self.deferred[handler] = (client, time.time() + timeout)
+        if woken >= since:
+            self.requests.put((handler.request, handler.client_address, handler))
+        else:
+            self.wakeup.sendto("w", self.wakeup.getsockname())
+
+    def wake(self, client=None):
+        """Answers the deferred requests of a client, or all of them"""
+        with self.idle_lock:
+            now = time.time()
+            if client is None:
+                self.woken = {}
+            self.woken[client] = now
+            handlers = [handler for handler, (deferred_client, deadline) in self.deferred.items()
+                    if client is None or deferred_client == client]
+            for handler in handlers:
+                del self.deferred[handler]
+        for handler in handlers:
+            self.requests.put((handler.request, handler.client_address, handler))
+
+    def park(self, handler):
+        """Keeps an idle keep-alive connection until its next request"""
+        with self.idle_lock:
+            self.idle[handler.request] = (handler, time.time())
+        self.wakeup.sendto("w", self.wakeup.getsockname())
+
+    def work(self):
+        """Serves queued requests"""
+        while True:
+            request, client_address, handler = self.requests.get()
+            if request is None:
+                return
+            try:
+                if handler and handler.deferred:
+                    handler.resume()
+                    handler.finish()
+                elif handler:
+                    handler.handle()
+                    handler.finish()
+                else:
+                    self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+    def quit(self):
+        """Stops the workers and closes all connections"""
+        for worker in self.workers:
+            self.requests.put((None, None, None))
+        with self.senders_lock:
+            for sender in self.senders:
+                self.transfers.put((None, None))
+        with self.idle_lock:
+            idle = [handler for handler, since in self.idle.values()] + self.deferred.keys()
+            self.idle = {}
+            self.deferred = {}
+        for handler in idle:
+            handler.close()
+        self.server_close()
+
+# {{{ ControlListener
+class ControlRequestHandler(SocketServer.BaseRequestHandler):
+    """Handles control channel frames. Each call to handle() serves one
+    frame, and the connection is then handed back to the server until the
+    next one arrives."""
+    timeout = HTTP_TIMEOUT
+    closed = False
+    deferred = None
+
+    def setup(self):
+        """Configures the connection"""
+        self.request.settimeout(self.timeout)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = thread.allocate_lock()
+        self.client = None
+
+    def handle(self):
+        """Handles frames available on the connection"""
+        while True:
+            self.handle_frame()
+            # tls may have more frames already decrypted, which select()
+            # would not see
+            if self.closed or not hasattr(self.request, "pending") or not self.request.pending():
+                return
+
+    def handle_frame(self):
+        """Handles a single frame"""
+        try:
+            data = recv_frame(self.request)
+        except:
+            data = None
+        if not data:
+            self.closed = True
+            return
+        frame = self.server.protocol.unpack_control(data)
+        if not frame:
+            self.closed = True
+            return
+        frame_type, request_id, path, params = frame
+        if frame_type != protocol.CONTROL_REQUEST:
+            return
+        client = self.client_address[0]
+        # Support additional client identifiers, like for HTTP requests
+        if "client_id" in params:
+            client = "%s%s" % (client, params["client_id"][0])
+        if client != self.client:
+            self.client = client
+            self.server.register(client, self)
+        results, params = self.server.controller.process_request(client, path, params)
+        if results == DEFER or isinstance(results, FileResponse):
+            # actions are pushed, no need to wait for them, and files are
+            # downloaded over http
+            results, params = None, None
+        if params is not None:
+            params = {"params": params}
+        self.send(protocol.CONTROL_RESPONSE, request_id, results, params)
+
+    def send(self, frame_type, request_id, name, params=None):
+        """Sends a frame, from any thread"""
+        data = self.server.protocol.pack_control(frame_type, request_id, name, params)
+        with self.lock:
+            self.request.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+    def push(self, action, params=None):
+        """Pushes an action to the client, returns False on failure"""
+        if params is not None:
+            params = {"params": params}
+        try:
+            self.send(protocol.CONTROL_PUSH, 0, action, params)
+            return True
+        except:
+            return False
+
+    def finish(self):
+        """Closes the connection, or keeps it for the next frame"""
+        if self.closed:
+            self.close()
+        else:
+            self.server.park(self)
+
+    def close(self):
+        """Closes the connection"""
+        if self.client:
+            self.server.unregister(self.client, self)
+        self.server.shutdown_request(self.request)
+
+class ControlServer(PooledTCPServer):
+    """Control channel server, optionally over tls"""
+    def __init__(self, addr, logger, workers=HTTP_WORKERS, certfile=None):
+        self.protocol = protocol.Protocol(logger)
+        self.certfile = certfile
+        # client -> request handler of its connection
+        self.clients = {}
+        self.clients_lock = thread.allocate_lock()
+        PooledTCPServer.__init__(self, addr, ControlRequestHandler, workers)
+
+    def get_request(self):
+        """Accepts a connection, with a tls handshake when enabled"""
+        request, client_address = self.socket.accept()
+        if self.certfile:
+            request = ssl.wrap_socket(request, server_side=True, certfile=self.certfile,
+                    do_handshake_on_connect=False)
+        return request, client_address
+
+    def register(self, client, handler):
+        """Associates a client to its connection"""
+        with self.clients_lock:
+            self.clients[client] = handler
+
+    def unregister(self, client, handler):
+        """Forgets the connection of a client"""
+        with self.clients_lock:
+            if self.clients.get(client) is handler:
+                del self.clients[client]
+
+    def push(self, client, action, params=None):
+        """Pushes an action to a client, returns False when the client has
+        no control connection"""
+        with self.clients_lock:
+            handler = self.clients.get(client)
+        if not handler:
+            return False
+        return handler.push(action, params)
+
+    def push_all(self, action, params=None):
+        """Pushes an action to all connected clients"""
+        with self.clients_lock:
+            handlers = self.clients.values()
+        for handler in handlers:
+            handler.push(action, params)
+
+class ControlListener(Thread):
+    """Control channel listening thread"""
+    def __init__(self, controller, logger, port=CONTROLPORT, workers=HTTP_WORKERS, certfile=None):
+        Thread.__init__(self)
+        self.actions = Queue()
+        self.socket = ControlServer(("", port), logger, workers, certfile)
+        self.socket.set_controller(controller)
+
+    def run(self):
+        while 1:
+            if not self.actions.empty():
+                print "Finishing control channel"
+                self.socket.quit()
+                return
+            self.socket.serve()
+
+    def push(self, client, action, params=None):
+        """Pushes an action to a client, returns False when the client has
+        no control connection"""
+        return self.socket.push(client, action, params)
+
+    def push_all(self, action, params=None):
+        """Pushes an action to all connected clients"""
+        self.socket.push_all(action, params)
+# }}}
+
 class ReusableSocketServer(SocketServer.TCPServer):
     allow_reuse_address = True
 
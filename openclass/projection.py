@@ -0,0 +1,422 @@
+#!/usr/bin/python
+"""Screen projection streaming module
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+"""
+
+import thread
+import threading
+import time
+from collections import OrderedDict
+
+import system
+import protocol
+
+# projection quality levels, from best to worst:
+# jpeg quality, scale factor, frame interval multiplier
+QUALITY_LEVELS = [
+        (75, 1.0, 1.0),
+        (60, 1.0, 1.0),
+        (50, 1.0, 1.5),
+        (40, 0.75, 1.5),
+        (30, 0.75, 2.0),
+        (25, 0.5, 2.0),
+        ]
+
+class QualityController:
+    """Adjusts projection quality, size and frame rate to keep the sending
+    rate and the loss rate reported by students below their targets, and
+    brings the quality back when the network clears."""
+    def __init__(self, logger, target_rate, max_loss, period=2.0, levels=QUALITY_LEVELS):
+        self.logger = logger
+        # bytes per second
+        self.target_rate = target_rate
+        # fraction of tiles lost
+        self.max_loss = max_loss
+        self.period = period
+        self.levels = levels
+        self.level = 0
+        # periods in a row with a clear network
+        self.good_periods = 0
+        # periods to wait after going down before trying to go up
+        self.hold = 0
+        self.lock = thread.allocate_lock()
+        self.last_update = system.timefunc()
+        self.losses = []
+        self.raw_losses = []
+        # median loss rate of the last period, after forward error correction
+        self.loss = 0.0
+        # median loss rate of the last period before forward error
+        # correction, which sizes the parity groups
+        self.raw_loss = 0.0
+
+    def get_settings(self):
+        """Returns current jpeg quality, scale factor and interval multiplier"""
+        return self.levels[self.level]
+
+    def report(self, client, received, missing, rebuilt=0):
+        """Accounts for a student report of the tiles received and missed
+        since its previous report, and of the received tiles which were
+        rebuilt from parity packets"""
+        if received + missing == 0:
+            return
+        with self.lock:
+            self.losses.append(missing * 1.0 / (received + missing))
+            self.raw_losses.append((missing + rebuilt) * 1.0 / (received + missing))
+
+    def update(self, rate):
+        """Re-evaluates the quality level, given the rate achieved by the
+        multicast sender in bytes per second. Returns True when it changed."""
+        now = system.timefunc()
+        elapsed = now - self.last_update
+        if elapsed < self.period:
+            return False
+        with self.lock:
+            losses = sorted(self.losses)
+            raw_losses = sorted(self.raw_losses)
+            self.losses = []
+            self.raw_losses = []
+        self.last_update = now
+        loss = 0.0
+        if losses:
+            loss = losses[len(losses) / 2]
+        self.loss = loss
+        if raw_losses:
+            self.raw_loss = raw_losses[len(raw_losses) / 2]
+        else:
+            self.raw_loss = 0.0
+        level = self.level
+        if loss > self.max_loss or rate > self.target_rate:
+            self.good_periods = 0
+            self.hold = 2
+            if self.level < len(self.levels) - 1:
+                self.level += 1
+        elif loss < self.max_loss / 2 and rate < self.target_rate * 0.8:
+            if self.hold > 0:
+                self.hold -= 1
+            else:
+                self.good_periods += 1
+                if self.good_periods >= 3 and self.level > 0:
+                    self.level -= 1
+                    self.good_periods = 0
+        else:
+            self.good_periods = 0
+        if level != self.level:
+            self.logger.info("Projection quality level %d (rate %d bytes/s, loss %.2f)" % (self.level, rate, loss))
+            return True
+        return False
+
+class TileMap:
+    """Newest frame id drawn over each cell of a fixed grid, to compare
+    tiles by the area they cover rather than by their exact geometry, which
+    changes with the changed areas of each frame. A tile covers the cells
+    whose center lies inside it, so tiles side by side never share a cell."""
+    # size of the cells, in pixels
+    CELL = 16
+
+    def __init__(self):
+        # rows of frame ids, -1 where nothing was drawn
+        self.rows = []
+
+    def cells(self, rect):
+        """Returns the range of cells covered by a rectangle, as the first
+        and last + 1 columns and rows"""
+        pos_x, pos_y, width, height = rect
+        half = self.CELL / 2
+        # first cells whose center is past a coordinate
+        first = lambda pos: -((half - pos) / self.CELL)
+        return first(pos_x), first(pos_y), first(pos_x + width), first(pos_y + height)
+
+    def is_covered(self, rect, frame_id):
+        """Returns True if frames newer than frame_id were drawn over all
+        the area of a rectangle"""
+        x0, y0, x1, y1 = self.cells(rect)
+        if x0 >= x1 or y0 >= y1 or y1 > len(self.rows):
+            return False
+        newest = None
+        for row in self.rows[y0:y1]:
+            if len(row) < x1:
+                return False
+            oldest = min(row[x0:x1])
+            if newest is None or oldest < newest:
+                newest = oldest
+        return frame_id < newest < frame_id + protocol.FRAME_RESTART
+
+    def mark(self, rect, frame_id, keep_newer=False):
+        """Records that frame_id was drawn over a rectangle, except over the
+        cells of newer frames when keep_newer is set"""
+        x0, y0, x1, y1 = self.cells(rect)
+        if x0 >= x1 or y0 >= y1:
+            return
+        while len(self.rows) < y1:
+            self.rows.append([])
+        for row in self.rows[y0:y1]:
+            if len(row) < x1:
+                row.extend([-1] * (x1 - len(row)))
+            if keep_newer:
+                row[x0:x1] = [drawn if frame_id < drawn < frame_id + protocol.FRAME_RESTART else frame_id
+                        for drawn in row[x0:x1]]
+            else:
+                row[x0:x1] = [frame_id] * (x1 - x0)
+
+class ReceiveStats:
+    """Tracks projection frames on the student side: discards tiles
+    superseded by newer ones and computes loss and latency statistics"""
+    # frames kept open for late tiles before counting their losses
+    WINDOW = 2
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets everything known about the stream"""
+        # frame id -> [tiles in frame, received sequence numbers, whether a
+        # tile of the frame was received]
+        self.frames = {}
+        self.newest = -1
+        # tiles in the newest frame, to estimate the size of lost frames
+        self.last_tiles = 0
+        # frames of which no tile was received
+        self.lost_frames = 0
+        # newest frame accepted over each area
+        self.positions = TileMap()
+        self.received = 0
+        self.missing = 0
+        # received tiles rebuilt from parity packets
+        self.rebuilt = 0
+        self.stale = 0
+        # frame id -> missed sequence numbers, to ask for repair
+        self.nacks = {}
+        # smallest one-way delay seen, as clocks are not synchronized
+        self.min_delay = None
+        self.latency = 0.0
+
+    def put(self, frame_id, seq, tiles, timestamp, position, rebuilt=False):
+        """Accounts for a received tile, returns False if it should be
+        discarded, because it is a duplicate or a newer tile was already
+        drawn at its position. Rebuilt tells whether the tile was rebuilt
+        from a parity packet rather than received."""
+        with self.lock:
+            return self.put_locked(frame_id, seq, tiles, timestamp, position, rebuilt)
+
+    def put_locked(self, frame_id, seq, tiles, timestamp, position, rebuilt):
+        """Accounts for a received tile, with the lock held"""
+        if frame_id + protocol.FRAME_RESTART < self.newest:
+            self.reset()
+        delay = (int(time.time() * 1000) - timestamp) & 0xffffffff
+        if delay > 0x7fffffff:
+            delay -= 0x100000000
+        if self.min_delay is None or delay < self.min_delay:
+            self.min_delay = delay
+        self.latency += ((delay - self.min_delay) - self.latency) / 8.0
+        if frame_id > self.newest:
+            if self.newest >= 0:
+                self.skip_frames(frame_id)
+            self.newest = frame_id
+            self.close_frames()
+        self.last_tiles = tiles
+        if frame_id not in self.frames and frame_id > self.newest - self.WINDOW:
+            self.frames[frame_id] = [tiles, set(), True]
+        if frame_id in self.frames:
+            frame = self.frames[frame_id]
+            frame[0] = tiles
+            frame[2] = True
+            received = frame[1]
+            if seq in received:
+                return False
+            received.add(seq)
+            self.received += 1
+            if rebuilt:
+                self.rebuilt += 1
+        # else this is a late tile, or a repair of a tile already counted as
+        # lost, which is still worth drawing if nothing newer was drawn there
+        if self.positions.is_covered(position, frame_id):
+            self.stale += 1
+            return False
+        self.positions.mark(position, frame_id)
+        return True
+
+    def skip_frames(self, frame_id):
+        """Accounts for the frames between the newest one and frame_id, of
+        which nothing was received yet. Those out of the receive window are
+        lost, the others may still arrive late."""
+        first_open = max(self.newest + 1, frame_id - self.WINDOW + 1)
+        skipped = first_open - (self.newest + 1)
+        self.lost_frames += skipped
+        self.missing += skipped * self.last_tiles
+        for missed in range(first_open, frame_id):
+            self.frames[missed] = [self.last_tiles, set(), False]
+
+    def close_frames(self):
+        """Counts the losses of frames out of the receive window"""
+        for frame_id in self.frames.keys():
+            if frame_id <= self.newest - self.WINDOW:
+                tiles, received, seen = self.frames.pop(frame_id)
+                if not seen:
+                    # the tile count is a guess, nothing to ask for
+                    self.lost_frames += 1
+                    self.missing += tiles
+                elif len(received) < tiles:
+                    self.missing += tiles - len(received)
+                    self.nacks[frame_id] = [seq for seq in range(tiles) if seq not in received]
+
+    def get_nacks(self):
+        """Returns the tiles missed since the previous call, as a dict
+        mapping frame ids to lists of sequence numbers, newest frames first
+        up to the protocol.MAX_NACK_SEQS the teacher accepts"""
+        with self.lock:
+            missed = self.nacks
+            self.nacks = {}
+        nacks = {}
+        left = protocol.MAX_NACK_SEQS
+        for frame_id in sorted(missed.keys(), reverse=True):
+            if left <= 0:
+                break
+            nacks[frame_id] = missed[frame_id][:left]
+            left -= len(nacks[frame_id])
+        return nacks
+
+    def get_report(self):
+        """Returns tiles received and missed since the previous report, the
+        received ones which were rebuilt from parity packets, the frames
+        entirely missed and the current relative latency in ms"""
+        with self.lock:
+            received = self.received
+            missing = self.missing
+            rebuilt = self.rebuilt
+            lost_frames = self.lost_frames
+            self.received = 0
+            self.missing = 0
+            self.rebuilt = 0
+            self.lost_frames = 0
+        return received, missing, rebuilt, lost_frames, int(self.latency)
+
+class TileBuffer:
+    """Bounded buffer of received tiles waiting to be drawn, skipping the
+    tiles whose area was entirely covered by newer ones, so a slow student
+    does not fall behind drawing tiles which were overwritten"""
+    def __init__(self, max_tiles=1024):
+        self.max_tiles = max_tiles
+        self.lock = threading.Condition()
+        # position -> (frame id, tile), oldest first
+        self.tiles = OrderedDict()
+        # newest frame queued over each area
+        self.coverage = TileMap()
+        # tiles replaced or covered by newer ones
+        self.superseded = 0
+        # tiles older than the one waiting at the same position
+        self.stale = 0
+        # tiles dropped because the buffer was full
+        self.overflow = 0
+
+    def put(self, position, frame_id, tile):
+        """Queues a tile for drawing"""
+        with self.lock:
+            if position in self.tiles:
+                if self.tiles[position][0] > frame_id:
+                    self.stale += 1
+                    return
+                del self.tiles[position]
+                self.superseded += 1
+            elif len(self.tiles) >= self.max_tiles:
+                self.tiles.popitem(last=False)
+                self.overflow += 1
+            self.tiles[position] = (frame_id, tile)
+            self.coverage.mark(position, frame_id, keep_newer=True)
+            self.lock.notify()
+
+    def get(self, timeout=None):
+        """Waits for a tile, returns the oldest one or None on timeout"""
+        with self.lock:
+            if not self.tiles:
+                self.lock.wait(timeout)
+            while self.tiles:
+                position, (frame_id, tile) = self.tiles.popitem(last=False)
+                if not self.coverage.is_covered(position, frame_id):
+                    return tile
+                self.superseded += 1
+        return None
+
+    def get_all(self):
+        """Returns the waiting tiles, oldest first, and empties the buffer"""
+        with self.lock:
+            tiles = []
+            for position, (frame_id, tile) in self.tiles.iteritems():
+                if self.coverage.is_covered(position, frame_id):
+                    self.superseded += 1
+                else:
+                    tiles.append(tile)
+            self.tiles.clear()
+        return tiles
+
+    def get_dropped(self):
+        """Returns the number of tiles dropped without being drawn"""
+        return self.superseded + self.stale + self.overflow
+
+class RepairBuffer:
+    """Keeps the recently sent projection chunks, to send again the ones
+    students report as missing. Reports for the same chunk are merged, so a
+    chunk lost by the whole class is only sent once."""
+    def __init__(self, frames=8, holdoff=1.0, max_repairs=64):
+        # number of frames kept
+        self.frames = frames
+        # time during which repeated reports for a chunk are ignored
+        self.holdoff = holdoff
+        # maximum chunks sent again per report
+        self.max_repairs = max_repairs
+        self.lock = thread.allocate_lock()
+        # frame id -> {sequence number: packet}
+        self.packets = {}
+        # (frame id, sequence number) -> time of last repair
+        self.repaired = {}
+        self.requested = 0
+        self.suppressed = 0
+        self.sent = 0
+
+    def store(self, frame_id, packets):
+        """Keeps the packets of a frame, indexed by sequence number"""
+        with self.lock:
+            self.packets[frame_id] = dict(enumerate(packets))
+            for old in self.packets.keys():
+                if old <= frame_id - self.frames:
+                    del self.packets[old]
+            for key in self.repaired.keys():
+                if key[0] not in self.packets:
+                    del self.repaired[key]
+
+    def nack(self, missing):
+        """Processes a report of missing chunks, as a dict mapping frame ids
+        to lists of sequence numbers. Returns the packets to send again."""
+        now = system.timefunc()
+        res = []
+        with self.lock:
+            for frame_id, seqs in missing.items():
+                packets = self.packets.get(frame_id)
+                if not packets:
+                    continue
+                for seq in seqs:
+                    if seq not in packets:
+                        continue
+                    self.requested += 1
+                    key = (frame_id, seq)
+                    if now - self.repaired.get(key, 0) < self.holdoff:
+                        self.suppressed += 1
+                        continue
+                    if len(res) >= self.max_repairs:
+                        continue
+                    self.repaired[key] = now
+                    res.append(packets[seq])
+            self.sent += len(res)
+        return res
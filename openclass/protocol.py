@@ -17,7 +17,7 @@ along with this program; if not, see <http://www.gnu.org/licenses/>.
 
 OPENCLASS_HEADER="Open Class"
 OPENCLASS_VERSION_MAJOR=0
-OPENCLASS_VERSION_MINOR=1
+OPENCLASS_VERSION_MINOR=2
 OPENCLASS_BUILD=1
 
 # protocol commands
@@ -45,9 +45,45 @@ REQUEST_ACTIONS="actions"
 REQUEST_RAISEHAND="raisehand"
 REQUEST_SHOWSCREEN="showscreen"
 REQUEST_GETFILE="getfile"
+REQUEST_NACK="nack"
+REQUEST_THUMBNAIL="thumbnail"
+REQUEST_FILENACK="filenack"
 
+import socket
 import struct
 import traceback
+import time
+
+# projection chunks header: version, flags, frame id, tile sequence number,
+# tiles in frame, send timestamp (ms), screen size, tile position and size
+CHUNK_VERSION=2
+CHUNK_HEADER=struct.Struct("!BBIHHIHHHHHH")
+CHUNK_HEADER_SIZE=CHUNK_HEADER.size
+# chunk flags
+CHUNK_FULLSCREEN = 1<<0
+CHUNK_PARITY = 1<<1
+# parity packets header: version, flags, frame id, first sequence number of
+# the protected group, number of packets in group; followed by their lengths
+PARITY_HEADER=struct.Struct("!BBIHB")
+PARITY_HEADER_SIZE=PARITY_HEADER.size
+# a jump back in frame ids this big means the teacher restarted
+FRAME_RESTART=1000
+# largest tile sequence number, as sent in the chunk header
+MAX_SEQ=0xffff
+# most chunks a student may report missing at once
+MAX_NACK_SEQS=4096
+
+# control channel frames, after their length: frame type, request id,
+# request or action name; followed by parameters, each as its name and
+# value, with lengths
+CONTROL_HEADER=struct.Struct("!BIH")
+CONTROL_PARAM_NAME=struct.Struct("!H")
+CONTROL_PARAM_VALUE=struct.Struct("!I")
+# control frame types: student request, teacher response to a request,
+# action pushed by teacher
+CONTROL_REQUEST=1
+CONTROL_RESPONSE=2
+CONTROL_PUSH=3
 
 class Protocol:
     """This is the main class for OpenClass protocol."""
@@ -82,36 +118,189 @@ class Protocol:
         # all ok
         return msg[self.header_len:]
 
-    def create_announce(self, class_name, restricted=False):
-        """Creates announce message."""
+    def create_announce(self, class_name, restricted=False, group=("0.0.0.0", 0)):
+        """Creates announce message, advertising the class multicast group."""
         header = self.header
         header += struct.pack("!64p", class_name)
         flags = 0
         if restricted:
-            flags |= ANNOUNCE_RESTRICTED
-        header += struct.pack("i", flags)
+            flags |= self.ANNOUNCE_RESTRICTED
+        addr, port = group
+        header += struct.pack("!i4sH", flags, socket.inet_aton(addr), port)
         return header
 
     def parse_announce(self, announce):
         """Parses a class announcment"""
         try:
-            name, flags = struct.unpack("!64pi", announce)
+            name, flags, addr, port = struct.unpack("!64pi4sH", announce)
             # TODO: strip trailing null bytes
-            return (name.strip(), flags)
+            return (name.strip(), flags, (socket.inet_ntoa(addr), port))
         except:
             self.logger.exception("Parsing protocol announce")
-            return None, None
+            return None, None, None
 
-    def pack_chunk(self, screen_width, screen_height, fullscreen, chunk):
+    def pack_chunk(self, screen_width, screen_height, fullscreen, chunk, frame_id=0, seq=0, tiles=1, timestamp=None):
         """Packs a chunk into network-specific format for sending"""
-        # TODO: instead of passing fullscreen as an integer, use Flags-like structure
         pos_x, pos_y, step_x, step_y, img = chunk
-        data = struct.pack("!iiiiiii", screen_width, screen_height, fullscreen, pos_x, pos_y, step_x, step_y)
+        flags = 0
+        if fullscreen:
+            flags |= CHUNK_FULLSCREEN
+        if timestamp is None:
+            timestamp = int(time.time() * 1000) & 0xffffffff
+        data = CHUNK_HEADER.pack(CHUNK_VERSION, flags, frame_id, seq, tiles, timestamp,
+                screen_width, screen_height, pos_x, pos_y, step_x, step_y)
         return data + img
 
     def unpack_chunk(self, data):
-        """Unpacks a chunk of data"""
-        head_size = struct.calcsize("!iiiiiii")
-        screen_width, screen_height, fullscreen, pos_x, pos_y, step_x, step_y = struct.unpack("!iiiiiii", data[:head_size])
-        return screen_width, screen_height, fullscreen, pos_x, pos_y, step_x, step_y, data[head_size:]
+        """Unpacks a chunk of data, returns None when it cannot be parsed"""
+        if len(data) < CHUNK_HEADER_SIZE:
+            self.logger.error("Chunk too short (%d < %d)" % (len(data), CHUNK_HEADER_SIZE))
+            return None
+        version, flags, frame_id, seq, tiles, timestamp, screen_width, screen_height, \
+                pos_x, pos_y, step_x, step_y = CHUNK_HEADER.unpack_from(data)
+        if version != CHUNK_VERSION:
+            self.logger.error("Wrong chunk version: %d != %d" % (version, CHUNK_VERSION))
+            return None
+        fullscreen = int(flags & CHUNK_FULLSCREEN != 0)
+        return screen_width, screen_height, fullscreen, pos_x, pos_y, step_x, step_y, \
+                frame_id, seq, tiles, timestamp, data[CHUNK_HEADER_SIZE:]
+
+    def pack_nack(self, missing):
+        """Packs a report of missing chunks, given as a dict mapping frame
+        ids to sequence numbers, into a compact form: 12:1-3,7;13:0"""
+        frames = []
+        for frame_id in sorted(missing.keys()):
+            ranges = []
+            seqs = sorted(missing[frame_id])
+            start = end = seqs[0]
+            for seq in seqs[1:] + [None]:
+                if seq == end + 1:
+                    end = seq
+                    continue
+                if start == end:
+                    ranges.append("%d" % start)
+                else:
+                    ranges.append("%d-%d" % (start, end))
+                start = end = seq
+            frames.append("%d:%s" % (frame_id, ",".join(ranges)))
+        return ";".join(frames)
+
+    def unpack_nack(self, data):
+        """Unpacks a report of missing chunks. Raises ValueError when it
+        holds sequence numbers out of range, or more than MAX_NACK_SEQS of
+        them, which are never expanded."""
+        missing = {}
+        total = 0
+        for frame in data.split(";"):
+            frame_id, ranges = frame.split(":", 1)
+            seqs = []
+            for item in ranges.split(","):
+                if "-" in item:
+                    start, end = item.split("-", 1)
+                    start, end = int(start), int(end)
+                else:
+                    start = end = int(item)
+                if start < 0 or end > MAX_SEQ or start > end:
+                    raise ValueError("Bad range of missing chunks: %s" % item)
+                total += end - start + 1
+                if total > MAX_NACK_SEQS:
+                    raise ValueError("Too many missing chunks reported")
+                seqs.extend(range(start, end + 1))
+            missing[int(frame_id)] = seqs
+        return missing
+
+    def pack_ranges(self, ranges):
+        """Packs a list of (first, last) ranges of chunk ids: 1-3,7,9- where
+        a last of None stands for the end of the file"""
+        items = []
+        for first, last in ranges:
+            if last is None:
+                items.append("%d-" % first)
+            elif first == last:
+                items.append("%d" % first)
+            else:
+                items.append("%d-%d" % (first, last))
+        return ",".join(items)
+
+    def unpack_ranges(self, data):
+        """Unpacks a list of ranges of chunk ids"""
+        ranges = []
+        for item in data.split(","):
+            if item.endswith("-"):
+                ranges.append((int(item[:-1]), None))
+            elif "-" in item:
+                first, last = item.split("-", 1)
+                ranges.append((int(first), int(last)))
+            else:
+                ranges.append((int(item), int(item)))
+        return ranges
+
+    def pack_control(self, frame_type, request_id, name, params=None):
+        """Packs a control channel frame. Params maps names to values or
+        lists of values."""
+        name = name or ""
+        data = [CONTROL_HEADER.pack(frame_type, request_id, len(name)), name]
+        if params:
+            for key, values in params.items():
+                if not isinstance(values, list):
+                    values = [values]
+                for value in values:
+                    value = str(value)
+                    data.append(CONTROL_PARAM_NAME.pack(len(key)))
+                    data.append(key)
+                    data.append(CONTROL_PARAM_VALUE.pack(len(value)))
+                    data.append(value)
+        return "".join(data)
+
+    def unpack_control(self, data):
+        """Unpacks a control channel frame into its type, request id, name
+        and parameters, as lists of values like in parsed query strings.
+        Returns None when it cannot be parsed."""
+        try:
+            frame_type, request_id, size = CONTROL_HEADER.unpack_from(data)
+            pos = CONTROL_HEADER.size
+            name = data[pos:pos + size]
+            pos += size
+            params = {}
+            while pos < len(data):
+                size, = CONTROL_PARAM_NAME.unpack_from(data, pos)
+                pos += CONTROL_PARAM_NAME.size
+                key = data[pos:pos + size]
+                pos += size
+                size, = CONTROL_PARAM_VALUE.unpack_from(data, pos)
+                pos += CONTROL_PARAM_VALUE.size
+                params.setdefault(key, []).append(data[pos:pos + size])
+                pos += size
+            if pos > len(data):
+                raise ValueError("truncated control frame")
+            return frame_type, request_id, name, params
+        except:
+            self.logger.exception("Parsing control frame")
+            return None
+
+    def peek_chunk(self, data):
+        """Returns the frame id and sequence number of a chunk"""
+        return CHUNK_HEADER.unpack_from(data)[2:4]
+
+    def is_parity(self, data):
+        """Checks if a projection packet is a parity packet"""
+        return len(data) > 1 and ord(data[1]) & CHUNK_PARITY != 0
+
+    def pack_parity(self, frame_id, first, lengths, payload):
+        """Packs a parity packet protecting a group of chunks"""
+        header = PARITY_HEADER.pack(CHUNK_VERSION, CHUNK_PARITY, frame_id, first, len(lengths))
+        return header + struct.pack("!%dH" % len(lengths), *lengths) + payload
+
+    def unpack_parity(self, data):
+        """Unpacks a parity packet, returns None when it cannot be parsed"""
+        try:
+            version, flags, frame_id, first, count = PARITY_HEADER.unpack_from(data)
+            if version != CHUNK_VERSION:
+                self.logger.error("Wrong chunk version: %d != %d" % (version, CHUNK_VERSION))
+                return None
+            lengths = struct.unpack_from("!%dH" % count, data, PARITY_HEADER_SIZE)
+            return frame_id, first, lengths, data[PARITY_HEADER_SIZE + 2 * count:]
+        except:
+            self.logger.exception("Parsing parity packet")
+            return None
 
@@ -15,26 +15,709 @@ You should have received a copy of the GNU General Public License
 along with this program; if not, see <http://www.gnu.org/licenses/>.
 """
 
+import sys
+import ctypes
+import mmap
+import multiprocessing
+import random
+import binascii
+import struct
+import time
+import math
+
 from gtk import gdk
 
+import system
+import x11
+
+try:
+    import numpy
+    from numpy.lib.stride_tricks import as_strided
+except ImportError:
+    numpy = None
+
+# size of macroblocks used for change detection, in pixels
+BLOCK_SIZE=16
+# maximum number of changed rectangles before falling back to a bounding box
+MAX_RECTS=32
+# size of tiles cost map cells, in pixels
+COST_CELL=64
+# smallest tile the tiler will split into
+MIN_TILE=16
+# approximate size of jpeg headers and tables, present in every tile
+JPEG_OVERHEAD=620
+
+class FrameDiff:
+    """Detects which parts of the screen changed between two frames"""
+    def __init__(self, block_size=BLOCK_SIZE, max_rects=MAX_RECTS):
+        self.block_size = block_size
+        self.max_rects = max_rects
+        self.reset()
+
+    def reset(self):
+        """Forgets the previous frame, so the next one is sent in full"""
+        self.previous = None
+        self.geometry = None
+
+    def update(self, image, regions=None):
+        """Compares a pixbuf with the previous frame, returns the list of
+        changed rectangles as (pos_x, pos_y, width, height). When a list of
+        regions is given, changes are only looked for inside them."""
+        width = image.get_width()
+        height = image.get_height()
+        geometry = (width, height, image.get_rowstride(), image.get_n_channels())
+        pixels = image.get_pixels()
+        previous = self.previous
+        self.previous = pixels
+        if previous is None or geometry != self.geometry:
+            self.geometry = geometry
+            return [(0, 0, width, height)]
+        bs = self.block_size
+        blocks_x = (width + bs - 1) / bs
+        blocks_y = (height + bs - 1) / bs
+        grid = [[False] * blocks_x for y in range(blocks_y)]
+        if regions is None:
+            regions = [(0, 0, width, height)]
+        for pos_x, pos_y, size_x, size_y in regions:
+            # macroblocks touched by the region
+            blocks = (max(pos_x, 0) / bs, max(pos_y, 0) / bs,
+                    min((pos_x + size_x + bs - 1) / bs, blocks_x),
+                    min((pos_y + size_y + bs - 1) / bs, blocks_y))
+            if blocks[0] >= blocks[2] or blocks[1] >= blocks[3]:
+                continue
+            if numpy:
+                self.dirty_blocks_numpy(previous, pixels, grid, blocks)
+            else:
+                self.dirty_blocks(previous, pixels, grid, blocks)
+        return self.merge_blocks(grid)
+
+    def dirty_blocks_numpy(self, previous, pixels, grid, blocks):
+        """Marks the changed macroblocks of an area of the grid, using numpy"""
+        width, height, rowstride, channels = self.geometry
+        bs = self.block_size
+        x0, y0, x1, y1 = blocks
+        left = x0 * bs * channels
+        right = min(x1 * bs, width) * channels
+        top = y0 * bs
+        bottom = min(y1 * bs, height)
+        # the last row of a pixbuf is not padded to rowstride
+        shape = (height, width * channels)
+        old = as_strided(numpy.frombuffer(previous, numpy.uint8), shape, (rowstride, 1))
+        new = as_strided(numpy.frombuffer(pixels, numpy.uint8), shape, (rowstride, 1))
+        changed = old[top:bottom, left:right] != new[top:bottom, left:right]
+        padded = numpy.zeros(((y1 - y0) * bs, (x1 - x0) * bs * channels), numpy.bool_)
+        padded[:bottom - top, :right - left] = changed
+        area = padded.reshape(y1 - y0, bs, x1 - x0, bs * channels).any(axis=3).any(axis=1)
+        for y, row in enumerate(area.tolist()):
+            grid_row = grid[y0 + y]
+            for x, value in enumerate(row):
+                if value:
+                    grid_row[x0 + x] = True
+
+    def dirty_blocks(self, previous, pixels, grid, blocks):
+        """Marks the changed macroblocks of an area of the grid, without numpy"""
+        width, height, rowstride, channels = self.geometry
+        bs = self.block_size
+        x0, y0, x1, y1 = blocks
+        left = x0 * bs * channels
+        right = min(x1 * bs, width) * channels
+        block_line = bs * channels
+        for y in range(y0 * bs, min(y1 * bs, height)):
+            start = y * rowstride
+            if previous[start + left:start + right] == pixels[start + left:start + right]:
+                continue
+            row = grid[y / bs]
+            for x in range(x0, x1):
+                if row[x]:
+                    continue
+                pos = start + x * block_line
+                end = min(pos + block_line, start + right)
+                if previous[pos:end] != pixels[pos:end]:
+                    row[x] = True
+
+    def merge_blocks(self, grid):
+        """Merges changed macroblocks into a small set of rectangles"""
+        width, height = self.geometry[:2]
+        bs = self.block_size
+        rects = []
+        # runs from previous block row which may still grow downwards
+        open_runs = {}
+        for y, row in enumerate(grid):
+            runs = {}
+            x = 0
+            blocks_x = len(row)
+            while x < blocks_x:
+                if not row[x]:
+                    x += 1
+                    continue
+                start = x
+                while x < blocks_x and row[x]:
+                    x += 1
+                run = (start, x)
+                # extend a rectangle with the same horizontal span
+                runs[run] = open_runs.pop(run, y)
+            for (start, end), top in open_runs.items():
+                rects.append((start, top, end, y))
+            open_runs = runs
+        for (start, end), top in open_runs.items():
+            rects.append((start, top, end, len(grid)))
+        if not rects:
+            return []
+        if len(rects) > self.max_rects:
+            rects = [(min([r[0] for r in rects]), min([r[1] for r in rects]),
+                    max([r[2] for r in rects]), max([r[3] for r in rects]))]
+        res = []
+        for x0, y0, x1, y1 in rects:
+            pos_x = x0 * bs
+            pos_y = y0 * bs
+            res.append((pos_x, pos_y, min(x1 * bs, width) - pos_x, min(y1 * bs, height) - pos_y))
+        return res
+
+class DamageTracker:
+    """Tells which areas of the screen were drawn since the previous call,
+    through the X DAMAGE extension. When damage tracking is not available,
+    every area is reported as possibly changed."""
+    def __init__(self, logger, max_rects=MAX_RECTS):
+        self.logger = logger
+        self.max_rects = max_rects
+        self.display = None
+        self.damage = None
+        try:
+            self.display = x11.Display()
+            self.damage = x11.XDamage(self.display)
+        except:
+            self.logger.exception("Starting damage tracking, every capture will be processed")
+            self.close()
+        # nothing is known about the screen contents yet
+        self.first = True
+
+    def get_damage(self):
+        """Returns the list of (pos_x, pos_y, width, height) damaged areas,
+        or None when unknown"""
+        if not self.damage:
+            return None
+        rects = self.damage.get_rects()
+        if self.first:
+            self.first = False
+            return None
+        if len(rects) > self.max_rects:
+            rects = [(min([r[0] for r in rects]), min([r[1] for r in rects]),
+                    max([r[0] + r[2] for r in rects]), max([r[1] + r[3] for r in rects]))]
+            rects = [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in rects]
+        return rects
+
+    def close(self):
+        """Stops tracking damage"""
+        if self.damage:
+            self.damage.close()
+            self.damage = None
+        if self.display:
+            self.display.close()
+            self.display = None
+
+def scale_rects(rects, scale_x, scale_y):
+    """Scales a list of rectangles, growing them by one pixel around to
+    cover the scaling interpolation"""
+    res = []
+    for pos_x, pos_y, width, height in rects:
+        left = int(pos_x * scale_x) - 1
+        top = int(pos_y * scale_y) - 1
+        right = int(math.ceil((pos_x + width) * scale_x)) + 1
+        bottom = int(math.ceil((pos_y + height) * scale_y)) + 1
+        res.append((left, top, right - left, bottom - top))
+    return res
+
+def encode_pixbuf(pixbuf, quality):
+    """Encodes a pixbuf into jpeg"""
+    image = []
+    pixbuf.save_to_callback(lambda buf, image: image.append(buf), "jpeg", {"quality": str(quality)}, image)
+    return "".join(image)
+
+def dhash(pixbuf):
+    """Computes a 64 bit perceptual difference hash of an image: each bit
+    tells if a pixel of the image reduced to 9x8 gray pixels is brighter
+    than its right neighbour"""
+    small = pixbuf.scale_simple(9, 8, gdk.INTERP_BILINEAR)
+    pixels = small.get_pixels()
+    rowstride = small.get_rowstride()
+    channels = small.get_n_channels()
+    value = 0
+    for y in range(8):
+        row = []
+        for x in range(9):
+            pos = y * rowstride + x * channels
+            r, g, b = [ord(c) for c in pixels[pos:pos + 3]]
+            row.append(r * 299 + g * 587 + b * 114)
+        for x in range(8):
+            value = (value << 1) | int(row[x] > row[x + 1])
+    return value
+
+def hamming(a, b):
+    """Counts the bits differing between two hashes"""
+    return bin(a ^ b).count("1")
+
+class Tiler:
+    """Splits screen areas into tiles whose encoded size fits into a
+    datagram. The cost of each screen region, in bytes per pixel, is learnt
+    from the sizes of previously encoded tiles."""
+    def __init__(self, max_size, cell=COST_CELL, min_tile=MIN_TILE, default_cost=0.5):
+        self.max_size = max_size
+        self.cell = cell
+        self.min_tile = min_tile
+        self.default_cost = default_cost
+        self.costs = {}
+        self.oversized = 0
+
+    def cells(self, rect):
+        """Returns the cost map cells covered by a rectangle, with the covered area"""
+        pos_x, pos_y, width, height = rect
+        cell = self.cell
+        res = []
+        for cell_y in range(pos_y / cell, (pos_y + height - 1) / cell + 1):
+            top = max(pos_y, cell_y * cell)
+            bottom = min(pos_y + height, (cell_y + 1) * cell)
+            for cell_x in range(pos_x / cell, (pos_x + width - 1) / cell + 1):
+                left = max(pos_x, cell_x * cell)
+                right = min(pos_x + width, (cell_x + 1) * cell)
+                res.append(((cell_x, cell_y), (right - left) * (bottom - top)))
+        return res
+
+    def estimate(self, rect):
+        """Estimates the encoded size of a rectangle"""
+        size = JPEG_OVERHEAD
+        for cell, area in self.cells(rect):
+            size += area * self.costs.get(cell, self.default_cost)
+        return size
+
+    def learn(self, rect, size):
+        """Updates the cost map with the encoded size of a rectangle"""
+        area = rect[2] * rect[3]
+        cost = max(size - JPEG_OVERHEAD, 0) * 1.0 / area
+        for cell, covered in self.cells(rect):
+            old = self.costs.get(cell, cost)
+            # weight the update by how much of the cell was seen
+            weight = min(1.0, covered * 1.0 / (self.cell * self.cell) + 0.25)
+            self.costs[cell] = old + (cost - old) * weight
+
+    def split(self, rect):
+        """Splits a rectangle in two along its longest side, or returns None
+        when it is already as small as allowed"""
+        pos_x, pos_y, width, height = rect
+        if width >= height and width >= 2 * self.min_tile:
+            half = width / 2
+            return [(pos_x, pos_y, half, height), (pos_x + half, pos_y, width - half, height)]
+        elif height >= 2 * self.min_tile:
+            half = height / 2
+            return [(pos_x, pos_y, width, half), (pos_x, pos_y + half, width, height - half)]
+        return None
+
+    def plan(self, rect):
+        """Splits a rectangle until all the pieces are expected to fit"""
+        pending = [rect]
+        res = []
+        while pending:
+            rect = pending.pop()
+            parts = None
+            if self.estimate(rect) > self.max_size:
+                parts = self.split(rect)
+            if parts:
+                pending.extend(parts)
+            else:
+                res.append(rect)
+        return res
+
+    def tiles(self, image, rects, quality, encode=None):
+        """Encodes the rectangles of a pixbuf, re-splitting the tiles which
+        turn out to be too big. Returns a list of
+        (pos_x, pos_y, width, height, img) tuples"""
+        if not encode:
+            encode = encode_tiles
+        pending = []
+        for rect in rects:
+            pending.extend(self.plan(rect))
+        chunks = []
+        while pending:
+            encoded = encode(image, pending, quality)
+            pending = []
+            for chunk in encoded:
+                rect = chunk[:4]
+                size = len(chunk[4])
+                self.learn(rect, size)
+                if size > self.max_size:
+                    parts = self.split(rect)
+                    if parts:
+                        pending.extend(parts)
+                        continue
+                    self.oversized += 1
+                chunks.append(chunk)
+        return chunks
+
+def encode_tiles(image, rects, quality):
+    """Encodes rectangles of a pixbuf into jpeg images"""
+    chunks = []
+    for pos_x, pos_y, width, height in rects:
+        chunk = image.subpixbuf(pos_x, pos_y, width, height)
+        img = []
+        chunk.save_to_callback(lambda buf, img: img.append(buf), "jpeg", {"quality": str(quality)}, img)
+        chunks.append((pos_x, pos_y, width, height, "".join(img)))
+    return chunks
+
+# frame shared with the encoding processes
+_shared_frame = None
+
+def _init_encoder(frame):
+    """Initializes an encoding process"""
+    global _shared_frame
+    _shared_frame = frame
+
+def _encode_tile(task):
+    """Encodes a tile of the shared frame into jpeg, in a worker process"""
+    rowstride, channels, has_alpha, quality, rect = task
+    pos_x, pos_y, width, height = rect
+    line = width * channels
+    start = pos_y * rowstride + pos_x * channels
+    data = "".join([_shared_frame[start + y * rowstride:start + y * rowstride + line] for y in range(height)])
+    chunk = gdk.pixbuf_new_from_data(data, gdk.COLORSPACE_RGB, has_alpha, 8, width, height, line)
+    img = []
+    chunk.save_to_callback(lambda buf, img: img.append(buf), "jpeg", {"quality": str(quality)}, img)
+    return (pos_x, pos_y, width, height, "".join(img))
+
+class EncoderPool:
+    """Encodes tiles on a pool of worker processes. The frame pixels are
+    passed to the workers through a shared memory mapping, so only the tile
+    coordinates and the resulting jpeg images cross the process boundary."""
+    def __init__(self, workers=None):
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.pool = None
+        self.frame = None
+        self.frame_size = 0
+        self.image = None
+
+    def start(self, size):
+        """Starts the worker processes with a shared frame of a given size"""
+        self.stop()
+        self.frame = mmap.mmap(-1, size)
+        self.frame_size = size
+        self.pool = multiprocessing.Pool(self.workers, _init_encoder, (self.frame,))
+
+    def stop(self):
+        """Stops the worker processes"""
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.frame:
+            self.frame.close()
+            self.frame = None
+        self.image = None
+
+    def new_frame(self):
+        """Tells the pool that the next pixbuf has new pixels, even if it
+        is the same pixbuf object"""
+        self.image = None
+
+    def encode(self, image, rects, quality):
+        """Encodes rectangles of a pixbuf into jpeg images, in parallel"""
+        if image is not self.image:
+            pixels = image.get_pixels()
+            if len(pixels) > self.frame_size:
+                self.start(len(pixels))
+            self.frame.seek(0)
+            self.frame.write(pixels)
+            self.image = image
+        rowstride = image.get_rowstride()
+        channels = image.get_n_channels()
+        has_alpha = image.get_has_alpha()
+        tasks = [(rowstride, channels, has_alpha, quality, rect) for rect in rects]
+        chunksize = max(1, len(tasks) / (self.workers * 4))
+        return self.pool.map(_encode_tile, tasks, chunksize)
+
+# {{{ Capture backends
+class Capture:
+    """Screen capture backend"""
+    def get_size(self):
+        """Returns the size of the captured screen"""
+        raise NotImplementedError
+
+    def grab(self, width, height):
+        """Returns a pixbuf with the top-left width x height pixels of the screen"""
+        raise NotImplementedError
+
+    def close(self):
+        """Releases the backend resources"""
+        pass
+
+class GdkCapture(Capture):
+    """Captures the root window through gdk"""
+    def __init__(self, param=None):
+        pass
+
+    def get_size(self):
+        """Returns the size of the captured screen"""
+        return gdk.screen_width(), gdk.screen_height()
+
+    def grab(self, width, height):
+        """Returns a pixbuf with the top-left width x height pixels of the screen"""
+        screenshot = gdk.Pixbuf(gdk.COLORSPACE_RGB, False, 8, width, height)
+        screenshot.get_from_drawable(gdk.get_default_root_window(),
+                                    gdk.colormap_get_system(),
+                                    0, 0, 0, 0,
+                                    width, height)
+        return screenshot
+
+class SyntheticCapture(Capture):
+    """Generates deterministic frames without a display. Supported modes are
+    'static' (an idle desktop), 'scroll' (a scrolling text window) and
+    'motion' (a full-motion video window)."""
+    MODES = ["static", "scroll", "motion"]
+
+    def __init__(self, param=None, width=1024, height=768, seed=1):
+        if not param:
+            param = "static"
+        if param not in self.MODES:
+            raise ValueError("Unknown synthetic capture mode %s" % param)
+        self.mode = param
+        self.width = width
+        self.height = height
+        self.frame = 0
+        r = random.Random(seed)
+        line = width * 3
+        # desktop background: horizontal gradient bands
+        self.background = [chr(64 + (y * 128) / height) * line for y in range(height)]
+        # text: short runs of dark "glyphs" over a white page
+        self.text = []
+        for y in range(height):
+            row = []
+            while len(row) < width:
+                if y % 16 < 4:
+                    row.extend(["\xff\xff\xff"] * 8)
+                else:
+                    row.extend(["\x20\x20\x20"] * r.randint(1, 6))
+                    row.extend(["\xff\xff\xff"] * r.randint(1, 3))
+            self.text.append("".join(row[:width]))
+        # video: a noise buffer larger than the video window
+        size = line * 2
+        self.noise = binascii.unhexlify("%0*x" % (size * 2, r.getrandbits(size * 8)))
+
+    def get_size(self):
+        """Returns the size of the generated screen"""
+        return self.width, self.height
+
+    def grab(self, width, height):
+        """Returns the next frame"""
+        frame = self.frame
+        self.frame += 1
+        line = self.width * 3
+        # the "window" covers the middle of the screen
+        top = self.height / 4
+        bottom = self.height * 3 / 4
+        left = (self.width / 4) * 3
+        right = (self.width * 3 / 4) * 3
+        rows = []
+        for y in range(self.height):
+            row = self.background[y]
+            if top <= y < bottom:
+                if self.mode == "scroll":
+                    window = self.text[(y + frame * 8) % self.height]
+                elif self.mode == "motion":
+                    offset = ((y * 31 + frame * 1021) % self.width) * 3
+                    window = self.noise[offset:offset + line]
+                else:
+                    window = self.text[y]
+                row = row[:left] + window[left:right] + row[right:]
+            rows.append(row)
+        image = gdk.pixbuf_new_from_data("".join(rows), gdk.COLORSPACE_RGB, False, 8, self.width, self.height, line)
+        if width != self.width or height != self.height:
+            image = image.subpixbuf(0, 0, width, height)
+        return image
+
+class XShmCapture(Capture):
+    """Captures the root window through MIT-SHM shared memory, into a
+    persistent pixbuf. Works with local X servers only, Xvfb included."""
+    def __init__(self, param=None):
+        self.display = x11.Display(param)
+        try:
+            self.shm = x11.XShmImage(self.display)
+        except:
+            self.display.close()
+            raise
+        self.width = self.shm.width
+        self.height = self.shm.height
+        self.pixbuf = gdk.Pixbuf(gdk.COLORSPACE_RGB, False, 8, self.width, self.height)
+        # position of red, green and blue bytes in a 32 bits pixel
+        image = self.shm.image.contents
+        self.offsets = []
+        for mask in (image.red_mask, image.green_mask, image.blue_mask):
+            byte = 0
+            while mask > 0xff:
+                mask >>= 8
+                byte += 1
+            if sys.byteorder == "big":
+                byte = 3 - byte
+            self.offsets.append(byte)
+        self.pixels = None
+        self.rgb = None
+        if numpy:
+            try:
+                # pixbuf pixels and the shared segment, seen as arrays
+                self.pixels = self.pixbuf.get_pixels_array()
+                frame = (ctypes.c_uint8 * self.shm.size).from_address(self.shm.info.shmaddr)
+                frame = numpy.ctypeslib.as_array(frame).reshape(self.height, self.shm.bytes_per_line)
+                self.frame = frame[:, :self.width * 4].reshape(self.height, self.width, 4)
+            except:
+                self.pixels = None
+        if self.pixels is None:
+            self.rgb = bytearray(self.width * self.height * 3)
+
+    def get_size(self):
+        """Returns the size of the captured screen"""
+        return self.width, self.height
+
+    def grab(self, width, height):
+        """Returns a pixbuf with the top-left width x height pixels of the screen"""
+        addr = self.shm.grab()
+        red, green, blue = self.offsets
+        if self.pixels is not None:
+            # converted in place, straight into the pixbuf
+            self.pixels[..., 0] = self.frame[..., red]
+            self.pixels[..., 1] = self.frame[..., green]
+            self.pixels[..., 2] = self.frame[..., blue]
+            image = self.pixbuf
+        else:
+            raw = ctypes.string_at(addr, self.shm.size)
+            line = self.width * 4
+            if self.shm.bytes_per_line != line:
+                bpl = self.shm.bytes_per_line
+                raw = "".join([raw[y * bpl:y * bpl + line] for y in range(self.height)])
+            self.rgb[0::3] = raw[red::4]
+            self.rgb[1::3] = raw[green::4]
+            self.rgb[2::3] = raw[blue::4]
+            image = gdk.pixbuf_new_from_data(str(self.rgb), gdk.COLORSPACE_RGB, False, 8,
+                    self.width, self.height, self.width * 3)
+        if width != self.width or height != self.height:
+            image = image.subpixbuf(0, 0, width, height)
+        return image
+
+    def close(self):
+        """Releases the shared memory and the display connection"""
+        if self.shm.image:
+            self.shm.release()
+        self.display.close()
+
+# raw frames file format: magic, width, height, rowstride, channels + pixels
+FRAME_HEADER = struct.Struct("!4sIIIB")
+FRAME_MAGIC = "OCFR"
+
+class ReplayCapture(Capture):
+    """Replays raw frames recorded with record_frames, looping at the end"""
+    def __init__(self, param):
+        self.fd = open(param, "rb")
+        self.size = None
+        header = self.fd.read(FRAME_HEADER.size)
+        magic, width, height, rowstride, channels = FRAME_HEADER.unpack(header)
+        if magic != FRAME_MAGIC:
+            raise ValueError("%s is not a frames file" % param)
+        self.size = (width, height)
+        self.fd.seek(0)
+
+    def get_size(self):
+        """Returns the size of the recorded screen"""
+        return self.size
+
+    def grab(self, width, height):
+        """Returns the next recorded frame"""
+        header = self.fd.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            self.fd.seek(0)
+            header = self.fd.read(FRAME_HEADER.size)
+        magic, frame_width, frame_height, rowstride, channels = FRAME_HEADER.unpack(header)
+        pixels = self.fd.read(rowstride * (frame_height - 1) + frame_width * channels)
+        image = gdk.pixbuf_new_from_data(pixels, gdk.COLORSPACE_RGB, channels == 4, 8, frame_width, frame_height, rowstride)
+        if width != frame_width or height != frame_height:
+            image = image.subpixbuf(0, 0, min(width, frame_width), min(height, frame_height))
+        return image
+
+    def close(self):
+        """Closes the frames file"""
+        self.fd.close()
+
+def record_frames(filename, capture, count, interval=0.5):
+    """Records frames from a capture backend into a raw frames file"""
+    width, height = capture.get_size()
+    with open(filename, "wb") as fd:
+        for i in range(count):
+            image = capture.grab(width, height)
+            frame_width, frame_height = image.get_width(), image.get_height()
+            rowstride, channels = image.get_rowstride(), image.get_n_channels()
+            fd.write(FRAME_HEADER.pack(FRAME_MAGIC, frame_width, frame_height, rowstride, channels))
+            # the padding of the last row may or may not be included in the
+            # pixels, so it is never written, as ReplayCapture expects
+            fd.write(image.get_pixels()[:rowstride * (frame_height - 1) + frame_width * channels])
+            time.sleep(interval)
+
+CAPTURE_BACKENDS = {
+        "gdk": GdkCapture,
+        "xshm": XShmCapture,
+        "synthetic": SyntheticCapture,
+        "replay": ReplayCapture,
+        }
+
+# shared memory capture is only available on X11
+if system.get_os() == "Linux":
+    DEFAULT_CAPTURE = "xshm"
+else:
+    DEFAULT_CAPTURE = "gdk"
+
+def get_capture(spec, logger):
+    """Converts a backend description, in form of name[:parameter], into a
+    capture backend"""
+    name, param = (spec.split(":", 1) + [None])[:2]
+    if name not in CAPTURE_BACKENDS:
+        raise ValueError("Unknown capture backend %s" % name)
+    try:
+        return CAPTURE_BACKENDS[name](param)
+    except x11.X11Error:
+        # X11 extensions missing, fall back to the regular capture
+        logger.exception("Initializing %s capture backend, using gdk instead" % name)
+        return GdkCapture()
+# }}}
+
 class Screen:
     """Screen capturing class"""
-    def __init__(self, width=None, height=None):
+    def __init__(self, logger, width=None, height=None, workers=0, capture="gdk"):
+        if isinstance(capture, basestring):
+            capture = get_capture(capture, logger)
+        self.backend = capture
+        screen_width, screen_height = capture.get_size()
         if not width:
-            width = gdk.screen_width()
+            width = screen_width
         self.width = width
         if not height:
-            height = gdk.screen_height()
-            self.height = height
+            height = screen_height
+        self.height = height
+        # shared memory is inherited by forked processes only
+        self.encoder = None
+        if workers > 1 and system.get_os() == "Linux":
+            self.encoder = EncoderPool(workers)
+
+    def encode(self, image, rects, quality):
+        """Encodes rectangles of a pixbuf, in parallel when possible"""
+        if self.encoder:
+            return self.encoder.encode(image, rects, quality)
+        return encode_tiles(image, rects, quality)
+
+    def stop(self):
+        """Releases the encoding processes and capture backend"""
+        if self.encoder:
+            self.encoder.stop()
+        self.backend.close()
 
     def capture(self, scale_x=None, scale_y=None, quality=75, raw=False):
         """Captures a screenshot and returns in for width, height, data"""
 
-        screenshot = gdk.Pixbuf(gdk.COLORSPACE_RGB, False, 8, self.width, self.height)
-        screenshot.get_from_drawable(gdk.get_default_root_window(),
-                                    gdk.colormap_get_system(),
-                                    0, 0, 0, 0,
-                                    self.width, self.height)
+        screenshot = self.backend.grab(self.width, self.height)
 
         if not scale_x:
             scale_x = self.width
@@ -46,29 +729,48 @@ class Screen:
         if raw:
             return scale_x, scale_y, screenshot
         else:
-            image=[]
-            screenshot.save_to_callback(lambda buf, image: image.append(buf), "jpeg", {"quality": str(quality)}, image)
-            return scale_x, scale_y, "".join(image)
+            return scale_x, scale_y, encode_pixbuf(screenshot, quality)
 
-    def chunks(self, chunks_x=4, chunks_y=4, scale_x=None, scale_y=None, quality=75):
-        """Captures a screenshot and converts it into a serie of smaller shots"""
+    def chunks(self, chunks_x=4, chunks_y=4, scale_x=None, scale_y=None, quality=75, diff=None, tiler=None, damage=None):
+        """Captures a screenshot and converts it into a serie of smaller shots.
+        When a FrameDiff is given, only the changed areas are returned,
+        looking for changes in the damaged areas only if those are known.
+        When a Tiler is given, the shots are sized to fit into its datagram
+        size."""
 
         width, height, image = self.capture(scale_x=scale_x, scale_y=scale_y, raw=True)
+        if self.encoder:
+            self.encoder.new_frame()
 
         step_x = width / chunks_x
         step_y = height / chunks_y
 
-        chunks=[]
+        if diff:
+            rects = diff.update(image, damage)
+        else:
+            rects = [(0, 0, step_x * chunks_x, step_y * chunks_y)]
+
+        tiles = []
+        for rect in rects:
+            tiles.extend(split_rect(rect, step_x, step_y))
 
-        for y in range(chunks_y):
-            pos_y = y * step_y
-            for x in range(chunks_x):
-                pos_x = x * step_x
+        if tiler:
+            return tiler.tiles(image, tiles, quality, encode=self.encode)
+        return self.encode(image, tiles, quality)
 
-                chunk = image.subpixbuf(pos_x, pos_y, step_x, step_y)
-                img = []
-                chunk.save_to_callback(lambda buf, img: img.append(buf), "jpeg", {"quality": str(quality)}, img)
-                chunks.append((pos_x, pos_y, step_x, step_y, "".join(img)))
-        return chunks
+def split_rect(rect, step_x, step_y):
+    """Splits a rectangle along the borders of a grid of step_x x step_y cells"""
+    pos_x, pos_y, width, height = rect
+    res = []
+    y = pos_y
+    while y < pos_y + height:
+        end_y = min((y / step_y + 1) * step_y, pos_y + height)
+        x = pos_x
+        while x < pos_x + width:
+            end_x = min((x / step_x + 1) * step_x, pos_x + width)
+            res.append((x, y, end_x - x, end_y - y))
+            x = end_x
+        y = end_y
+    return res
 
 RESOLUTIONS=["320x240", "640x480", "800x480", "800x600", "1024x600", "1024x768"]
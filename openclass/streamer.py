@@ -20,10 +20,54 @@ along with this program; if not, see <http://www.gnu.org/licenses/>.
 
 import traceback
 import struct
+import mmap
+import re
 import os
 
 STREAMER_PROTOCOL_VERSION=1
 DEFAULT_CHUNK_SIZE=1024
+# protocol version and file name length
+CHUNK_PREFIX=struct.Struct("!BB")
+# chunk size, number of chunks and chunk id
+CHUNK_INFO=struct.Struct("!HLL")
+CHUNK_ID=struct.Struct("!L")
+# runs of missing chunks in the map of received chunks
+MISSING_RUN=re.compile(r"\x00+")
+
+def map_address(mapping):
+    """Returns the address of the pages of a writable memory map, or None"""
+    try:
+        import ctypes
+        return ctypes.addressof(ctypes.c_char.from_buffer(mapping))
+    except:
+        traceback.print_exc()
+        return None
+
+class FileChanged(Exception):
+    """File resized while being streamed, so its memory map cannot be read
+    safely anymore"""
+    pass
+
+def parse_header(chunk):
+    """Parses the header of an encoded chunk. Returns its file name, chunk
+    size, number of chunks, chunk id and the offset of its data, or None if
+    it is not a chunk"""
+    if chunk[:3] != "OST" or len(chunk) < CHUNK_PREFIX.size + 3:
+        return None
+    version, filename_len = CHUNK_PREFIX.unpack_from(chunk, 3)
+    offset = filename_len + 5
+    if version != STREAMER_PROTOCOL_VERSION or len(chunk) < offset + CHUNK_INFO.size:
+        return None
+    chunk_size, num_chunks, pos = CHUNK_INFO.unpack_from(chunk, offset)
+    return chunk[5:offset], chunk_size, num_chunks, pos, offset + CHUNK_INFO.size
+
+def chunk_filename(chunk):
+    """Returns the file name of an encoded chunk, or None if it is not a
+    chunk"""
+    header = parse_header(chunk)
+    if not header:
+        return None
+    return header[0]
 
 class StreamerEncoder:
     #
@@ -45,57 +89,79 @@ class StreamerEncoder:
         self.short_filename_len = len(self.short_filename)
         self.filesize = -1
         self.num_chunks = -1
-        self.chunks = []
-        self.fd = -1
+        self.fd = None
+        self.map = None
+        # address of the mapped file, when known
+        self.address = None
+        # header of all chunks, up to the chunk id
+        self.prefix = None
 
     def prepare(self):
         """Prepares the file for transmission, returns total number of chunks"""
         try:
             fd = open(self.filename, "rb")
-            fd.seek(0, 2)
-            self.filesize = fd.tell()
+            self.filesize = os.fstat(fd.fileno()).st_size
             self.num_chunks = self.filesize / self.chunk_size
-            if self.filesize / self.chunk_size != 0:
+            if self.filesize % self.chunk_size != 0:
                 self.num_chunks += 1
+            if self.filesize:
+                # a private mapping, never written, so that the address of its
+                # pages can be handed to the kernel without copying them
+                self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_COPY)
+                self.address = map_address(self.map)
         except:
             traceback.print_exc()
             return False
         self.fd = fd
+        self.prefix = "OST" + struct.pack("!BB", STREAMER_PROTOCOL_VERSION, self.short_filename_len) + \
+            self.short_filename + struct.pack("!HL", self.chunk_size, self.num_chunks)
         return True
 
     def get_num_chunks(self):
         """Returns the number of chunks in file"""
         return self.num_chunks
 
+    def get_chunk_range(self, pos):
+        """Returns the header of a chunk, and the offset and length of its data
+        in the mapped file. Raises FileChanged when the file was resized, as
+        reading pages past its new end would crash the process with SIGBUS."""
+        if os.fstat(self.fd.fileno()).st_size != self.filesize:
+            raise FileChanged("%s changed while being sent" % self.filename)
+        start = self.chunk_size * pos
+        end = min(start + self.chunk_size, self.filesize)
+        return self.prefix + CHUNK_ID.pack(pos), start, end - start
+
+    def get_chunk_parts(self, pos):
+        """Returns the header and the data of a chunk, the data being a buffer
+        of the mapped file"""
+        header, start, length = self.get_chunk_range(pos)
+        return header, buffer(self.map, start, length)
+
     def get_chunk(self, pos):
         """Returns the encoded chunk corresponding to the offset in file"""
         try:
-            self.fd.seek(self.chunk_size * pos)
-            data = self.fd.read(self.chunk_size)
-            return self.encode_chunk(pos, data)
+            header, data = self.get_chunk_parts(pos)
+            return header + str(data)
         except:
             traceback.print_exc()
             return None
 
-    def get_chunks(self, chunks=[]):
-        """Returns a series of chunks, read at once. Returns a dict mapping chunk ids with file contents"""
-        # sort the chunks
-        chunks.sort()
-        res = {}
+    def iter_chunks(self, chunks=None):
+        """Yields the header and data of a series of chunks, in order, or of
+        all the chunks"""
+        if chunks is None:
+            chunks = xrange(self.num_chunks)
+        else:
+            chunks = sorted(chunks)
         for chunk in chunks:
-            res[chunk] = self.get_chunk(chunk)
-        return res
-
-    def encode_chunk(self, pos, data):
-        """Encodes a chunk into streaming format"""
-        res = "OST" + struct.pack("!BB", STREAMER_PROTOCOL_VERSION, self.short_filename_len) + \
-            self.short_filename + \
-            struct.pack("!HLL", self.chunk_size, self.num_chunks, pos) + \
-            data
-        return res
+            yield self.get_chunk_parts(chunk)
 
     def finish(self):
         """Finishes streaming"""
+        self.address = None
+        if self.map:
+            self.map.close()
+            self.map = None
         self.fd.close()
         self.fd = None
 
@@ -111,12 +177,28 @@ class StreamerDecoder:
     #   chunk id(unsigned long, big endian) +
     #   data
 
-    def __init__(self, filename):
-        """Initializes streamer"""
+    def __init__(self, filename, use_mmap=True):
+        """Initializes streamer. Chunks are written into a memory map of the
+        file when use_mmap is set and the file fits in the address space."""
         self.filename = filename
         self.short_filename = os.path.basename(filename)
         self.short_filename_len = len(self.short_filename)
         self.fd = -1
+        self.use_mmap = use_mmap
+        self.map = None
+        # known once a chunk is received
+        self.chunk_size = None
+        self.num_chunks = None
+        # one byte per chunk, set once received, so that runs of missing
+        # chunks are found by a regular expression
+        self.received = None
+        self.count = 0
+        # highest chunk id received
+        self.highest = -1
+        # known once the last chunk is received
+        self.filesize = None
+        # chunks which could not be parsed or belong to another stream
+        self.rejected = 0
 
         # calculate file parameters
         self.prepare()
@@ -124,42 +206,109 @@ class StreamerDecoder:
     def prepare(self):
         """Prepares the file for transmission, returns total number of chunks"""
         try:
-            fd = open(self.filename, "wb")
+            fd = open(self.filename, "w+b")
         except:
             traceback.print_exc()
             return False
         self.fd = fd
         return True
 
+    def allocate(self, chunk_size, num_chunks):
+        """Sizes the file and the map of received chunks for a stream"""
+        self.chunk_size = chunk_size
+        self.num_chunks = num_chunks
+        self.received = bytearray(num_chunks)
+        # sparse where supported, disk space is used as chunks arrive
+        self.fd.truncate(chunk_size * num_chunks)
+        if self.use_mmap:
+            try:
+                self.map = mmap.mmap(self.fd.fileno(), chunk_size * num_chunks)
+            except (EnvironmentError, OverflowError, ValueError):
+                # too large for the address space, written with file calls
+                self.map = None
+
     def decode_chunk(self, chunk):
-        """Decodes a chunk"""
-        header = chunk[:3]
-        version = struct.unpack("!B", chunk[3])[0]
-        if header != "OST" or version != STREAMER_PROTOCOL_VERSION:
-            # bad version
-            print "Incompatible protocol version"
+        """Decodes a chunk, returns None when it cannot be parsed"""
+        header = parse_header(chunk)
+        if not header:
             return None
-        filename_len = struct.unpack("!B", chunk[4])[0]
-        filename = chunk[5:filename_len+5]
-        data = chunk[filename_len + 5:]
-        data_size = struct.calcsize("!HLL")
-        chunk_size, num_chunks, pos = struct.unpack("!HLL", data[:data_size])
-        payload = data[data_size:]
-        return filename, chunk_size, num_chunks, pos, payload
+        filename, chunk_size, num_chunks, pos, offset = header
+        return filename, chunk_size, num_chunks, pos, chunk[offset:]
 
     def put_chunk(self, chunk):
-        """Puts a chunk back into file and refreshes the streamer constants"""
-        res = self.decode_chunk(chunk)
-        if not res:
-            return
-        filename, chunk_size, num_chunks, pos, payload = res
-        new_pos = chunk_size * pos
-        print new_pos
-        self.fd.seek(new_pos, 0)
-        self.fd.write(payload)
+        """Puts a chunk back into file. Returns False when the chunk was
+        already received or cannot be parsed."""
+        header = parse_header(chunk)
+        if not header:
+            self.rejected += 1
+            return False
+        filename, chunk_size, num_chunks, pos, offset = header
+        if self.received is None:
+            if not chunk_size or not num_chunks:
+                self.rejected += 1
+                return False
+            self.allocate(chunk_size, num_chunks)
+        elif chunk_size != self.chunk_size or num_chunks != self.num_chunks:
+            self.rejected += 1
+            return False
+        if pos >= num_chunks:
+            self.rejected += 1
+            return False
+        if self.received[pos]:
+            # duplicate, checked before copying its data
+            return False
+        payload = chunk[offset:]
+        start = chunk_size * pos
+        if pos == num_chunks - 1:
+            self.filesize = start + len(payload)
+        elif len(payload) != chunk_size:
+            self.rejected += 1
+            return False
+        if self.map is not None:
+            self.map[start:start + len(payload)] = payload
+        elif hasattr(os, "pwrite"):
+            os.pwrite(self.fd.fileno(), payload, start)
+        else:
+            self.fd.seek(start)
+            self.fd.write(payload)
+        self.received[pos] = 1
+        self.count += 1
+        if pos > self.highest:
+            self.highest = pos
+        return True
+
+    def is_complete(self):
+        """Checks if all the chunks of the file were received"""
+        return self.num_chunks is not None and self.count == self.num_chunks
+
+    def get_received(self):
+        """Returns the number of chunks received"""
+        return self.count
+
+    def missing_ranges(self, end=None, limit=None):
+        """Returns the ranges of missing chunks below end, or below the
+        number of chunks, as (first, last) pairs. At most limit ranges are
+        returned."""
+        if self.received is None:
+            return []
+        if end is None:
+            end = self.num_chunks
+        ranges = []
+        for match in MISSING_RUN.finditer(self.received, 0, end):
+            ranges.append((match.start(), match.end() - 1))
+            if limit and len(ranges) >= limit:
+                break
+        return ranges
 
     def finish(self):
         """Finishes streaming"""
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.filesize is not None:
+            # the last chunk is usually shorter than the others
+            self.fd.truncate(self.filesize)
         self.fd.close()
         self.fd = None
 
@@ -168,11 +317,7 @@ if __name__ == "__main__":
     w = StreamerDecoder("output")
     s.prepare()
     num_chunks = s.get_num_chunks()
-    chunks = s.get_chunks(range(num_chunks))
-    keys = chunks.keys()
-    keys.reverse()
-    for c in keys:
-        chunk = chunks[c]
-        w.put_chunk(chunk)
+    for c in reversed(range(num_chunks)):
+        w.put_chunk(s.get_chunk(c))
     s.finish()
     w.finish()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+"""X11 extensions module
+
+Minimal ctypes bindings for the X11 extensions used for screen capturing.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, see <http://www.gnu.org/licenses/>.
+"""
+
+import ctypes
+import ctypes.util
+
+# X11 constants
+ZPixmap = 2
+AllPlanes = ctypes.c_ulong(-1).value
+
+# System V shared memory constants
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+
+class X11Error(Exception):
+    """An X11 extension is not available"""
+    pass
+
+class XImage(ctypes.Structure):
+    """Leading fields of Xlib XImage structure"""
+    _fields_ = [
+            ("width", ctypes.c_int),
+            ("height", ctypes.c_int),
+            ("xoffset", ctypes.c_int),
+            ("format", ctypes.c_int),
+            ("data", ctypes.c_void_p),
+            ("byte_order", ctypes.c_int),
+            ("bitmap_unit", ctypes.c_int),
+            ("bitmap_bit_order", ctypes.c_int),
+            ("bitmap_pad", ctypes.c_int),
+            ("depth", ctypes.c_int),
+            ("bytes_per_line", ctypes.c_int),
+            ("bits_per_pixel", ctypes.c_int),
+            ("red_mask", ctypes.c_ulong),
+            ("green_mask", ctypes.c_ulong),
+            ("blue_mask", ctypes.c_ulong),
+            ]
+
+class XShmSegmentInfo(ctypes.Structure):
+    """Xlib XShmSegmentInfo structure"""
+    _fields_ = [
+            ("shmseg", ctypes.c_ulong),
+            ("shmid", ctypes.c_int),
+            ("shmaddr", ctypes.c_void_p),
+            ("readOnly", ctypes.c_int),
+            ]
+
+XErrorHandler = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+
+def load_library(name):
+    """Loads a shared library, raising X11Error when not found"""
+    path = ctypes.util.find_library(name)
+    if not path:
+        raise X11Error("Library %s not found" % name)
+    return ctypes.CDLL(path)
+
+def load_xlib():
+    """Loads libX11 and declares the functions in use"""
+    xlib = load_library("X11")
+    xlib.XOpenDisplay.restype = ctypes.c_void_p
+    xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+    xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+    xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+    xlib.XRootWindow.restype = ctypes.c_ulong
+    xlib.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XDefaultVisual.restype = ctypes.c_void_p
+    xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XFlush.argtypes = [ctypes.c_void_p]
+    xlib.XDestroyImage.argtypes = [ctypes.POINTER(XImage)]
+    xlib.XSetErrorHandler.restype = ctypes.c_void_p
+    xlib.XSetErrorHandler.argtypes = [ctypes.c_void_p]
+    return xlib
+
+class Display:
+    """A connection to the X server"""
+    def __init__(self, name=None):
+        self.xlib = load_xlib()
+        self.dpy = self.xlib.XOpenDisplay(name)
+        if not self.dpy:
+            raise X11Error("Unable to open display %s" % name)
+        self.screen = self.xlib.XDefaultScreen(self.dpy)
+        self.root = self.xlib.XRootWindow(self.dpy, self.screen)
+        self.errors = 0
+
+    def get_size(self):
+        """Returns the size of the default screen"""
+        return (self.xlib.XDisplayWidth(self.dpy, self.screen),
+                self.xlib.XDisplayHeight(self.dpy, self.screen))
+
+    def checked(self, func, *args):
+        """Runs a request and waits for its completion, returning False
+        when the server reported an error instead of exiting the program,
+        as the default Xlib error handler would do"""
+        def handler(dpy, event):
+            self.errors += 1
+            return 0
+        handler = XErrorHandler(handler)
+        errors = self.errors
+        old_handler = self.xlib.XSetErrorHandler(ctypes.cast(handler, ctypes.c_void_p))
+        try:
+            res = func(*args)
+            self.xlib.XSync(self.dpy, 0)
+        finally:
+            self.xlib.XSetErrorHandler(old_handler)
+        return res and self.errors == errors
+
+    def close(self):
+        """Closes the connection"""
+        if self.dpy:
+            self.xlib.XCloseDisplay(self.dpy)
+            self.dpy = None
+
+class XShmImage:
+    """Root window image kept in a MIT-SHM shared memory segment. The X server
+    writes each captured frame directly into the segment, so no memory is
+    allocated and no pixels are sent over the X socket while capturing."""
+    def __init__(self, display):
+        self.display = display
+        xlib = display.xlib
+        self.xext = xext = load_library("Xext")
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(XImage)
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint,
+                ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo),
+                ctypes.c_uint, ctypes.c_uint]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XImage),
+                ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        self.libc = libc = load_library("c")
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+        dpy = display.dpy
+        if not xext.XShmQueryExtension(dpy):
+            raise X11Error("MIT-SHM extension not available")
+        self.width, self.height = display.get_size()
+        self.info = XShmSegmentInfo()
+        self.image = xext.XShmCreateImage(dpy, xlib.XDefaultVisual(dpy, display.screen),
+                xlib.XDefaultDepth(dpy, display.screen), ZPixmap, None,
+                ctypes.byref(self.info), self.width, self.height)
+        if not self.image:
+            raise X11Error("Unable to create shared image")
+        image = self.image.contents
+        if image.bits_per_pixel != 32:
+            xlib.XDestroyImage(self.image)
+            raise X11Error("Unsupported pixel format (%d bpp)" % image.bits_per_pixel)
+        self.bytes_per_line = image.bytes_per_line
+        self.size = image.bytes_per_line * image.height
+        self.info.shmid = libc.shmget(IPC_PRIVATE, self.size, IPC_CREAT | 0o600)
+        if self.info.shmid < 0:
+            xlib.XDestroyImage(self.image)
+            raise X11Error("Unable to allocate shared memory")
+        self.info.shmaddr = libc.shmat(self.info.shmid, None, 0)
+        if self.info.shmaddr in (None, ctypes.c_void_p(-1).value):
+            libc.shmctl(self.info.shmid, IPC_RMID, None)
+            xlib.XDestroyImage(self.image)
+            raise X11Error("Unable to attach shared memory")
+        self.info.readOnly = 0
+        image.data = self.info.shmaddr
+        attached = display.checked(xext.XShmAttach, dpy, ctypes.byref(self.info))
+        # the segment is released automatically once both sides detach
+        libc.shmctl(self.info.shmid, IPC_RMID, None)
+        if not attached:
+            self.release(attached=False)
+            raise X11Error("Unable to attach shared memory, is the display remote?")
+
+    def grab(self):
+        """Captures the root window into the shared segment, returns its address"""
+        self.xext.XShmGetImage(self.display.dpy, self.display.root, self.image, 0, 0, AllPlanes)
+        return self.info.shmaddr
+
+    def release(self, attached=True):
+        """Releases the shared image"""
+        if attached:
+            self.xext.XShmDetach(self.display.dpy, ctypes.byref(self.info))
+        # XDestroyImage would free the shared data
+        self.image.contents.data = None
+        self.display.xlib.XDestroyImage(self.image)
+        self.libc.shmdt(self.info.shmaddr)
+        self.image = None
+
+# XDamage constants
+XDamageReportRawRectangles = 0
+XDamageNotify = 0
+
+class XRectangle(ctypes.Structure):
+    """Xlib XRectangle structure"""
+    _fields_ = [
+            ("x", ctypes.c_short),
+            ("y", ctypes.c_short),
+            ("width", ctypes.c_ushort),
+            ("height", ctypes.c_ushort),
+            ]
+
+class XDamageNotifyEvent(ctypes.Structure):
+    """XDamageNotifyEvent structure"""
+    _fields_ = [
+            ("type", ctypes.c_int),
+            ("serial", ctypes.c_ulong),
+            ("send_event", ctypes.c_int),
+            ("display", ctypes.c_void_p),
+            ("drawable", ctypes.c_ulong),
+            ("damage", ctypes.c_ulong),
+            ("level", ctypes.c_int),
+            ("more", ctypes.c_int),
+            ("timestamp", ctypes.c_ulong),
+            ("area", XRectangle),
+            ("geometry", XRectangle),
+            ]
+
+class XEvent(ctypes.Union):
+    """Xlib XEvent union, only the damage notification is decoded"""
+    _fields_ = [
+            ("type", ctypes.c_int),
+            ("damage", XDamageNotifyEvent),
+            ("pad", ctypes.c_long * 24),
+            ]
+
+class XDamage:
+    """Reports the areas of the root window which were drawn, using the
+    X DAMAGE extension. It uses its own display connection, whose events are
+    only processed when the damaged areas are requested."""
+    def __init__(self, display):
+        self.display = display
+        xlib = display.xlib
+        xlib.XPending.argtypes = [ctypes.c_void_p]
+        xlib.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.POINTER(XEvent)]
+        self.xdamage = xdamage = load_library("Xdamage")
+        xdamage.XDamageQueryExtension.argtypes = [ctypes.c_void_p,
+                ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+        xdamage.XDamageCreate.restype = ctypes.c_ulong
+        xdamage.XDamageCreate.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int]
+        xdamage.XDamageDestroy.argtypes = [ctypes.c_void_p, ctypes.c_ulong]
+        event_base = ctypes.c_int()
+        error_base = ctypes.c_int()
+        if not xdamage.XDamageQueryExtension(display.dpy, ctypes.byref(event_base), ctypes.byref(error_base)):
+            raise X11Error("DAMAGE extension not available")
+        self.event_type = event_base.value + XDamageNotify
+        self.damage = xdamage.XDamageCreate(display.dpy, display.root, XDamageReportRawRectangles)
+        xlib.XFlush(display.dpy)
+        self.event = XEvent()
+
+    def get_rects(self):
+        """Returns the list of (x, y, width, height) areas damaged since the
+        last call"""
+        xlib = self.display.xlib
+        dpy = self.display.dpy
+        event = self.event
+        rects = []
+        while xlib.XPending(dpy):
+            xlib.XNextEvent(dpy, ctypes.byref(event))
+            if event.type == self.event_type:
+                area = event.damage.area
+                rects.append((area.x, area.y, area.width, area.height))
+        return rects
+
+    def close(self):
+        """Stops tracking damage"""
+        if self.damage:
+            self.xdamage.XDamageDestroy(self.display.dpy, self.damage)
+            self.damage = None
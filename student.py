@@ -36,12 +36,14 @@ import gobject
 from gtk import gdk
 
 from threading import Thread
+import threading
 import thread
 import socket
 import traceback
 import time
 
-import urllib, urllib2
+import urllib
+import httplib
 import math
 
 import gettext
@@ -54,12 +56,15 @@ except IOError:
     _ = str
     traceback.print_exc()
 
-from openclass import network, system, protocol, screen, notification, config
+from openclass import network, system, protocol, screen, notification, config, projection, fec, download, streamer
 import skins
 
 # variables
 CONFIGFILE = system.get_full_path(system.get_local_storage(), ".openclass-student.conf")
 SYSTEM_CONFIGFILE = system.get_full_path(system.get_system_storage(), "openclass-student.conf")
+
+# seconds without chunks of a multicast file before downloading it instead
+FILE_TIMEOUT = 10
 class Student:
     selected_machines = 0
     """Teacher GUI main class"""
@@ -78,7 +83,14 @@ class Student:
         self.notification = notification.Notification("OpenClass student")
 
         # screen
-        self.screen = screen.Screen()
+        capture = self.config.get("student", "capture", screen.DEFAULT_CAPTURE)
+        try:
+            self.screen = screen.Screen(self.logger, capture=capture)
+        except:
+            self.logger.exception("Initializing %s capture backend" % capture)
+            self.screen = screen.Screen(self.logger)
+        # only send thumbnails when something was drawn on the screen
+        self.damage = screen.DamageTracker(self.logger)
 
         # find out what is our skin
         skin_name = self.config.get("student", "skin", "DefaultSkinStudent")
@@ -95,13 +107,91 @@ class Student:
         # Configura o timer
         gobject.timeout_add(1000, self.monitor_bcast)
         gobject.timeout_add(500, self.monitor_mcast)
-        gobject.timeout_add(1000, self.monitor_teacher)
+        gobject.timeout_add(1000, self.monitor_thumbnail)
+        gobject.timeout_add(1000, self.monitor_files)
 
         self.teacher = None
         self.teacher_addr = None
         self.name = None
         self.outfile = None
         self.missed_commands = 0
+        # persistent http connections to teacher: "commands" for the
+        # commands sent from the main loop, "poll" for the background poller
+        self.connections = {}
+        # last command received from teacher
+        self.current_command = None
+        # thumbnails, until the teacher asks for others
+        self.set_thumbnail_settings("")
+        try:
+            self.thumbnail_threshold = int(self.config.get("student", "thumbnail_threshold", "0"))
+        except:
+            self.logger.exception("Detecting thumbnail change threshold")
+            self.thumbnail_threshold = 0
+        # persistent control channel to teacher, when connected
+        self.control = None
+        self.control_lock = thread.allocate_lock()
+        self.control_request_id = 0
+        # request id -> [event, answer] for requests waiting for their
+        # answer, or None for status reports
+        self.control_requests = {}
+        # time to try to open the control channel again
+        self.control_retry = 0
+        try:
+            self.use_control = int(self.config.get("student", "control", "1"))
+            self.control_ssl = int(self.config.get("student", "control_ssl", "0"))
+            self.control_ca_certs = self.config.get("student", "ca_certs", "") or None
+            self.control_report = int(self.config.get("student", "report_interval", "5"))
+        except:
+            self.logger.exception("Detecting control channel settings")
+            self.use_control = 1
+            self.control_ssl = 0
+            self.control_ca_certs = None
+            self.control_report = 5
+        try:
+            self.poll_wait = int(self.config.get("student", "poll_wait", "20"))
+        except:
+            self.logger.exception("Detecting poll wait")
+            self.poll_wait = 20
+        # projection reception statistics, reported to teacher
+        self.projection_stats = projection.ReceiveStats()
+        self.projection_fec = fec.FecDecoder(self.logger)
+        try:
+            max_tiles = int(self.config.get("student", "max_tiles", "1024"))
+        except:
+            self.logger.exception("Detecting projection buffer size")
+            max_tiles = 1024
+        # received tiles waiting to be decoded
+        self.projection_tiles = projection.TileBuffer(max_tiles)
+        # decoded tiles waiting to be drawn by the main loop
+        self.projection_lock = thread.allocate_lock()
+        self.projection_ready = []
+        self.projection_draw_pending = False
+        # newest frame drawn over each area
+        self.projection_drawn = projection.TileMap()
+        self.quitting = False
+        try:
+            max_downloads = int(self.config.get("student", "max_downloads", "2"))
+        except:
+            self.logger.exception("Detecting concurrent downloads")
+            max_downloads = 2
+        # files received from teacher, downloaded in background
+        self.downloader = download.Downloader(self.logger, self.download_changed, max_downloads)
+        # download -> progress shown in the tray icon
+        self.downloads = {}
+        # files sent by teacher over multicast: short name -> [decoder,
+        # download, time of last chunk]
+        self.file_receives = {}
+        self.files_lock = thread.allocate_lock()
+        self.files_mcast = None
+        try:
+            decoders = int(self.config.get("student", "decoders", "2"))
+        except:
+            self.logger.exception("Detecting projection decoders")
+            decoders = 2
+        for i in range(max(1, decoders)):
+            decoder = Thread(target=self.decode_tiles)
+            decoder.setDaemon(True)
+            decoder.start()
         try:
             self.max_missed_commands = int(self.config.get("student", "max_missed_commands", "30"))
         except:
@@ -113,11 +203,22 @@ class Student:
         self.logger.info("Starting broadcasting service..")
         self.bcast.start()
 
-        self.mcast = network.McastListener()
+        self.poller = Thread(target=self.poll_teacher)
+        self.poller.setDaemon(True)
+        self.poller.start()
+
+        # multicast listener, for the group of the teacher we log in to
+        self.mcast = None
+        try:
+            self.source_specific = int(self.config.get("student", "source_specific", "1"))
+        except:
+            self.logger.exception("Detecting source-specific multicast")
+            self.source_specific = 1
 
         # initialize list of teachers
         self.teachers = gtk.combo_box_new_text()
         self.teachers_addr = {}
+        self.teachers_group = {}
 
         # disconnected by default
         self.disconnect()
@@ -230,8 +331,168 @@ class Student:
     def quit(self, widget, param):
         """Main window was closed"""
         gtk.main_quit()
+        self.quitting = True
+        self.downloader.quit()
+        self.damage.close()
         self.bcast.actions.put(1)
-        self.mcast.actions.put(1)
+        if self.mcast:
+            self.mcast.stop()
+        if self.files_mcast:
+            self.files_mcast.stop()
+
+    def download_changed(self, download):
+        """Shows the progress of a download, from the download threads"""
+        gobject.idle_add(self.show_download, download)
+
+    def show_download(self, download):
+        """Shows the progress of the downloads in the tray icon"""
+        if download.status == "done":
+            self.downloads.pop(download, None)
+            self.notification.notify(_("File download"), _("Received a file from teacher: %s") % download.path)
+        elif download.status == "failed":
+            self.downloads.pop(download, None)
+            self.notification.notify(_("File download"), _("Unable to download file %s from teacher.") % download.name)
+        else:
+            progress = download.get_progress()
+            if progress is None:
+                self.downloads[download] = _("Waiting to download %s") % download.name
+            else:
+                self.downloads[download] = _("Downloading %s (%d%%)") % (download.name, 100 * progress)
+        if self.teacher:
+            tooltip = _('OpenClass student (connected to %s)') % self.teacher
+        else:
+            tooltip = _('OpenClass student (disconnected)')
+        self.icon.set_tooltip("\n".join([tooltip] + self.downloads.values()))
+        return False
+
+    def receive_file(self, url, filename_short):
+        """Starts receiving a file sent by the teacher over multicast"""
+        localfile = system.create_local_file(_("Received files"), filename_short)
+        with self.files_lock:
+            if filename_short in self.file_receives:
+                return
+            decoder = streamer.StreamerDecoder(localfile + download.PART_SUFFIX)
+            file_download = download.Download(url, localfile)
+            if decoder.fd == -1:
+                self.downloader.add(url, localfile)
+                return
+            file_download.status = "running"
+            # decoder, download, time of the last chunk, whether the whole
+            # file was asked for
+            self.file_receives[filename_short] = [decoder, file_download, system.timefunc(), False]
+        self.show_download(file_download)
+        if not self.files_mcast:
+            addr, port = network.MCASTADDR, network.MCASTPORT
+            if self.mcast:
+                addr, port = self.mcast.addr, self.mcast.port
+            self.files_mcast = network.McastListener(addr, port + network.FILEPORT_OFFSET,
+                    self.mcast and self.mcast.source, receiver=self.receive_file_chunk)
+            self.files_mcast.start()
+
+    def receive_file_chunk(self, message, sender):
+        """Processes a chunk of a file, from the multicast listener thread"""
+        if sender != self.teacher_addr:
+            return
+        try:
+            data = message.tobytes()
+            with self.files_lock:
+                receive = self.file_receives.get(streamer.chunk_filename(data))
+                if not receive or not receive[0].put_chunk(data):
+                    return
+                receive[2] = system.timefunc()
+                decoder, file_download = receive[:2]
+                if not decoder.is_complete():
+                    return
+                del self.file_receives[file_download.name]
+            decoder.finish()
+            # checked in background, not to hold the reception of chunks
+            thread.start_new_thread(self.verify_file, (decoder, file_download))
+        except:
+            self.logger.exception("Processing file chunk")
+
+    def verify_file(self, decoder, file_download):
+        """Checks a file received over multicast against the digest known
+        by the teacher, or downloads it when they do not match"""
+        try:
+            digest = download.fetch_digest(file_download.url, network.HTTP_TIMEOUT)
+            if digest and download.file_digest(decoder.filename) == digest:
+                if os.path.exists(file_download.path):
+                    os.unlink(file_download.path)
+                os.rename(decoder.filename, file_download.path)
+                file_download.status = "done"
+                self.download_changed(file_download)
+                return
+            self.logger.warning("Unable to verify %s received over multicast, downloading it" % file_download.name)
+        except:
+            self.logger.exception("Verifying %s" % file_download.name)
+        if os.path.exists(decoder.filename):
+            os.unlink(decoder.filename)
+        # replaced by the download
+        gobject.idle_add(self.downloads.pop, file_download, None)
+        self.downloader.add(file_download.url, file_download.path)
+
+    def monitor_files(self):
+        """Asks the teacher to send again the chunks of files missed, or
+        downloads the files when multicast does not reach us"""
+        now = system.timefunc()
+        with self.files_lock:
+            receives = self.file_receives.items()
+        for filename_short, receive in receives:
+            decoder, file_download, last_chunk, asked_all = receive
+            if now - last_chunk > FILE_TIMEOUT:
+                self.logger.info("No multicast chunks of %s, downloading it" % filename_short)
+                with self.files_lock:
+                    if self.file_receives.pop(filename_short, None) is None:
+                        continue
+                decoder.finish()
+                # multicast chunks may have left holes, which would be resumed
+                os.unlink(decoder.filename)
+                self.downloader.add(file_download.url, file_download.path)
+                continue
+            if decoder.num_chunks is None:
+                # nothing received yet, so the size of the file is unknown:
+                # the stream may have ended before we joined it. Asked once
+                # only, as the whole class receives the file again.
+                if now - last_chunk > 2 and not asked_all:
+                    receive[3] = True
+                    self.send_command(protocol.REQUEST_FILENACK, {"file": filename_short,
+                        "missing": self.protocol.pack_ranges([(0, None)])})
+                continue
+            # progress in chunks, shown as a fraction
+            file_download.size = decoder.num_chunks
+            file_download.received = decoder.get_received()
+            self.show_download(file_download)
+            # chunks are first sent in order, so the ones below the highest
+            # received are lost, and the ones above too once the teacher is
+            # done with the file
+            end = decoder.highest
+            if now - last_chunk > 1:
+                end = None
+            with self.files_lock:
+                ranges = decoder.missing_ranges(end, limit=64)
+            if ranges:
+                self.send_command(protocol.REQUEST_FILENACK, {"file": filename_short,
+                    "missing": self.protocol.pack_ranges(ranges)})
+        if not receives and self.files_mcast:
+            self.files_mcast.stop()
+            self.files_mcast = None
+
+        gobject.timeout_add(1000, self.monitor_files)
+
+    def join_group(self, group, source):
+        """Starts listening to the multicast group of a teacher"""
+        addr, port = network.MCASTADDR, network.MCASTPORT
+        if group and group[1]:
+            addr, port = group
+        if not self.source_specific:
+            source = None
+        if self.mcast:
+            if (self.mcast.addr, self.mcast.port, self.mcast.source) == (addr, port, source):
+                return
+            self.mcast.stop()
+        self.logger.info("Listening to multicast group %s:%d" % (addr, port))
+        self.mcast = network.McastListener(addr, port, source, receiver=self.receive_mcast)
+        self.mcast.start()
 
     def leave_class(self, widget):
         """Leave a class"""
@@ -307,12 +568,13 @@ class Student:
                 ret, params = self.send_command(protocol.REQUEST_REGISTER, {"name": self.name}, teacher=source)
                 if ret == "registered":
                     # registered successfully
+                    self.set_thumbnail_settings(params)
                     self.teacher = teacher
                     self.teacher_addr = source
+                    self.current_command = None
                     self.connect_to_teacher(self.teacher)
                     # start threads
-                    if not self.mcast.isAlive():
-                        self.mcast.start()
+                    self.join_group(self.teachers_group.get(teacher), source)
                     dialog.hide()
                     name_label = self.manager.get_widget('/Menubar/Menu/Login')
                     name_label.get_children()[0].set_markup(_("Logged in as <b>%s</b>") % self.name)
@@ -332,73 +594,210 @@ class Student:
         quit = self.manager.get_widget('/Menubar/Menu/Quit')
         quit.set_sensitive(True)
 
-    def monitor_teacher(self):
-        """Periodically checks for teacher commands"""
-        if self.teacher_addr:
-            # send some parameters with the request
-            params = {}
-            params["name"] = self.name
-            width, height, shot = self.screen.capture(scale_x=64, scale_y=64, quality=25)
-            params["shot"] = shot
-            # connect to teacher for instructions
-            command, params = self.send_command(protocol.REQUEST_ACTIONS, params)
-            if command == protocol.ACTION_PROJECTION:
-                self.logger.info("Projecting")
-                self.start_projection()
-            elif command == protocol.ACTION_ATTENTION:
-                self.logger.info( "Attention!")
-                self.ask_attention()
-            elif command == protocol.ACTION_MSG:
-                self.logger.info("Message: %s" % params)
-                self.show_message(params)
-                self.noop()
-            elif command == protocol.ACTION_NOOP:
-                self.logger.info("Stopping everything")
-                self.noop()
-            elif command == protocol.ACTION_PLEASEREGISTER:
-                self.logger.info("Students needs to register again")
-                self.noop()
-                self.disconnect()
-            elif command == protocol.ACTION_SHOT:
-                self.logger.info("Teacher requested our screenshot")
-                self.shot()
-            elif command == protocol.ACTION_OPENFILE:
-                file_action = params
-                self.logger.info("Teacher requested us to process file action: %s" % file_action)
+    def monitor_thumbnail(self):
+        """Periodically sends a thumbnail of the screen to teacher, when it
+        visibly changed"""
+        damage = self.damage.get_damage()
+        # the first thumbnail after registering is sent even when idle, as
+        # the teacher may have restarted and have none
+        if self.teacher_addr and (damage != [] or self.thumbnail_hash is None):
+            width, height, thumbnail = self.screen.capture(scale_x=self.thumbnail_width,
+                    scale_y=self.thumbnail_height, raw=True)
+            thumbnail_hash = screen.dhash(thumbnail)
+            if self.thumbnail_hash is None or screen.hamming(thumbnail_hash, self.thumbnail_hash) > self.thumbnail_threshold:
+                shot = screen.encode_pixbuf(thumbnail, 25)
+                self.send_command(protocol.REQUEST_THUMBNAIL, {"name": self.name}, data=shot)
+                self.thumbnail_hash = thumbnail_hash
+        gobject.timeout_add(self.thumbnail_interval * 1000, self.monitor_thumbnail)
+
+    def set_thumbnail_settings(self, settings):
+        """Applies the thumbnail size and interval asked by teacher"""
+        self.thumbnail_hash = None
+        try:
+            size, interval = settings.split(" ")
+            width, height = size.split("x")
+            self.thumbnail_width = max(8, min(int(width), 256))
+            self.thumbnail_height = max(8, min(int(height), 256))
+            self.thumbnail_interval = max(1, int(interval))
+        except:
+            self.logger.info("Using default thumbnail settings")
+            self.thumbnail_width = 64
+            self.thumbnail_height = 64
+            self.thumbnail_interval = 1
+
+    def poll_teacher(self):
+        """Waits for teacher commands, in a background thread, over the
+        control channel when the teacher accepts it, or else with long
+        polling"""
+        while not self.quitting:
+            teacher = self.teacher_addr
+            if not teacher:
+                time.sleep(1)
+                continue
+            if self.use_control and time.time() >= self.control_retry:
+                if self.run_control(teacher):
+                    continue
+                self.logger.info("No control channel on %s, using http" % teacher)
+                self.control_retry = time.time() + 60
+            self.poll_http()
+
+    def get_report(self):
+        """Returns the parameters reported to teacher with actions requests"""
+        params = {}
+        params["name"] = self.name
+        received, missing, rebuilt, lost_frames, latency = self.projection_stats.get_report()
+        params["tiles"] = received
+        params["missing"] = missing
+        params["rebuilt"] = rebuilt
+        params["lost_frames"] = lost_frames
+        params["latency"] = latency
+        params["dropped"] = self.projection_tiles.get_dropped()
+        return params
+
+    def poll_http(self):
+        """Asks teacher for commands over http. The teacher holds each
+        request until it has a new command for us, or for poll_wait
+        seconds."""
+        params = self.get_report()
+        if self.current_command:
+            params["current"] = self.current_command
+            params["wait"] = self.poll_wait
+        # connect to teacher for instructions
+        start = time.time()
+        command, params = self.send_command(protocol.REQUEST_ACTIONS, params, connection="poll")
+        if command is None:
+            time.sleep(1)
+            return
+        if command == self.current_command and params == "None":
+            # nothing new, the teacher may not hold requests
+            time.sleep(max(0, 1 - (time.time() - start)))
+        self.current_command = command
+        gobject.idle_add(self.run_command, command, params)
+
+    def run_control(self, teacher):
+        """Talks to teacher over the control channel until it is closed,
+        returns False if it could not be opened"""
+        control = network.TcpClient(teacher, network.CONTROLPORT, self.control_ssl, self.control_ca_certs)
+        if not control.connect(timeout=network.HTTP_TIMEOUT):
+            return False
+        self.logger.info("Connected to control channel on %s" % teacher)
+        self.control = control
+        try:
+            # commands are pushed by teacher, we only report our status
+            # often enough to be seen alive
+            control.settimeout(1)
+            self.control_send(control, protocol.REQUEST_REGISTER, {"name": self.name,
+                "client_id": self.client_id})
+            last_report = 0
+            while not self.quitting and self.teacher_addr == teacher:
+                if time.time() - last_report >= self.control_report:
+                    params = self.get_report()
+                    params["client_id"] = self.client_id
+                    request_id = self.control_send(control, protocol.REQUEST_ACTIONS, params)
+                    with self.control_lock:
+                        self.control_requests[request_id] = None
+                    last_report = time.time()
                 try:
-                    do_open, filename_short, filename = file_action.split(":", 2)
-                    filename = urllib.quote(filename)
-                    url = "http://%s:%d/%s?file=%s" % (self.teacher_addr, network.LISTENPORT, protocol.REQUEST_GETFILE, filename)
-                    self.logger.debug("Grabbing file from %s" % url)
-                    if do_open == "open":
-                        system.open_url(url)
-                    else:
-                        # just download the file, do not open it yet
-                        try:
-                            localfile = system.create_local_file(_("Received files"), filename_short)
-                            opener = urllib.FancyURLopener().open(url)
-                            with open(localfile, "w") as fd:
-                                while True:
-                                    data = opener.read(16384)
-                                    if not data:
-                                        break
-                                    fd.write(data)
-                            self.notification.notify(_("File download"), _("Received a file from teacher: %s") % localfile)
-                        except:
-                            self.logger.exception("Downloading file %s from teacher" % url)
-                            self.notification.notify(_("File download"), _("Unable to download file %s from teacher.") % filename_short)
-                except:
-                    self.logger.exception("Open file request")
-            elif command == protocol.ACTION_OPENURL:
-                url = params
-                self.logger.info("Teacher requested us to open the link at %s" % url)
-                system.open_url(url)
-            elif command == protocol.ACTION_SHUTDOWN:
-                # TODO: show a confirmation window with a timeout
-                system.shutdown()
-            else:
-                self.logger.error("Unknown command %s" % command)
-        gobject.timeout_add(1000, self.monitor_teacher)
+                    data = control.recv_frame()
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                frame = self.protocol.unpack_control(data)
+                if not frame:
+                    break
+                frame_type, request_id, command, params = frame
+                params = params.get("params", [None])[0]
+                with self.control_lock:
+                    waiter = self.control_requests.pop(request_id, False)
+                if frame_type == protocol.CONTROL_PUSH or waiter is None:
+                    # pushed action, or answer to a status report
+                    if command:
+                        self.current_command = command
+                        gobject.idle_add(self.run_command, command, params)
+                elif waiter:
+                    waiter[1] = (command, params)
+                    waiter[0].set()
+        except:
+            self.logger.exception("Control channel to %s" % teacher)
+        self.control = None
+        control.close()
+        self.logger.info("Control channel to %s closed" % teacher)
+        return True
+
+    def control_send(self, control, command, params):
+        """Sends a request over the control channel, returns its id"""
+        with self.control_lock:
+            self.control_request_id = (self.control_request_id + 1) & 0xffffffff
+            request_id = self.control_request_id
+        control.send_frame(self.protocol.pack_control(protocol.CONTROL_REQUEST, request_id, command, params))
+        return request_id
+
+    def control_request(self, control, command, params):
+        """Sends a request over the control channel and waits for its answer"""
+        waiter = [threading.Event(), None]
+        with self.control_lock:
+            self.control_request_id = (self.control_request_id + 1) & 0xffffffff
+            request_id = self.control_request_id
+            self.control_requests[request_id] = waiter
+        control.send_frame(self.protocol.pack_control(protocol.CONTROL_REQUEST, request_id, command, params))
+        waiter[0].wait(network.HTTP_TIMEOUT)
+        with self.control_lock:
+            self.control_requests.pop(request_id, None)
+        if not waiter[1]:
+            raise socket.timeout("No answer over control channel")
+        return waiter[1]
+
+    def run_command(self, command, params):
+        """Runs a teacher command"""
+        if command == protocol.ACTION_PROJECTION:
+            self.logger.info("Projecting")
+            self.start_projection()
+        elif command == protocol.ACTION_ATTENTION:
+            self.logger.info( "Attention!")
+            self.ask_attention()
+        elif command == protocol.ACTION_MSG:
+            self.logger.info("Message: %s" % params)
+            self.show_message(params)
+            self.noop()
+        elif command == protocol.ACTION_NOOP:
+            self.logger.info("Stopping everything")
+            self.noop()
+        elif command == protocol.ACTION_PLEASEREGISTER:
+            self.logger.info("Students needs to register again")
+            self.noop()
+            self.disconnect()
+        elif command == protocol.ACTION_SHOT:
+            self.logger.info("Teacher requested our screenshot")
+            self.shot()
+        elif command == protocol.ACTION_OPENFILE:
+            file_action = params
+            self.logger.info("Teacher requested us to process file action: %s" % file_action)
+            try:
+                do_open, filename_short, filename = file_action.split(":", 2)
+                filename = urllib.quote(filename)
+                url = "http://%s:%d/%s?file=%s" % (self.teacher_addr, network.LISTENPORT, protocol.REQUEST_GETFILE, filename)
+                self.logger.debug("Grabbing file from %s" % url)
+                if do_open == "open":
+                    system.open_url(url)
+                elif do_open == "mcast":
+                    self.receive_file(url, filename_short)
+                else:
+                    # just download the file, do not open it yet
+                    localfile = system.create_local_file(_("Received files"), filename_short)
+                    self.downloader.add(url, localfile)
+            except:
+                self.logger.exception("Open file request")
+        elif command == protocol.ACTION_OPENURL:
+            url = params
+            self.logger.info("Teacher requested us to open the link at %s" % url)
+            system.open_url(url)
+        elif command == protocol.ACTION_SHUTDOWN:
+            # TODO: show a confirmation window with a timeout
+            system.shutdown()
+        else:
+            self.logger.error("Unknown command %s" % command)
+        return False
 
     def show_message(self, message):
         """Shows a message to student"""
@@ -415,8 +814,11 @@ class Student:
                 }
         self.send_command(protocol.REQUEST_SHOWSCREEN, params=params, post=True)
 
-    def send_command(self, command, params={}, teacher=None, post=False):
-        """Sends a command to teacher via GET request (default) or POST (post=True)"""
+    def send_command(self, command, params={}, teacher=None, post=False, connection="commands", data=None):
+        """Sends a command to teacher over the control channel when it is
+        connected, or else via GET request (default) or POST (post=True),
+        over the named persistent connection. Data is sent as a raw binary
+        body."""
         if not teacher:
             teacher = self.teacher_addr
         if not teacher:
@@ -425,22 +827,37 @@ class Student:
         if not self.name:
             self.logger.error("Error: not logged in yet!")
             return None, None
-        # TODO: proper user-agent
-        url = "http://%s:%d/%s" % (teacher, network.LISTENPORT, command)
         params["client_id"] = self.client_id
-        if post:
-            params = urllib.urlencode(params)
-        else:
-            url += "?%s" % urllib.urlencode(params)
-            params = None
+        control = self.control
+        if control and control.addr == teacher:
+            try:
+                if data is not None:
+                    params["data"] = data
+                return self.control_request(control, command, params)
+            except:
+                self.logger.warning("Unable to talk to teacher over control channel: %s" % sys.exc_value)
+        # TODO: proper user-agent
+        path = "/%s" % command
         headers = {'User-Agent': 'openclass'}
+        if data is not None:
+            method = "POST"
+            params.pop("data", None)
+            path += "?%s" % urllib.urlencode(params)
+            body = data
+            headers["Content-Type"] = "application/octet-stream"
+        elif post:
+            method = "POST"
+            body = urllib.urlencode(params)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        else:
+            method = "GET"
+            path += "?%s" % urllib.urlencode(params)
+            body = None
 
         command = None
         params_ret = None
         try:
-            req = urllib2.Request(url, params, headers)
-            print req
-            response = urllib2.urlopen(req)
+            response = self.request_teacher(connection, teacher, method, path, body, headers)
             ret = response.read()
             try:
                 if ret:
@@ -455,74 +872,172 @@ class Student:
             self.missed_commands += 1
             if self.missed_commands > self.max_missed_commands:
                 self.logger.warning("Too many missing commands, leaving this teacher")
-                self.noop()
                 self.teacher = None
                 self.teacher_addr = None
-                self.disconnect()
+                gobject.idle_add(self.leave_teacher)
                 self.logger.error("Unable to talk to teacher: %s" % sys.exc_value)
             self.logger.warning("Unable to talk to teacher for %d time: %s" % (self.missed_commands, sys.exc_value))
         return command, params_ret
 
+    def request_teacher(self, name, teacher, method, path, body, headers):
+        """Sends a request to teacher over a named persistent connection,
+        which is opened again once if the teacher closed it"""
+        for attempt in range(2):
+            connection = self.connections.get(name)
+            if not connection or connection.host != teacher:
+                if connection:
+                    connection.close()
+                timeout = network.HTTP_TIMEOUT
+                if name == "poll":
+                    timeout += self.poll_wait
+                connection = httplib.HTTPConnection(teacher, network.LISTENPORT, timeout=timeout)
+                self.connections[name] = connection
+            try:
+                connection.request(method, path, body, headers)
+                return connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                del self.connections[name]
+                if attempt:
+                    raise
+
+    def leave_teacher(self):
+        """Leaves a teacher which stopped answering"""
+        self.noop()
+        self.disconnect()
+        return False
+
     def monitor_mcast(self):
-        """Monitor for multicast messages"""
-        while not self.mcast.messages.empty():
-            message, sender = self.mcast.messages.get()
-            screen_width, screen_height, fullscreen, pos_x, pos_y, step_x, step_y, img = self.protocol.unpack_chunk(message)
-            self.logger.debug("Received image at %dx%d-%dx%d (fullscreen=%s)" % (pos_x, pos_y, step_x, step_y, fullscreen))
-            # ignore messages received from different teacher
-            if sender != self.teacher_addr:
-                self.logger.info( "Ignoring multicast request from other teacher (%s instead of %s)" % (sender, self.teacher_addr))
+        """Asks the teacher to send again the chunks missed by the last frames"""
+        nacks = self.projection_stats.get_nacks()
+        if nacks and self.teacher_addr:
+            self.send_command(protocol.REQUEST_NACK, {"missing": self.protocol.pack_nack(nacks)})
+
+        gobject.timeout_add(200, self.monitor_mcast)
+
+    def decode_tiles(self):
+        """Decodes received projection tiles, in a background thread"""
+        while not self.quitting:
+            chunk = self.projection_tiles.get(timeout=1)
+            if not chunk:
                 continue
             try:
+                screen_width, screen_height, fullscreen, pos_x, pos_y, step_x, step_y, \
+                        frame_id, seq, tiles, timestamp, img = chunk
                 loader = gdk.PixbufLoader(image_type="jpeg")
                 loader.write(img)
                 loader.close()
                 pb = loader.get_pixbuf()
+                # fullscreen tiles are scaled to our screen size right away
+                if fullscreen == 1 and (self.screen.width != screen_width or self.screen.height != screen_height):
+                    pb = pb.scale_simple(int(math.ceil(step_x * self.screen.width * 1.0 / screen_width)),
+                            int(math.ceil(step_y * self.screen.height * 1.0 / screen_height)),
+                            gtk.gdk.INTERP_BILINEAR)
+            except:
+                self.logger.exception("Decoding projection chunk")
+                continue
+            with self.projection_lock:
+                self.projection_ready.append((chunk, pb))
+                if self.projection_draw_pending:
+                    continue
+                self.projection_draw_pending = True
+            gobject.idle_add(self.draw_tiles)
 
-                gc = self.drawing.get_style().fg_gc[gtk.STATE_NORMAL]
-                # are we in fullscreen mode ?
-                if fullscreen == 1:
-                    width = self.screen.width
-                    height = self.screen.height
-                    if width != screen_width or height != screen_height:
-                        self.projection_window.set_size_request(screen_width, screen_height)
-                        self.drawing.set_size_request(screen_width, screen_height)
-                    if self.projection_window.is_fullscreen == False:
-                        self.projection_window.set_has_frame(False)
-                        self.projection_window.set_decorated(False)
-                        self.block_keyboard_mouse()
-                        self.projection_window.fullscreen()
-                        self.projection_window.is_fullscreen = True
-                    scaling_ratio_x = 1.0 * width / screen_width
-                    scaling_ratio_y = 1.0 * height / screen_height
-                else:
-                    width, height = self.projection_window.get_size()
-                    if width != screen_width or height != screen_height:
-                        self.projection_window.set_size_request(screen_width, screen_height)
-                        self.drawing.set_size_request(screen_width, screen_height)
-                    if self.projection_window.is_fullscreen:
-                        self.projection_window.set_has_frame(True)
-                        self.projection_window.set_decorated(True)
-                        self.projection_window.unfullscreen()
-                        self.projection_window.is_fullscreen = False
-                    scaling_ratio_x = 1
-                    scaling_ratio_y = 1
-                # drawing or scaling
-                if scaling_ratio_x != 1 or scaling_ratio_y != 1:
-                    # scaling received stuff
-                    new_pos_x = math.ceil(pos_x * scaling_ratio_x)
-                    new_pos_y = math.ceil(pos_y * scaling_ratio_y)
-                    new_step_x = math.ceil(step_x * scaling_ratio_x)
-                    new_step_y = math.ceil(step_y * scaling_ratio_y)
-                    pb2 = pb.scale_simple(new_step_x, new_step_y, gtk.gdk.INTERP_BILINEAR)
-                    self.drawing.window.draw_pixbuf(gc, pb2, 0, 0, new_pos_x, new_pos_y, new_step_x, new_step_y)
-                else:
-                    self.drawing.window.draw_pixbuf(gc, pb, 0, 0, pos_x, pos_y, step_x, step_y)
-
+    def draw_tiles(self):
+        """Draws the decoded projection tiles, from the main loop"""
+        with self.projection_lock:
+            ready = self.projection_ready
+            self.projection_ready = []
+            self.projection_draw_pending = False
+        for chunk, pb in ready:
+            frame_id = chunk[7]
+            position = chunk[3:7]
+            # concurrent decoders may finish an older tile last
+            if self.projection_drawn.is_covered(position, frame_id):
+                continue
+            self.projection_drawn.mark(position, frame_id)
+            try:
+                self.draw_chunk(chunk, pb)
             except:
-                self.logger.exception("Processing multicast message")
+                self.logger.exception("Drawing projection chunk")
+        return False
 
-        gobject.timeout_add(1000, self.monitor_mcast)
+    def receive_mcast(self, message, sender):
+        """Processes a multicast message, from the multicast listener thread"""
+        # ignore messages received from different teacher
+        if sender != self.teacher_addr:
+            self.logger.info( "Ignoring multicast request from other teacher (%s instead of %s)" % (sender, self.teacher_addr))
+            return
+        try:
+            # parity packets may allow to rebuild lost chunks
+            packets = self.projection_fec.put(message)
+            # anything else than the message itself was rebuilt
+            first_rebuilt = int(not self.protocol.is_parity(message))
+            for index, data in enumerate(packets):
+                # headers are read from the message buffer, which is reused
+                # for the next ones
+                chunk = self.protocol.unpack_chunk(data)
+                if not chunk:
+                    continue
+                screen_width, screen_height, fullscreen, pos_x, pos_y, step_x, step_y, \
+                        frame_id, seq, tiles, timestamp, img = chunk
+                position = (pos_x, pos_y, step_x, step_y)
+                # skip tiles already drawn over by newer ones
+                if not self.projection_stats.put(frame_id, seq, tiles, timestamp, position, index >= first_rebuilt):
+                    continue
+                if isinstance(img, memoryview):
+                    # only the image of tiles to draw is copied
+                    chunk = chunk[:-1] + (img.tobytes(),)
+                self.projection_tiles.put(position, frame_id, chunk)
+        except:
+            self.logger.exception("Processing multicast message")
+
+    def draw_chunk(self, chunk, pb):
+        """Draws a decoded projection chunk"""
+        screen_width, screen_height, fullscreen, pos_x, pos_y, step_x, step_y, \
+                frame_id, seq, tiles, timestamp, img = chunk
+        self.logger.debug("Received image at %dx%d-%dx%d (fullscreen=%s)" % (pos_x, pos_y, step_x, step_y, fullscreen))
+
+        gc = self.drawing.get_style().fg_gc[gtk.STATE_NORMAL]
+        # are we in fullscreen mode ?
+        if fullscreen == 1:
+            width = self.screen.width
+            height = self.screen.height
+            if width != screen_width or height != screen_height:
+                self.projection_window.set_size_request(screen_width, screen_height)
+                self.drawing.set_size_request(screen_width, screen_height)
+            if self.projection_window.is_fullscreen == False:
+                self.projection_window.set_has_frame(False)
+                self.projection_window.set_decorated(False)
+                self.block_keyboard_mouse()
+                self.projection_window.fullscreen()
+                self.projection_window.is_fullscreen = True
+            scaling_ratio_x = 1.0 * width / screen_width
+            scaling_ratio_y = 1.0 * height / screen_height
+        else:
+            width, height = self.projection_window.get_size()
+            if width != screen_width or height != screen_height:
+                self.projection_window.set_size_request(screen_width, screen_height)
+                self.drawing.set_size_request(screen_width, screen_height)
+            if self.projection_window.is_fullscreen:
+                self.projection_window.set_has_frame(True)
+                self.projection_window.set_decorated(True)
+                self.projection_window.unfullscreen()
+                self.projection_window.is_fullscreen = False
+            scaling_ratio_x = 1
+            scaling_ratio_y = 1
+        # drawing or scaling
+        if scaling_ratio_x != 1 or scaling_ratio_y != 1:
+            # scaling received stuff
+            new_pos_x = math.ceil(pos_x * scaling_ratio_x)
+            new_pos_y = math.ceil(pos_y * scaling_ratio_y)
+            new_step_x = math.ceil(step_x * scaling_ratio_x)
+            new_step_y = math.ceil(step_y * scaling_ratio_y)
+            if pb.get_width() != new_step_x or pb.get_height() != new_step_y:
+                pb = pb.scale_simple(new_step_x, new_step_y, gtk.gdk.INTERP_BILINEAR)
+            self.drawing.window.draw_pixbuf(gc, pb, 0, 0, new_pos_x, new_pos_y, new_step_x, new_step_y)
+        else:
+            self.drawing.window.draw_pixbuf(gc, pb, 0, 0, pos_x, pos_y, step_x, step_y)
 
     def monitor_bcast(self):
         """Monitors broadcast teacher status"""
@@ -534,12 +1049,13 @@ class Student:
                 # Was the protocol parsed correctly?
                 self.logger.info("Skipping unknown protocol announced by %s" % source)
             else:
-                name, flags = self.protocol.parse_announce(msg)
+                name, flags, group = self.protocol.parse_announce(msg)
                 self.logger.debug("Found teacher <%s> at %s" % (name, source))
                 model = self.teachers.get_model()
                 if name not in [x[0] for x in model]:
                     self.teachers.append_text(name)
                     self.teachers_addr[name] = source
+                    self.teachers_group[name] = group
                     # should we enable the login dialog?
                     if len(model) > 0:
                         self.teachers.set_active(0)
@@ -22,6 +22,7 @@ along with this program; if not, see <http://www.gnu.org/licenses/>.
 import sys
 import traceback
 import time
+import thread
 
 import socket
 import struct
@@ -32,11 +33,13 @@ import pygtk
 import gobject
 from gtk import gdk
 
+import multiprocessing
 from multiprocessing import Queue
 import SocketServer
 import socket
 import urllib
 from threading import Thread
+import threading
 
 import gettext
 import __builtin__
@@ -49,7 +52,7 @@ except IOError:
     traceback.print_exc()
 
 # configuration
-from openclass import network, system, protocol, screen, notification, config
+from openclass import network, system, protocol, screen, notification, config, projection, fec, download, streamer
 import skins
 
 # variables
@@ -86,8 +89,34 @@ class TeacherRunner(Thread):
         # actions for clients
         self.clients_actions = {}
 
+        # protects clients and their actions, as requests are served
+        # concurrently
+        self.lock = thread.allocate_lock()
+
+        # longest time to hold a student request
+        try:
+            self.max_wait = float(self.config.get("gui", "max_poll_wait", "30"))
+        except:
+            self.logger.exception("Detecting long poll timeout")
+            self.max_wait = 30.0
+        # clients with a held request -> time it will be answered
+        self.waiting = {}
+
+        # student thumbnails size and minimum interval between them, as
+        # told to students when registering: "<width>x<height> <seconds>"
+        try:
+            self.thumbnail_settings = "%dx%d %d" % (int(self.config.get("gui", "thumbnail_width", "64")),
+                    int(self.config.get("gui", "thumbnail_height", "64")),
+                    int(self.config.get("gui", "thumbnail_interval", "2")))
+        except:
+            self.logger.exception("Detecting thumbnail settings")
+            self.thumbnail_settings = "64x64 2"
+
         # authorized files for transfer
         self.authorized_files = []
+        # (shared file, size, modification time) -> sha-256 digest, or None
+        # while it is computed
+        self.file_digests = {}
 
         # protocol
         self.protocol = protocol.Protocol(self.logger)
@@ -95,16 +124,67 @@ class TeacherRunner(Thread):
         # listening server
         self.server = network.HTTPListener(self)
 
+        # persistent control channel, with tls when a certificate is given
+        self.control = None
+        # clients which were pushed the current action over it
+        self.current_pushed = set()
+        try:
+            if int(self.config.get("control", "enabled", "1")):
+                certfile = None
+                if int(self.config.get("control", "use_ssl", "0")):
+                    certfile = self.config.get("control", "certificate", "")
+                self.control = network.ControlListener(self, logger, certfile=certfile)
+        except:
+            self.logger.exception("Starting control channel, students will use http only")
+
         # broadcast sender
         self.bcast = None
 
         # multicast sender
         try:
-            self.mcast_frequency = float(self.config.get("multicast", "min_interval", "0.05"))
+            self.mcast_frequency = float(self.config.get("multicast", "min_interval", "0"))
         except:
             self.logger.exception("Detecting multicast interval")
-            self.mcast_frequency = 0.05
-        self.mcast = network.McastSender(logger=logger, interval = self.mcast_frequency)
+            self.mcast_frequency = 0
+        try:
+            mcast_rate = int(self.config.get("multicast", "max_rate", "1250000"))
+            mcast_burst = int(self.config.get("multicast", "burst", "65536"))
+        except:
+            self.logger.exception("Detecting multicast rate")
+            mcast_rate = 1250000
+            mcast_burst = 65536
+        self.mcast = network.McastSender(logger=logger, interval = self.mcast_frequency,
+                rate=mcast_rate, burst=mcast_burst)
+
+        # multicast file sender, sharing files with the whole class at once
+        try:
+            self.mcast_files = int(self.config.get("multicast", "files", "1"))
+            files_rate = int(self.config.get("multicast", "files_rate", "1250000"))
+        except:
+            self.logger.exception("Detecting multicast file settings")
+            self.mcast_files = 1
+            files_rate = 1250000
+        self.files = network.McastFileSender(logger, rate=files_rate, burst=mcast_burst)
+        # short name -> shared file sent over multicast
+        self.streamed_files = {}
+
+        # projection quality control
+        try:
+            target_rate = int(self.config.get("projection", "target_rate", "1000000"))
+            max_loss = float(self.config.get("projection", "max_loss", "0.05"))
+        except:
+            self.logger.exception("Detecting projection quality targets")
+            target_rate = 1000000
+            max_loss = 0.05
+        self.quality = projection.QualityController(logger, target_rate, max_loss)
+        self.frame_id = 0
+
+        # forward error correction: "auto", "0" (disabled) or a group size
+        self.fec_mode = self.config.get("projection", "fec", "auto")
+        self.fec = fec.FecEncoder(logger)
+
+        # recently sent chunks, repaired on students request
+        self.repair = projection.RepairBuffer()
 
         # temporary files
         self.tmpfiles = []
@@ -128,20 +208,28 @@ class TeacherRunner(Thread):
                 name = name[0]
             else:
                 name = client
-            client_status = self.clients.get(client, "pending")
+            with self.lock:
+                client_status = self.clients.get(client, "pending")
+                if client_status == "pending":
+                    self.clients[client] = "registered"
             if client_status == "pending":
                 # register student by default, and allow teacher to disconnect it later
                 self.add_client(client, name)
-                self.clients[client] = "registered"
                 response = "registered"
+                response_params = self.thumbnail_settings
             elif client_status == "rejected":
                 response = "rejected"
                 self.reject_client(client, name)
             elif client_status == "registered":
                 response = "registered"
+                response_params = self.thumbnail_settings
             else:
                 self.logger.error("Error: unknown status for %s: %s" % (client, self.clients[client]))
         elif request == protocol.REQUEST_ACTIONS:
+            # a held request of the client is answered now, woken up or
+            # timed out, so it is held again below or not at all
+            with self.lock:
+                self.waiting.pop(client, None)
             # student could send us additional params
             # if client is still unknown, default it to "pending" state
             client_status = self.clients.get(client, "pending")
@@ -155,18 +243,66 @@ class TeacherRunner(Thread):
                     name = name[0]
                 shot = params.get("shot", None)
                 self.add_client(client, name, shot)
+                # projection reception feedback
+                if "tiles" in params:
+                    try:
+                        self.quality.report(client, int(params["tiles"][0]), int(params["missing"][0]),
+                                int(params.get("rebuilt", ["0"])[0]))
+                        self.logger.debug("Projection latency for %s: %s ms, %s tiles dropped, %s frames lost" % (client,
+                            params.get("latency", ["?"])[0], params.get("dropped", ["?"])[0],
+                            params.get("lost_frames", ["?"])[0]))
+                    except:
+                        self.logger.exception("Parsing projection feedback from %s" % client)
                 # checking actions for the client
                 response = self.gui.current_action
                 # TODO: support persistent actions which run until cancelled
                 # for example, individual screen blocking, constant screen
                 # streaming, and so on
-                if client in self.clients_actions:
-                    if len(self.clients_actions[client]) > 0:
+                with self.lock:
+                    if self.clients_actions.get(client):
                         response, response_params = self.clients_actions[client].pop(0)
+                    elif "wait" in params and params.get("current", [None])[0] == response:
+                        # long poll: nothing new for the student, answer
+                        # when an action comes or the wait times out
+                        for key in ["tiles", "missing"]:
+                            params.pop(key, None)
+                        try:
+                            response_params = min(float(params["wait"][0]), self.max_wait)
+                            response = network.DEFER
+                            self.waiting[client] = time.time() + response_params
+                        except:
+                            self.logger.exception("Parsing long poll timeout from %s" % client)
             else:
                     self.logger.error("Error: unknown status for %s: %s" % (client, client_status))
                     # don't know what to do with this student, tell it to go away
                     response = protocol.ACTION_PLEASEREGISTER
+        elif request == protocol.REQUEST_THUMBNAIL:
+            # student screen changed
+            if self.clients.get(client) == "registered":
+                name = params.get("name", [None])[0]
+                # raw jpeg body, or urlencoded by older students
+                shot = params.get("data", params.get("shot", None))
+                self.add_client(client, name, shot)
+        elif request == protocol.REQUEST_NACK:
+            # student missed some projection chunks
+            if self.clients.get(client) == "registered" and "missing" in params:
+                try:
+                    missing = self.protocol.unpack_nack(params["missing"][0])
+                    packets = self.repair.nack(missing)
+                    self.logger.debug("Repairing %d chunks for %s" % (len(packets), client))
+                    for data in packets:
+                        self.mcast.put(data)
+                except:
+                    self.logger.exception("Parsing projection repair request from %s" % client)
+        elif request == protocol.REQUEST_FILENACK:
+            # student missed some chunks of a file sent over multicast
+            if self.clients.get(client) == "registered" and "file" in params and "missing" in params:
+                try:
+                    ranges = self.protocol.unpack_ranges(params["missing"][0])
+                    queued = self.files.nack(params["file"][0], ranges)
+                    self.logger.debug("Sending %d chunks of %s again for %s" % (queued, params["file"][0], client))
+                except:
+                    self.logger.exception("Parsing file repair request from %s" % client)
         elif request == protocol.REQUEST_RAISEHAND:
             # student raised his hand
             self.logger.info("Student called your attention")
@@ -197,9 +333,10 @@ class TeacherRunner(Thread):
                     response = _("File not authorized for transfer")
                 else:
                     try:
-                        with open(filename) as fd:
-                            response = fd.read()
-                            response_params = ""
+                        # checked here, so errors are still reported as text
+                        open(filename).close()
+                        response = network.FileResponse(filename, digest=self.get_digest(filename))
+                        response_params = ""
                     except:
                         response = _("Unable to transfer %s: %s") % (filename, sys.exc_value)
         return response, response_params
@@ -210,7 +347,10 @@ class TeacherRunner(Thread):
         if self.bcast:
             self.bcast.actions.put(1)
         self.mcast.quit()
+        self.files.quit()
         self.server.actions.put(1)
+        if self.control:
+            self.control.actions.put(1)
 
         # remove temporary files
         for z in self.tmpfiles:
@@ -238,35 +378,167 @@ class TeacherRunner(Thread):
     def disconnect_student(self, client, message=_("The teacher asked you to leave this class")):
         """Disconnects a student"""
         self.clients[client] = "rejected"
+        with self.lock:
+            self.waiting.pop(client, None)
 
     def reconnect_student(self, client):
         """Allow the student to join the class again"""
         self.clients[client] = "pending"
 
     def add_client_action(self, client, action, params=None):
-        """Adds an action for a client into a list"""
-        if client not in self.clients_actions:
-            self.clients_actions[client]=[]
-        self.clients_actions[client].append((action, params))
+        """Pushes an action to a client, or adds it into a list for its next
+        request"""
+        if self.control and self.clients.get(client) == "registered":
+            with self.lock:
+                pushed = action == self.gui.current_action and client in self.current_pushed
+                self.current_pushed.discard(client)
+            if pushed and not params:
+                # already pushed to all clients by set_current_action
+                return
+            if self.control.push(client, action, params):
+                return
+        with self.lock:
+            if client not in self.clients_actions:
+                self.clients_actions[client]=[]
+            self.clients_actions[client].append((action, params))
+        self.server.wake(client)
+
+    def is_waiting(self, client):
+        """Checks if a request of a client is being held, so the client is
+        still alive even if it was not heard from recently"""
+        return self.waiting.get(client, 0) > time.time()
+
+    def set_current_action(self, action):
+        """Changes the action of all clients"""
+        self.gui.current_action = action
+        self.server.wake()
+        if self.control:
+            pushed = set()
+            for client, status in self.clients.items():
+                if status == "registered" and self.control.push(client, action):
+                    pushed.add(client)
+            with self.lock:
+                self.current_pushed = pushed
 
     def authorize_file_transfer(self, filename):
         """Authorizes a local file for sharing with students"""
         self.authorized_files.append(filename)
+        try:
+            self.get_digest(filename)
+        except:
+            self.logger.exception("Checking %s" % filename)
+
+    def get_digest(self, filename):
+        """Returns the digest of the current contents of a shared file, or
+        None when it is not known yet. A file modified since its digest was
+        computed is hashed again in background."""
+        st = os.stat(filename)
+        version = (filename, st.st_size, st.st_mtime)
+        with self.lock:
+            if version in self.file_digests:
+                return self.file_digests[version]
+            for old in self.file_digests.keys():
+                if old[0] == filename:
+                    del self.file_digests[old]
+            self.file_digests[version] = None
+        # hashed in background, sent to students when ready
+        thread.start_new_thread(self.compute_digest, (version,))
+        return None
+
+    def compute_digest(self, version):
+        """Computes the digest students verify a shared file against"""
+        filename = version[0]
+        digest = None
+        try:
+            digest = download.file_digest(filename)
+            st = os.stat(filename)
+            if (filename, st.st_size, st.st_mtime) != version:
+                # modified while hashing, computed again when asked for
+                digest = None
+        except:
+            self.logger.exception("Computing digest of %s" % filename)
+        with self.lock:
+            if digest:
+                if version in self.file_digests:
+                    self.file_digests[version] = digest
+            else:
+                self.file_digests.pop(version, None)
+
+    def stream_file(self, filename):
+        """Starts sending a shared file to the class over multicast. Returns
+        False when students should download it over http instead."""
+        if not self.mcast_files:
+            return False
+        # students tell files apart by their short name
+        filename_short = os.path.basename(filename)
+        if self.files.has_stream(filename_short):
+            return self.streamed_files.get(filename_short) == filename
+        encoder = streamer.StreamerEncoder(filename)
+        if len(filename_short) > 255 or not encoder.prepare():
+            return False
+        if not encoder.get_num_chunks():
+            encoder.finish()
+            return False
+        self.logger.info("Sending %s over multicast in %d chunks" % (filename, encoder.get_num_chunks()))
+        self.streamed_files[filename_short] = filename
+        self.files.add(filename_short, encoder)
+        return True
 
     def start_multicast(self):
         """Starts multicast thread"""
         self.mcast.start()
+        self.files.start()
 
     def start_broadcast(self, class_name):
         """Start broadcasting service"""
-        self.bcast = network.BcastSender(self.logger, network.LISTENPORT, self.protocol.create_announce(class_name))
+        group = self.get_multicast_group(class_name)
+        self.logger.info("Using multicast group %s:%d" % group)
+        self.mcast.addr, self.mcast.port = group
+        self.files.addr, self.files.port = group[0], group[1] + network.FILEPORT_OFFSET
+        self.bcast = network.BcastSender(self.logger, network.LISTENPORT,
+                self.protocol.create_announce(class_name, group=group))
         self.class_name = class_name
         self.bcast.start()
 
+    def get_multicast_group(self, class_name):
+        """Returns the multicast group and port of the class, derived from
+        its name unless configured"""
+        addr, port = network.get_class_group(class_name, socket.gethostname())
+        # empty by default, so the derived values are never saved into the
+        # configuration and reused by the next classes
+        try:
+            addr = self.config.get("multicast", "group", "") or addr
+            port = int(self.config.get("multicast", "port", "") or port)
+        except:
+            self.logger.exception("Detecting multicast group")
+        return addr, port
+
     def send_projection(self, width, height, fullscreen, chunks):
         """Send chunks of projection over multicast"""
-        for chunk in chunks:
-            self.mcast.put(self.protocol.pack_chunk(width, height, fullscreen, chunk))
+        self.frame_id += 1
+        tiles = len(chunks)
+        timestamp = int(time.time() * 1000) & 0xffffffff
+        packets = []
+        for seq, chunk in enumerate(chunks):
+            packets.append(self.protocol.pack_chunk(width, height, fullscreen, chunk,
+                    self.frame_id, seq, tiles, timestamp))
+        self.repair.store(self.frame_id, packets)
+        packets = self.fec.encode(packets, self.frame_id, self.get_fec_group_size())
+        for data in packets:
+            self.mcast.put(data)
+
+    def get_fec_group_size(self):
+        """Returns the number of chunks protected by each parity packet"""
+        if self.fec_mode == "auto":
+            # sized from the losses before correction, as the losses left
+            # after it depend on the group size
+            return fec.group_size_for_loss(self.quality.raw_loss)
+        try:
+            return min(int(self.fec_mode), fec.MAX_GROUP_SIZE)
+        except:
+            self.logger.exception("Detecting forward error correction group size")
+            self.fec_mode = "auto"
+            return 0
 
     def run(self):
         """Starts a background thread"""
@@ -283,6 +555,72 @@ class TeacherRunner(Thread):
                 self.logger.error("Unknown action %s" % name)
 # }}}
 
+# {{{ ThumbnailDecoder
+class ThumbnailDecoder:
+    """Decodes student thumbnails in background threads, keeping only the
+    latest one of each student, so a backlog of superseded thumbnails is
+    never decoded"""
+    def __init__(self, logger, callback, workers=2):
+        """Callback is called from a decoding thread when decoded
+        thumbnails become available, and not again until they are taken
+        with get_ready()"""
+        self.logger = logger
+        self.callback = callback
+        self.lock = threading.Condition()
+        # client -> latest jpeg waiting to be decoded
+        self.pending = {}
+        # client -> latest decoded pixbuf
+        self.ready = {}
+        self.superseded = 0
+        self.quitting = False
+        for i in range(workers):
+            worker = Thread(target=self.run)
+            worker.setDaemon(True)
+            worker.start()
+
+    def put(self, client, shot):
+        """Queues a thumbnail for decoding"""
+        with self.lock:
+            if client in self.pending:
+                self.superseded += 1
+            self.pending[client] = shot
+            self.lock.notify()
+
+    def get_ready(self):
+        """Returns the decoded thumbnails, as a dict of pixbufs by client"""
+        with self.lock:
+            ready = self.ready
+            self.ready = {}
+        return ready
+
+    def run(self):
+        """Decodes thumbnails"""
+        while not self.quitting:
+            with self.lock:
+                if not self.pending:
+                    self.lock.wait(1)
+                if not self.pending:
+                    continue
+                client, shot = self.pending.popitem()
+            try:
+                loader = gdk.PixbufLoader(image_type="jpeg")
+                loader.write(shot)
+                loader.close()
+                pb = loader.get_pixbuf()
+            except:
+                self.logger.exception("Decoding thumbnail of %s" % client)
+                continue
+            with self.lock:
+                notify = not self.ready
+                self.ready[client] = pb
+            if notify:
+                self.callback()
+
+    def quit(self):
+        """Stops the decoding threads"""
+        self.quitting = True
+# }}}
+
 # {{{ TeacherGui
 class TeacherGui:
     selected_machines = 0
@@ -296,6 +634,10 @@ class TeacherGui:
         self.class_name = None
         self.bcast = None
         self.clients_queue = Queue()
+        # student thumbnails, decoded in background
+        self.thumbnails = ThumbnailDecoder(logger, self.queue_thumbnails)
+        # client -> decoded thumbnail waiting for its machine to be visible
+        self.thumbnails_pending = {}
         self.service = service
         self.service.set_gui(self)
 
@@ -324,9 +666,47 @@ class TeacherGui:
         self.curtimestamp = 0
 
         # projection screen
-        self.projection_screen = screen.Screen()
+        try:
+            workers = int(self.config.get("projection", "workers", str(multiprocessing.cpu_count())))
+        except:
+            self.logger.exception("Detecting number of encoding processes")
+            workers = 0
+        capture = self.config.get("projection", "capture", screen.DEFAULT_CAPTURE)
+        try:
+            self.projection_screen = screen.Screen(self.logger, workers=workers, capture=capture)
+        except:
+            self.logger.exception("Initializing %s capture backend" % capture)
+            self.projection_screen = screen.Screen(self.logger, workers=workers)
         self.projection_width = None
         self.projection_height = None
+        # send only changed areas of the screen, with a full refresh from
+        # time to time for late-joining students and lost packets
+        try:
+            block_size = int(self.config.get("projection", "block_size", str(screen.BLOCK_SIZE)))
+        except:
+            self.logger.exception("Detecting projection block size")
+            block_size = screen.BLOCK_SIZE
+        self.projection_diff = screen.FrameDiff(block_size=block_size)
+        try:
+            # frames between full refreshes, 0 for never
+            self.projection_refresh = max(0, int(self.config.get("projection", "full_refresh", "20")))
+        except:
+            self.logger.exception("Detecting projection full refresh interval")
+            self.projection_refresh = 20
+        self.projection_frames = 0
+        # keep every projection datagram below the network MTU
+        try:
+            max_datagram = int(self.config.get("projection", "max_datagram", "1472"))
+        except:
+            self.logger.exception("Detecting projection datagram size")
+            max_datagram = 1472
+        max_size = max_datagram - protocol.CHUNK_HEADER_SIZE
+        # parity packets are slightly bigger than the chunks they protect
+        if self.service.fec_mode != "0":
+            max_size -= fec.PARITY_OVERHEAD
+        self.projection_tiler = screen.Tiler(max_size=max_size)
+        # skip capturing when nothing was drawn on the screen
+        self.projection_damage = screen.DamageTracker(self.logger)
 
         # Inicializa a matriz de maquinas
         self.machine_layout = [None] * MACHINES_X
@@ -387,6 +767,8 @@ class TeacherGui:
             self.service.start_broadcast(self.class_name)
             self.service.start_multicast()
             self.service.server.start()
+            if self.service.control:
+                self.service.control.start()
             return True
         else:
             dialog.destroy()
@@ -493,7 +875,33 @@ class TeacherGui:
 
     def add_client(self, client, name, shot=None):
         """Adds a new client"""
-        self.clients_queue.put(("new", client, {"name": name, "shot": shot}))
+        self.clients_queue.put(("new", client, {"name": name}))
+        if shot:
+            self.thumbnails.put(client, shot[0])
+
+    def queue_thumbnails(self):
+        """Schedules an update of the decoded thumbnails, from any thread"""
+        gobject.idle_add(self.update_thumbnails)
+
+    def update_thumbnails(self):
+        """Shows the decoded thumbnails of the visible machines"""
+        self.thumbnails_pending.update(self.thumbnails.get_ready())
+        for addr, pb in self.thumbnails_pending.items():
+            machine = self.machines.get(addr)
+            if not machine:
+                # not added yet
+                continue
+            if self.machines_status.get(addr) == "rejected":
+                del self.thumbnails_pending[addr]
+                continue
+            if not machine.flags() & gtk.MAPPED:
+                # updated when visible again
+                continue
+            del self.thumbnails_pending[addr]
+            machine.image.set_from_pixbuf(pb)
+            if machine.button.get_image() is not machine.image:
+                machine.button.set_image(machine.image)
+        return False
 
     def queue_raise_hand(self, client, message):
         """A student calls for attention"""
@@ -514,8 +922,9 @@ class TeacherGui:
 
     def projection(self):
         """Grabs the screen for multicast projection when needed"""
+        # damaged areas are collected even when idle, to keep them current
+        damage = self.projection_damage.get_damage()
         if self.current_action == protocol.ACTION_PROJECTION:
-            self.logger.info("Sending screens, yee-ha!")
             # how many chunks?
             # TODO: auto-detect this according to the screen size
             try:
@@ -525,14 +934,44 @@ class TeacherGui:
                 self.logger.exception("Detecting number of chunks")
                 chunks_x = 4
                 chunks_y = 4
-            # we are projecting, grab stuff
+            self.service.quality.update(self.service.mcast.get_rate())
+            quality, scale, interval = self.service.quality.get_settings()
+            width = self.projection_width
+            height = self.projection_height
+            # students scale fullscreen projection to their screens
+            if self.projection_fullscreen:
+                width = int(width * scale)
+                height = int(height * scale)
+            frequency = int(self.projection_frequency * interval)
+
+            if self.projection_refresh and self.projection_frames % self.projection_refresh == 0:
+                self.projection_diff.reset()
+                damage = None
+            self.projection_frames += 1
+
+            # nothing was drawn, nothing to send
+            if damage == []:
+                gobject.timeout_add(frequency, self.projection)
+                return
 
+            if damage:
+                scale_x = 1.0 * width / self.projection_screen.width
+                scale_y = 1.0 * height / self.projection_screen.height
+                damage = screen.scale_rects(damage, scale_x, scale_y)
+
+            # we are projecting, grab stuff
+            self.logger.info("Sending screens, yee-ha!")
             chunks = self.projection_screen.chunks(chunks_x=chunks_x,
-                    chunks_y=chunks_y, scale_x=self.projection_width,
-                    scale_y=self.projection_height)
+                    chunks_y=chunks_y, scale_x=width, scale_y=height,
+                    quality=quality, diff=self.projection_diff,
+                    tiler=self.projection_tiler, damage=damage)
 
-            self.service.send_projection(self.projection_width,
-                    self.projection_height, self.projection_fullscreen, chunks)
+            if chunks:
+                self.service.send_projection(width, height,
+                        self.projection_fullscreen, chunks)
+
+            gobject.timeout_add(frequency, self.projection)
+            return
 
         gobject.timeout_add(self.projection_frequency, self.projection)
 
@@ -602,15 +1041,6 @@ class TeacherGui:
                     elif self.machines_status[addr] == "pending":
                         self.machines_status[addr] = "registered"
                     machine = self.machines[addr]
-                    shot = params.get("shot")
-                    if shot:
-                        loader = gdk.PixbufLoader(image_type="jpeg")
-                        loader.write(shot[0])
-                        loader.close()
-                        pb = loader.get_pixbuf()
-                        img = gtk.Image()
-                        img.set_from_pixbuf(pb)
-                        machine.button.set_image(img)
                     name = params.get("name")
                     if name:
                         machine.label.set_markup(self.mkname(name))
@@ -637,12 +1067,19 @@ class TeacherGui:
                     name = self.machines[addr].machine
                 self.show_message(_("Message received from %s") % name, message, timeout=0)
 
+        # thumbnails of machines which were not added or visible yet
+        if self.thumbnails_pending:
+            self.update_thumbnails()
+
         # nuke old clients
         for addr in self.machines_alive:
             client_ts = self.machines_alive[addr]
             if client_ts < 0:
                 # skip already dead clients
                 continue
+            if self.service.is_waiting(addr):
+                self.machines_alive[addr] = timestamp
+                continue
             timeout = int(timestamp - client_ts)
             if timeout > self.max_client_timeout:
                 self.logger.warning("Error: client %s has lost connection" % addr)
@@ -667,14 +1104,15 @@ class TeacherGui:
             if not res:
                 return
             self.SendScreen.set_label(_("Stop sending screen"))
-            self.current_action = protocol.ACTION_PROJECTION
+            self.projection_frames = 0
+            self.service.set_current_action(protocol.ACTION_PROJECTION)
             self.LockScreen.set_sensitive(False)
             for machine in machines:
                 self.service.add_client_action(machine, protocol.ACTION_PROJECTION)
         else:
             self.logger.info("Stopping sending screens")
             self.SendScreen.set_label(_("Send Screen"))
-            self.current_action = protocol.ACTION_NOOP
+            self.service.set_current_action(protocol.ACTION_NOOP)
             self.LockScreen.set_sensitive(True)
             for machine in machines:
                 self.service.add_client_action(machine, protocol.ACTION_NOOP)
@@ -766,14 +1204,18 @@ class TeacherGui:
         filename_short = filename.split(os.sep)[-1]
         self.service.authorize_file_transfer(filename)
         chooser.destroy()
-        if do_open:
-            file_action="open::%s" % filename
-        else:
-            file_action="down:%s:%s" % (filename_short, filename)
         if not client:
             machines = self.get_selected_machines()
         else:
             machines = [client]
+        if do_open:
+            file_action="open::%s" % filename
+        elif len(machines) > 1 and self.service.stream_file(filename):
+            # sent once for everyone, students still download it when
+            # multicast does not reach them
+            file_action="mcast:%s:%s" % (filename_short, filename)
+        else:
+            file_action="down:%s:%s" % (filename_short, filename)
         for machine in machines:
             self.service.add_client_action(machine, protocol.ACTION_OPENFILE, file_action)
 
@@ -784,14 +1226,14 @@ class TeacherGui:
         if self.current_action != protocol.ACTION_ATTENTION:
             self.logger.info("Locking screens")
             self.LockScreen.set_label(_("Stop locking screen"))
-            self.current_action = protocol.ACTION_ATTENTION
+            self.service.set_current_action(protocol.ACTION_ATTENTION)
             self.SendScreen.set_sensitive(False)
             for machine in machines:
                 self.service.add_client_action(machine, protocol.ACTION_ATTENTION)
         else:
             self.logger.info("Stopping locking screens")
             self.LockScreen.set_label(_("Lock Screen"))
-            self.current_action = protocol.ACTION_NOOP
+            self.service.set_current_action(protocol.ACTION_NOOP)
             self.SendScreen.set_sensitive(True)
             for machine in machines:
                 self.service.add_client_action(machine, protocol.ACTION_NOOP)
@@ -810,6 +1252,9 @@ class TeacherGui:
         """Main window was closed"""
         self.logger.info("Closing pending threads..")
         self.service.quit()
+        self.thumbnails.quit()
+        self.projection_screen.stop()
+        self.projection_damage.close()
         gtk.main_quit()
         self.logger.info("done")
 
@@ -831,6 +1276,8 @@ class TeacherGui:
 
         button = gtk.Button()
         button.set_image(img)
+        # thumbnail, reused for every update
+        box.image = gtk.Image()
         box.pack_start(button, expand=False)
 
         label = gtk.Label(_("name"))